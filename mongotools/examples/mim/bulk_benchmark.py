@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""Usage:
+        bulk_benchmark.py [options]
+
+Time loading a fixture into an indexed mim collection one document at a
+time, as a list passed to insert(), and through the bulk write API.
+
+Options:
+  -h --help              show this help message and exit
+  -n COUNT               number of documents to insert [default: 100000]
+  -i INDEXES             number of secondary indexes [default: 2]
+"""
+import time
+
+import docopt
+
+def main(args):
+    from mongotools import mim
+    n, n_indexes = int(args['-n']), int(args['-i'])
+    docs = [ make_doc(i) for i in range(n) ]
+    for label, load in (('insert each', insert_each),
+                        ('insert list', insert_list),
+                        ('bulk op', bulk_op)):
+        coll = mim.Connection().db.coll
+        for i in range(n_indexes):
+            coll.ensure_index('f%d' % i)
+        start = time.time()
+        load(coll, docs)
+        elapsed = time.time() - start
+        assert coll.find().count() == n
+        print '%-12s %8.0f docs/s' % (label, n / elapsed)
+
+def insert_each(coll, docs):
+    for doc in docs:
+        coll.insert(doc)
+
+def insert_list(coll, docs):
+    coll.insert(docs)
+
+def bulk_op(coll, docs):
+    bulk = coll.initialize_unordered_bulk_op()
+    for doc in docs:
+        bulk.insert(dict(doc))
+    bulk.execute()
+
+def make_doc(i):
+    return dict(_id=i, f0=i % 97, f1='k%d' % (i % 1013), f2=-i,
+                name='doc %d' % i, tags=['a', 'b'])
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
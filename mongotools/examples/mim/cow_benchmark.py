@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Usage:
+        cow_benchmark.py [options]
+
+Compare mim's default (BSON-copying) storage with copy-on-write storage.
+
+Options:
+  -h --help              show this help message and exit
+  -n COUNT               number of documents to insert [default: 20000]
+  -r READS               number of full passes over the collection [default: 5]
+  -w WIDTH               number of subdocuments per document [default: 10]
+"""
+import sys
+import time
+
+import docopt
+
+def main(args):
+    from mongotools import mim
+    n, reads, width = int(args['-n']), int(args['-r']), int(args['-w'])
+    docs = [ make_doc(i, width) for i in range(n) ]
+    for label, cow in (('bson copy', False), ('copy-on-write', True)):
+        coll = mim.Connection(copy_on_write=cow).db.coll
+        start = time.time()
+        coll.insert(docs)
+        t_insert = time.time() - start
+        start = time.time()
+        for x in range(reads):
+            for doc in coll.find():
+                doc['sub0']['v']
+        t_read = time.time() - start
+        results = list(coll.find())
+        start = time.time()
+        for x in range(reads):
+            coll.update({'_id': x}, {'$set': {'sub0.v': -x}})
+        t_update = (time.time() - start) / reads
+        print '%-14s insert %6.0f docs/s   read %7.0f docs/s   update %.2fms' % (
+            label, n / t_insert, n * reads / t_read, t_update * 1000)
+        print '%-14s %d results hold %.1fMB' % (
+            '', len(results), deep_sizeof(results) / 2.0 ** 20)
+
+def make_doc(i, width):
+    doc = dict(_id=i, name='doc %d' % i, tags=['a', 'b', 'c'])
+    for j in range(width):
+        doc['sub%d' % j] = dict(v=j, s='x' * 20, l=range(5))
+    return doc
+
+def deep_sizeof(obj, seen=None):
+    '''Bytes held by obj, counting objects shared between results once'''
+    if seen is None: seen = set()
+    if id(obj) in seen: return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen)
+                    for k, v in dict.iteritems(obj))
+    elif isinstance(obj, list):
+        size += sum(deep_sizeof(v, seen) for v in list.__iter__(obj))
+    return size
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
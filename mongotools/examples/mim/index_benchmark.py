@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""Usage:
+        index_benchmark.py [options]
+
+Time range, prefix and sorted queries against a compound mim index, and the
+same queries forced to a full collection scan with a $natural hint.
+
+Options:
+  -h --help              show this help message and exit
+  -n COUNT               number of documents in the collection [default: 100000]
+  -r REPEAT              times to run each query [default: 20]
+"""
+import time
+
+import docopt
+
+QUERIES = [
+    ('range', {'a': {'$gte': 10, '$lt': 12}}, None, None),
+    ('prefix + range', {'a': 7, 'b': {'$gt': 900}}, None, None),
+    ('prefix sort', {'a': 3}, [('b', -1)], 10),
+    ('reverse sort', {}, [('a', -1), ('b', 1)], 10),
+    ]
+
+def main(args):
+    from mongotools import mim
+    n, repeat = int(args['-n']), int(args['-r'])
+    coll = mim.Connection().db.coll
+    coll.ensure_index([('a', 1), ('b', -1)])
+    coll.insert([ dict(_id=i, a=i % 100, b=i % 997, name='doc %d' % i)
+                  for i in range(n) ])
+    print '%-16s %10s %10s' % ('query', 'index', 'scan')
+    for label, spec, sort, limit in QUERIES:
+        timings = []
+        for hint in (None, [('$natural', 1)]):
+            start = time.time()
+            for i in range(repeat):
+                cursor = coll.find(spec).hint(hint)
+                if sort: cursor = cursor.sort(sort)
+                if limit: cursor = cursor.limit(limit)
+                list(cursor)
+            timings.append((time.time() - start) / repeat)
+        print '%-16s %8.2fms %8.2fms' % (label, timings[0] * 1000, timings[1] * 1000)
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
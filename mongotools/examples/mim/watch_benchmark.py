@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""Usage:
+        watch_benchmark.py [options]
+
+Time inserts into a mim collection with no watchers, then with increasing
+numbers of change stream watchers, each draining its own queue.  Half the
+watchers filter on a field, so both fan-out and matching are measured.
+
+Options:
+  -h --help              show this help message and exit
+  -n COUNT               number of documents inserted per run [default: 10000]
+  -w WATCHERS            comma-separated watcher counts [default: 0,10,100,500]
+"""
+import time
+
+import docopt
+
+def main(args):
+    from mongotools import mim
+    n = int(args['-n'])
+    print '%8s %12s %12s' % ('watchers', 'insert/doc', 'events')
+    for count in map(int, args['-w'].split(',')):
+        coll = mim.Connection().db.coll
+        watchers = [
+            coll.watch({'fullDocument.a': i % 10} if i % 2 else None,
+                       max_queue=n)
+            for i in range(count) ]
+        start = time.time()
+        for i in range(n):
+            coll.insert({'_id': i, 'a': i % 10})
+        elapsed = time.time() - start
+        events = 0
+        for watcher in watchers:
+            while watcher.try_next() is not None:
+                events += 1
+        print '%8d %10.1fus %12d' % (count, elapsed / n * 1e6, events)
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""Usage:
+        dispatch_benchmark.py [options]
+
+Time a mim channel handling messages whose callback sleeps, with callbacks
+run on the tailing thread and on a Dispatcher's workers.
+
+Options:
+  -h --help              show this help message and exit
+  -n COUNT               messages to publish [default: 1000]
+  -k KEYS                distinct message keys [default: 100]
+  -d DELAY               seconds each callback sleeps [default: 0.001]
+  -w WORKERS             dispatcher worker threads [default: 8]
+"""
+import time
+
+import docopt
+
+def main(args):
+    from mongotools import mim, pubsub
+    n, keys, delay = int(args['-n']), int(args['-k']), float(args['-d'])
+    def callback(chan, msg):
+        time.sleep(delay)
+    print '%-12s %10s' % ('dispatch', 'msgs/s')
+    for label, dispatcher in [
+            ('inline', None),
+            ('workers', pubsub.Dispatcher(workers=int(args['-w'])))]:
+        bind = mim.Connection(oplog_size=2**24)
+        chan = pubsub.Channel(bind.db, 'chan', dispatcher)
+        chan.ensure_channel(capacity=n)
+        chan.sub('', callback)
+        chan.multipub([ dict(k='key.%d' % (i % keys), data=i) for i in range(n) ])
+        start = time.time()
+        chan.handle_ready()
+        if dispatcher is not None:
+            dispatcher.close()
+        print '%-12s %10.0f' % (label, n / (time.time() - start))
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
@@ -0,0 +1,16 @@
+# Subscriber to many channels from one thread
+import pymongo
+from mongotools.pubsub import Channel, Loop
+
+cli = pymongo.MongoClient()
+loop = Loop(cli)
+
+def printer(chan, msg):
+    print chan, msg
+
+for i in range(100):
+    chan = loop.add(Channel(cli.test, 'mychannel%d' % i))
+    chan.ensure_channel()
+    chan.sub('foo', printer)
+
+loop.run()
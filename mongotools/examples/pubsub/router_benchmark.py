@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""Usage:
+        router_benchmark.py [options]
+
+Time resolving the callbacks for a message key with the prefix trie
+Channel uses, and with a regex per subscription as Channel used to, for
+growing numbers of prefix subscriptions.
+
+Options:
+  -h --help              show this help message and exit
+  -n COUNT               messages to dispatch per run [default: 10000]
+  -s SUBSCRIPTIONS       comma-separated subscription counts [default: 10,100,1000,10000]
+"""
+import re
+import time
+import random
+
+import docopt
+
+def main(args):
+    from mongotools.pubsub.router import Router
+    n = int(args['-n'])
+    print '%14s %12s %12s' % ('subscriptions', 'trie', 'regexes')
+    for count in map(int, args['-s'].split(',')):
+        prefixes = [ 'event.%d.' % i for i in range(count) ]
+        keys = [ 'event.%d.update' % random.randrange(count * 2)
+                 for i in range(n) ]
+        router = Router()
+        patterns = []
+        for prefix in prefixes:
+            router.add(prefix, callback)
+            patterns.append((re.compile('^' + re.escape(prefix)), [ callback ]))
+        start = time.time()
+        for key in keys:
+            router.match(key)
+        trie = (time.time() - start) / n
+        start = time.time()
+        for key in keys:
+            to_call = []
+            for pattern, callbacks in patterns:
+                if pattern.match(key):
+                    to_call += callbacks
+        regexes = (time.time() - start) / n
+        print '%14d %10.1fus %10.1fus' % (count, trie * 1e6, regexes * 1e6)
+
+def callback(chan, msg):
+    pass
+
+if __name__ == '__main__':
+    main(docopt.docopt(__doc__))
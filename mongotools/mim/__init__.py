@@ -1 +1 @@
-from .mim import Connection, match, MatchDoc, MatchList, BsonArith
+from .mim import Connection, match, compile_query, MatchDoc, MatchList, BsonArith
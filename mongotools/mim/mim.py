@@ -3,11 +3,22 @@ non-persistent and hopefully much, much faster
 '''
 import re
 import sys
+import os
+import math
 import time
+import calendar
+import mmap
+import heapq
+import struct
+import thread
+import functools
+import threading
+import bisect
 import itertools
 import collections
 import logging
-from datetime import datetime
+import operator
+from datetime import datetime, timedelta
 from hashlib import md5
 
 try:
@@ -20,24 +31,56 @@ from mongotools.util import LazyProperty
 
 import bson
 from pymongo.errors import InvalidOperation, OperationFailure, DuplicateKeyError
-from pymongo import database, collection, ASCENDING
+from pymongo.errors import BulkWriteError, CollectionInvalid
+from pymongo.cursor import _QUERY_OPTIONS
+from pymongo.message import _INSERT, _UPDATE, _DELETE
+from pymongo import database, collection, bulk, results, ASCENDING
 
 log = logging.getLogger(__name__)
 
 class Connection(object):
     _singleton = None
+    _singleton_lock = threading.Lock()
 
     @classmethod
     def get(cls):
         if cls._singleton is None:
-            cls._singleton = cls()
+            with cls._singleton_lock:
+                if cls._singleton is None:
+                    cls._singleton = cls()
         return cls._singleton
 
-    def __init__(self):
+    def __init__(self, copy_on_write=False, thread_safe=False, clock=None,
+                 oplog_size=None):
+        '''If copy_on_write is set, collections store documents as frozen
+        (immutable) structures and cursors return copy-on-write views of
+        them rather than BSON round-tripped copies.
+
+        If thread_safe is set, each collection is guarded by a
+        reader/writer lock and cursors iterate over a snapshot of their
+        results taken when they are first read.
+
+        clock is called for the current (naive UTC) time when TTL indexes
+        check for expired documents; it defaults to datetime.utcnow
+
+        If oplog_size is given, writes to every database but local are
+        recorded in local['oplog.rs'], a capped collection of that many
+        bytes, as a replica set primary records them, so that
+        pubsub.OplogTail can follow them.'''
         self._databases = {}
+        self._copy_on_write = copy_on_write
+        self._thread_safe = thread_safe
+        self._clock = clock or datetime.utcnow
+        self._lock = _new_mutex(thread_safe)
+        self._profile_level = 0
+        self._slow_ms = 100
+        self._oplog_size = oplog_size
+        self._last_ts = bson.Timestamp(0, 0)
 
     def drop_all(self):
-        self._databases = {}
+        databases, self._databases = self._databases, {}
+        for db in databases.values():
+            db._invalidate()
 
     def clear_all(self):
         '''Remove all data, but keep the indexes'''
@@ -63,14 +106,79 @@ class Connection(object):
         try:
             return self._databases[name]
         except KeyError:
-            db = self._databases[name] = Database(self, name)
+            with self._lock:
+                db = self._databases.get(name)
+                if db is None:
+                    db = self._databases[name] = Database(self, name)
             return db
 
     def database_names(self):
         return self._databases.keys()
 
     def drop_database(self, name):
-        del self._databases[name]
+        self._databases.pop(name)._invalidate()
+        if self._oplog_size is not None and name != 'local':
+            self._log('%s.$cmd' % name, [ ('c', {'dropDatabase': 1}, None) ])
+
+    def _log(self, ns, writes):
+        '''Append entries for writes, (op, o, o2) triples, to ns to the
+        oplog.  Timestamps are taken under the oplog's write lock, so its
+        ring stays in ts order.'''
+        oplog = self['local']['oplog.rs']
+        with oplog._lock.writing:
+            entries = []
+            for op, o, o2 in writes:
+                entry = dict(ts=self._timestamp(), v=2, op=op, ns=ns, o=o)
+                if o2 is not None:
+                    entry['o2'] = o2
+                entries.append(entry)
+            oplog._insert_docs(entries, ordered=True)
+
+    def _timestamp(self):
+        '''The next oplog timestamp: the clock's second, and a counter
+        within it, never going back'''
+        secs = calendar.timegm(self._clock().utctimetuple())
+        last = self._last_ts
+        if secs > last.time:
+            ts = bson.Timestamp(secs, 1)
+        else:
+            ts = bson.Timestamp(last.time, last.inc + 1)
+        self._last_ts = ts
+        return ts
+
+    def set_profiling_level(self, level, slow_ms=None):
+        '''Set the profiling level of every database, present and future.
+        Databases then record operations in their system.profile
+        collection (all of them at level 2, those taking at least slow_ms
+        at level 1) and count them for the top command.'''
+        if not isinstance(level, int) or level < 0 or level > 2:
+            raise ValueError("level must be one of (OFF, SLOW_ONLY, ALL)")
+        if slow_ms is not None and not isinstance(slow_ms, int):
+            raise TypeError("slow_ms must be an integer")
+        self._profile_level = level
+        if slow_ms is not None:
+            self._slow_ms = slow_ms
+        for db in self._databases.values():
+            db.command('profile', level, slowms=self._slow_ms)
+
+    def dump(self, filename):
+        '''Write every database, with its index definitions, to filename'''
+        _dump(self._databases.values(), filename)
+
+    def load(self, filename):
+        '''Replace all databases with those dumped to filename.  The file
+        is memory-mapped, and documents are decoded as they are first read.'''
+        databases = {}
+        for name, snapshots in _load(filename).iteritems():
+            db = databases[name] = Database(self, name)
+            db._restore(snapshots)
+        with self._lock:
+            self._databases = databases
+        if 'local' in databases and 'oplog.rs' in databases['local']._collections:
+            last = databases['local']['oplog.rs'].find_one(
+                {}, sort=[('$natural', -1)])
+            if last is not None and last['ts'] > self._last_ts:
+                self._last_ts = last['ts']
 
     def __repr__(self):
         return 'mim.Connection()'
@@ -81,6 +189,18 @@ class Database(database.Database):
         self._name = name
         self._connection = connection
         self._collections = {}
+        self._checkpoints = []
+        self._lock = _new_mutex(connection._thread_safe)
+        # Held by checkpoint(), rollback() and release() while they take
+        # collection locks, one at a time, so that they never wait on one
+        # while holding _lock
+        self._checkpoint_lock = _new_mutex(connection._thread_safe)
+        self._profile_level = connection._profile_level
+        self._slow_ms = connection._slow_ms
+        self._top = {}
+        # A lock of its own, as profiled operations update it while holding
+        # their collection's lock
+        self._top_lock = _new_mutex(connection._thread_safe)
         if Runtime is not None:
             self._jsruntime = Runtime()
         else:
@@ -109,28 +229,44 @@ class Database(database.Database):
             return dict(md5=checksum.hexdigest())
         elif 'findandmodify' in command:
             coll = self._collections[command['findandmodify']]
-            before = coll.find_one(command['query'], sort=command.get('sort'))
-            upsert = False
-            if before is None:
-                upsert = True
-                if command.get('upsert'):
-                    before = dict(command['query'])
-                    coll.insert(before)
-                else:
-                    raise OperationFailure, 'No matching object found'
-            coll.update(command['query'], command['update'])
-            if command.get('new', False) or upsert:
-                return dict(value=coll.find_one(dict(_id=before['_id'])))
-            return dict(value=before)
+            value = coll.find_and_modify(
+                command['query'], command['update'],
+                upsert=command.get('upsert', False),
+                sort=command.get('sort'),
+                new=command.get('new', False))
+            if value is None:
+                raise OperationFailure, 'No matching object found'
+            return dict(value=value)
         elif 'mapreduce' in command:
             collection = command.pop('mapreduce')
+            if callable(command.get('map')):
+                return self._handle_python_mapreduce(collection, **command)
             return self._handle_mapreduce(collection, **command)
+        elif 'aggregate' in command:
+            collection = self._collections[command['aggregate']]
+            return collection.aggregate(command['pipeline'])
         elif 'distinct' in command:
             collection = self._collections[command['distinct']]
             key = command['key']
             return list(set(_lookup(d, key) for d in collection.find()))
+        elif 'create' in command:
+            options = dict(command)
+            self.create_collection(options.pop('create'), **options)
+            return dict(ok=1.0)
         elif 'getlasterror' in command:
             return dict(connectionId=None, err=None, n=0, ok=1.0)
+        elif 'profile' in command:
+            result = dict(was=self._profile_level, slowms=self._slow_ms, ok=1.0)
+            if command['profile'] >= 0:
+                self._profile_level = command['profile']
+            if 'slowms' in command:
+                self._slow_ms = command['slowms']
+            return result
+        elif 'top' in command:
+            totals = {}
+            for db in self.connection._databases.values():
+                totals.update(db._top_totals())
+            return dict(totals=totals, ok=1.0)
         else:
             raise NotImplementedError, repr(command)
 
@@ -240,6 +376,69 @@ class Database(database.Database):
         return result
                 
 
+    def _handle_python_mapreduce(self, collection, map=None, reduce=None,
+                                 out=None, query=None, sort=None, limit=None,
+                                 finalize=None, pool=None, chunk_size=1000):
+        '''map/reduce with Python callables rather than javascript: map(doc)
+        returns (key, value) pairs, reduce(key, values) and finalize(key,
+        value) return a value.  As with MongoDB, reduce must accept its
+        own results among values.
+
+        Documents are mapped in chunks of chunk_size, each reduced on its
+        own before the chunks are reduced together.  If pool (e.g. a
+        multiprocessing.Pool) is given the chunks are mapped by its
+        workers, so map and reduce must then be picklable.'''
+        cursor = self[collection].find(query)
+        if sort:
+            cursor = cursor.sort(sort.items() if isinstance(sort, dict) else sort)
+        if limit:
+            cursor = cursor.limit(limit)
+        jobs = ((map, reduce, chunk) for chunk in _chunks(cursor, chunk_size))
+        if pool is None:
+            mapped = itertools.imap(_map_chunk, jobs)
+        else:
+            mapped = pool.imap_unordered(_map_chunk, jobs)
+        counts = dict(input=0, emit=0, reduce=0, output=0)
+        groups = {}
+        for n_input, n_emit, pairs in mapped:
+            counts['input'] += n_input
+            counts['emit'] += n_emit
+            for key, value in pairs:
+                bkey = BsonArith.to_bson(key)
+                group = groups.setdefault((bkey[0], _hashable(bkey[1])), (key, []))
+                group[1].append(value)
+        reduced = []
+        for key, values in groups.itervalues():
+            if len(values) > 1:
+                counts['reduce'] += 1
+                reduced.append((key, reduce(key, values)))
+            else:
+                reduced.append((key, values[0]))
+        def finalized(key, value):
+            if finalize is None: return value
+            return finalize(key, value)
+        counts['output'] = len(reduced)
+        result = dict(counts=counts, ok=1.0)
+        assert len(out) == 1
+        (kind, name), = out.items()
+        if kind == 'inline':
+            result['results'] = [
+                dict(_id=k, value=finalized(k, v)) for k, v in reduced ]
+            return result
+        if kind not in ('replace', 'merge', 'reduce'):
+            raise TypeError, 'Unsupported out type: %s' % out.keys()
+        result['result'] = name
+        if kind == 'replace':
+            self._collections.pop(name, None)
+        out_coll = self[name]
+        for k, v in reduced:
+            if kind == 'reduce':
+                doc = out_coll.find_one(dict(_id=k))
+                if doc is not None:
+                    v = reduce(k, [v, doc['value']])
+            out_coll.save(dict(_id=k, value=finalized(k, v)))
+        return result
+
     def __getattr__(self, name):
         return self[name]
 
@@ -250,8 +449,17 @@ class Database(database.Database):
         try:
             return self._collections[name]
         except KeyError:
-            db = self._collections[name] = Collection(self, name)
-            return db
+            with self._lock:
+                coll = self._collections.get(name)
+                if coll is None:
+                    options = None
+                    oplog_size = self.connection._oplog_size
+                    if (self.name, name) == _OPLOG and oplog_size is not None:
+                        options = dict(capped=True, size=oplog_size,
+                                       autoIndexId=False)
+                    coll = self._collections[name] = Collection(
+                        self, name, _options=options)
+            return coll
 
     def __repr__(self):
         return 'mim.Database(%s)' % self.name
@@ -259,26 +467,233 @@ class Database(database.Database):
     def collection_names(self):
         return self._collections.keys()
 
+    def create_collection(self, name, codec_options=None, read_preference=None,
+                          write_concern=None, read_concern=None, **kwargs):
+        '''As pymongo's create_collection.  capped=True with size (in bytes
+        of BSON) and optionally max (documents) makes a capped collection.'''
+        with self._lock:
+            if name in self._collections:
+                raise CollectionInvalid('collection %s already exists' % name)
+            coll = self._collections[name] = Collection(
+                self, name, _options=kwargs)
+        return coll
+
     def drop_collection(self, name):
-        del self._collections[name]
+        self._collections.pop(name)._drop()
+        connection = self.connection
+        if connection._oplog_size is not None and self.name != 'local':
+            connection._log('%s.$cmd' % self.name, [ ('c', {'drop': name}, None) ])
+
+    def _invalidate(self):
+        '''End the change streams on this database's collections, as it's
+        dropped'''
+        for coll in self._collections.values():
+            coll._drop()
+
+    def checkpoint(self):
+        '''Mark the current state of this database for rollback().  Until
+        the checkpoint is released, each write journals what it replaces,
+        so rolling back costs as much as the writes since, not the data.'''
+        with self._checkpoint_lock:
+            with self._lock:
+                collections = dict(self._collections)
+            positions = {}
+            for name, coll in collections.iteritems():
+                with coll._lock.writing:
+                    if coll._journal is None:
+                        coll._journal = []
+                    positions[name] = len(coll._journal)
+            checkpoint = Checkpoint(self, collections, positions)
+            self._checkpoints.append(checkpoint)
+            return checkpoint
+
+    def rollback(self, checkpoint):
+        '''Restore this database to its state at checkpoint, which stays
+        valid; checkpoints taken after it are released'''
+        with self._checkpoint_lock:
+            i = self._checkpoint_index(checkpoint)
+            for later in self._checkpoints[i + 1:]:
+                later.database = None
+            del self._checkpoints[i + 1:]
+            for name, coll in checkpoint.collections.iteritems():
+                with coll._lock.writing:
+                    coll._rollback(checkpoint.positions[name])
+            with self._lock:
+                self._collections = dict(checkpoint.collections)
+
+    def release(self, checkpoint):
+        '''Forget checkpoint.  Journalling stops once none are left.'''
+        with self._checkpoint_lock:
+            del self._checkpoints[self._checkpoint_index(checkpoint)]
+            checkpoint.database = None
+            if self._checkpoints: return
+            for coll in self._collections.values():
+                with coll._lock.writing:
+                    coll._journal = None
+
+    def _profile(self, entry, elapsed):
+        '''Count a profiled operation for top, and record it in
+        system.profile if it is slow enough'''
+        micros = int(elapsed * 1e6)
+        with self._top_lock:
+            counts = self._top.setdefault(entry['ns'], {}).setdefault(
+                _TOP_KEYS[entry['op']], [0, 0])
+            counts[0] += 1
+            counts[1] += micros
+        millis = elapsed * 1000
+        if self._profile_level < 2 and millis < self._slow_ms: return
+        entry['millis'] = millis
+        entry['ts'] = datetime.utcnow()
+        self['system.profile'].insert(entry)
+
+    def _top_totals(self):
+        totals = {}
+        with self._top_lock:
+            for ns, ops in self._top.iteritems():
+                total = [ sum(c[0] for c in ops.itervalues()),
+                          sum(c[1] for c in ops.itervalues()) ]
+                totals[ns] = dict(
+                    (key, dict(count=count, time=micros))
+                    for key, (count, micros) in ops.items() + [('total', total)])
+        return totals
+
+    def _checkpoint_index(self, checkpoint):
+        if checkpoint.database is not self:
+            raise InvalidOperation('checkpoint is not valid for %r' % self)
+        return self._checkpoints.index(checkpoint)
+
+    def dump(self, filename):
+        '''Write this database, with its index definitions, to filename'''
+        _dump([self], filename)
+
+    def load(self, filename):
+        '''Replace this database's collections with those dumped to
+        filename, from the database of the same name or the only one there'''
+        dumped = _load(filename)
+        if self.name in dumped:
+            snapshots = dumped[self.name]
+        elif len(dumped) == 1:
+            snapshots = dumped.values()[0]
+        else:
+            raise KeyError, '%s not in %s' % (self.name, filename)
+        self._restore(snapshots)
+
+    def _restore(self, snapshots):
+        collections = dict(
+            (name, Collection(self, name, _snapshot=snapshot))
+            for name, snapshot in snapshots.iteritems())
+        with self._lock:
+            self._collections = collections
 
     def clear(self):
         for coll in self._collections.values():
             coll.clear()
 
+def _reads(func):
+    '''Run a Collection method under the collection's read lock'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.reading:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+def _writes(func):
+    '''Run a Collection method under the collection's write lock'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.writing:
+            return func(self, *args, **kwargs)
+    return wrapper
+
 class Collection(collection.Collection):
 
-    def __init__(self, database, name):
+    def __init__(self, database, name, _snapshot=None, _options=None):
         self._name = self.__name = name
         self._database = database
-        self._data = {}
-        self._unique_indexes = {}
-        self._indexes = {}
+        if _snapshot is None:
+            self._data = {}
+            self._indexes = {}
+            self._options = _options or {}
+            self._capped = self._new_capped()
+        else:
+            self._snapshot = _snapshot
+            self._options = _snapshot.options
+            if not self._options.get('capped'):
+                self._capped = None
+        self._journal = None
+        self._ttl = _snapshot is not None and any(
+            info.get('expireAfterSeconds') is not None
+            for info in _snapshot.indexes)
+        connection = database.connection
+        if (connection._oplog_size is None or database.name == 'local'
+            or name.startswith('system.')):
+            self._oplog_ns = None
+        else:
+            self._oplog_ns = '%s.%s' % (database.name, name)
+        self._watchers = []
+        self._change_ids = itertools.count(1)
+        self._copy_on_write = connection._copy_on_write
+        self._thread_safe = connection._thread_safe
+        if self._thread_safe:
+            self._lock = _RWLock()
+        else:
+            self._lock = _NULL_RWLOCK
+
+    @LazyProperty
+    def _data(self):
+        '''Documents restored by load(), decoded as they are first read'''
+        return self._snapshot.documents(self._copy_on_write)
+
+    @LazyProperty
+    def _indexes(self):
+        '''Indexes restored by load() when first used, from the entries
+        dumped with them (or, for older dumps, by indexing the documents)'''
+        indexes = {}
+        for info in self._snapshot.indexes:
+            index = indexes[info['name']] = Index(
+                info['name'], info['fields'],
+                unique=info['unique'], sparse=info['sparse'],
+                directions=info.get('directions'),
+                expire_after=info.get('expireAfterSeconds'))
+            if info.get('entries') is None:
+                index.build(self._data.itervalues())
+            else:
+                index.restore(_decode_at(self._snapshot.buf, info['entries']))
+                index.multikey = info['multikey']
+        return indexes
+
+    @LazyProperty
+    def _capped(self):
+        '''The ring of a capped collection restored by load(), in the
+        natural order it was dumped in'''
+        capped = self._new_capped()
+        self._data # decoding the table keys the documents without _id
+        for key, nbytes in self._snapshot.natural:
+            capped.push(key, nbytes)
+        return capped
+
+    def _new_capped(self):
+        capped = _Capped.from_options(self._options)
+        if capped is not None and (self._database.name, self._name) == _OPLOG:
+            capped.index = _RingIndex(capped, 'ts')
+        return capped
 
+    @_writes
     def clear(self):
+        if self._capped is not None:
+            self._journal_capped()
+            self._capped.clear()
+        if self._journal is not None:
+            self._journal.append((_JOURNAL_RESET, self._data, self._indexes))
+            self._indexes = dict(
+                (name, Index(index.name, index.fields,
+                             unique=index.unique, sparse=index.sparse,
+                             directions=index.directions,
+                             expire_after=index.expire_after))
+                for name, index in self._indexes.iteritems())
         self._data = {}
-        for ui in self._unique_indexes.values():
-            ui.clear()
+        for index in self._indexes.values():
+            index.clear()
 
     @property
     def name(self):
@@ -291,67 +706,385 @@ class Collection(collection.Collection):
     def drop(self):
         self._database.drop_collection(self._name)
 
+    def options(self):
+        '''The options this collection was created with'''
+        return dict(self._options)
+
     def __getattr__(self, name):
         return self._database['%s.%s' % (self.name, name)]
 
-    def _find(self, spec, sort=None, **kwargs):
+    def _find(self, spec, sort=None, top=None, stats=None, hint=None, **kwargs):
+        '''Matching documents, in sort order if sort is given.  If top is
+        given, only the first top documents in that order are needed.  If
+        stats (a profile entry) is given, the plan used and keys and
+        documents scanned are recorded in it.'''
         bson_safe(spec)
-        def _gen():
-            for doc in self._data.itervalues():
-                mspec = match(spec, doc)
-                if mspec is not None: yield doc, mspec
-        return _gen()
+        predicate = compile_query(spec)
+        plan = self._plan(spec, sort, hint)
+        if plan.ids is None:
+            docs = self._natural(_natural_direction(sort))
+        else:
+            docs = (self._data.get(_id) for _id in plan.ids())
+        if stats is None:
+            def _gen():
+                for doc in docs:
+                    if doc is not None and predicate(doc): yield doc
+        else:
+            stats['planSummary'] = plan.summary()
+            stats['scanAndOrder'] = bool(sort and not plan.ordered)
+            def _gen():
+                for doc in docs:
+                    stats['nscanned'] += 1
+                    if doc is None: continue
+                    stats['nscannedObjects'] += 1
+                    if predicate(doc): yield doc
+        result = _gen()
+        if sort and not plan.ordered:
+            result = _sort_docs(result, sort, top)
+        return result
+
+    def _plan(self, spec, sort=None, hint=None):
+        '''Choose the index that narrows spec to the fewest candidates.  An
+        index that also yields candidates in sort order wins ties.  A hint
+        (an index name, or '$natural' for a collection scan) overrides the
+        choice, and a \$natural sort always scans the collection.'''
+        spec = _index_spec(spec)
+        if sort and sort[0][0] == '$natural':
+            return _Plan(ordered=True)
+        if hint is not None:
+            return self._hinted_plan(spec, sort, hint)
+        best = _Plan()
+        if '_id' in spec:
+            ids = _id_candidates(spec['_id'], self._data)
+            if ids is not None:
+                best = _Plan(None, len(ids), lambda ids=ids: ids)
+        ring = self._ring_index()
+        if ring is not None and '$or' not in spec:
+            plan = ring.plan(spec, self._data)
+            if plan is not None and (best.ids is None or plan[0] < best.count):
+                best = _Plan(ring, *plan)
+        if '$or' not in spec:
+            for index in self._indexes.itervalues():
+                plan = index.plan(spec)
+                if plan is None: continue
+                count, ids = plan
+                if best.ids is None or count < best.count:
+                    best = _Plan(index, count, ids)
+        if sort:
+            for index in self._indexes.itervalues():
+                plan = index.ordered(spec, sort)
+                if plan is None: continue
+                count, ids = plan
+                if best.ids is None or count <= best.count:
+                    best = _Plan(index, count, ids, ordered=True)
+        return best
+
+    @_reads
+    def _replay_start(self, spec):
+        '''The sequence number of the oplog entry before the first that
+        spec's ts bounds could match, or None to start from the oldest'''
+        ring = self._ring_index()
+        span = ring is not None and ring.span(spec, self._data)
+        if not span or span[0] == self._capped.head: return None
+        return self._capped.ring[span[0] - 1][0]
+
+    def _ring_index(self):
+        '''The oplog's ts index, if this is the oplog'''
+        if self._capped is None: return None
+        return self._capped.index
+
+    def _natural(self, direction=1):
+        '''Every document in natural order (or its reverse): insertion order
+        for a capped collection, otherwise the order _data keeps them in.
+        The documents are those there are now, so writes made while they
+        are read don't disturb the scan.'''
+        capped = self._capped
+        if capped is None:
+            docs = self._data.values()
+            if direction < 0:
+                docs.reverse()
+            return iter(docs)
+        keys = capped.keys()
+        if direction < 0:
+            keys.reverse()
+        return itertools.imap(self._data.get, keys)
+
+    def _hinted_plan(self, spec, sort, hint):
+        if hint == '$natural':
+            # an oplog's ring is in ts order, so narrowing by ts still
+            # scans in natural order (as oplog_replay does)
+            ring = self._ring_index()
+            plan = ring is not None and ring.plan(spec, self._data)
+            if plan: return _Plan(ring, *plan)
+            return _Plan()
+        index = self._indexes.get(hint)
+        if index is None:
+            raise OperationFailure('database error: bad hint: %s' % hint)
+        plan = sort and index.ordered(spec, sort)
+        if plan:
+            return _Plan(index, *plan, ordered=True)
+        return _Plan(index, *(index.plan(spec) or index.scan()))
 
     def find(self, spec=None, fields=None, as_class=dict, **kwargs):
         if spec is None:
             spec = {}
         sort = kwargs.pop('sort', None)
-        cur = Cursor(collection=self, fields=fields, as_class=as_class,
-                     _iterator_gen=lambda: self._find(spec, **kwargs))
+        skip = kwargs.pop('skip', None)
+        limit = kwargs.pop('limit', None)
+        flags = kwargs.pop('cursor_type', 0)
+        for option, flag in _FIND_FLAGS:
+            if kwargs.pop(option, False):
+                flags |= flag
+        cur = Cursor(collection=self, fields=fields, as_class=as_class, spec=spec,
+                     _iterator_gen=lambda **kw: self._find(spec, **dict(kwargs, **kw)))
+        cur._query_flags = flags
         if sort:
             cur = cur.sort(sort)
+        if skip:
+            cur = cur.skip(skip)
+        if limit:
+            cur = cur.limit(limit)
         return cur
 
     def find_one(self, spec_or_id=None, *args, **kwargs):
         if spec_or_id is not None and not isinstance(spec_or_id, dict):
             spec_or_id = {"_id": spec_or_id}
-        for result in self.find(spec_or_id, *args, **kwargs):
-            return result
-        return None
+        if not args and not kwargs.get('skip') and _FIND_ONE_KWARGS.issuperset(kwargs):
+            self._expire()
+            with self._lock.reading:
+                profile = self._profiler('query', query=spec_or_id, ntoreturn=-1)
+                docs = self._lookup_ids(spec_or_id)
+                if docs is not None:
+                    if profile is not None:
+                        profile.finish(planSummary='IDHACK', nscanned=len(docs),
+                                       nreturned=min(len(docs), 1))
+                    for doc in docs:
+                        return _copy_out(
+                            doc, _normalize_fields(kwargs.get('fields')),
+                            kwargs.get('as_class', dict))
+                    return None
+        cursor = self.find(spec_or_id, *args, **kwargs)
+        try:
+            for result in cursor:
+                return result
+            return None
+        finally:
+            cursor.close()
+
+    def _lookup_ids(self, spec):
+        '''The documents matching spec if it only selects by _id (a value or
+        an \$in list), found by hash lookup; otherwise None'''
+        if not spec or len(spec) != 1 or '_id' not in spec: return None
+        ids = _id_candidates(spec['_id'], self._data)
+        if ids is None: return None
+        predicate = compile_query(spec)
+        return [ doc for doc in map(self._data.get, ids) if predicate(doc) ]
 
-    def find_and_modify(self, query=None, update=None, upsert=False, **kwargs):
+    @_reads
+    def _count(self, spec, stats=None):
+        '''Number of documents matching spec, answered from the collection
+        size or an index where possible'''
+        if stats is None: stats = {}
+        if not spec:
+            stats['planSummary'] = 'COUNT'
+            return len(self._data)
+        docs = self._lookup_ids(spec)
+        if docs is not None:
+            stats['planSummary'] = 'IDHACK'
+            return len(docs)
+        for index in self._indexes.itervalues():
+            count = index.count(spec)
+            if count is not None:
+                stats['planSummary'] = 'COUNT_SCAN %s' % index.summary()
+                return count
+        return sum(1 for doc in self._find(spec, stats=stats or None))
+
+    def _profiler(self, op, **fields):
+        '''A _Profile for an operation on this collection, or None if its
+        database isn't profiling'''
+        if not self._database._profile_level: return None
+        if self._name.startswith('system.'): return None
+        return _Profile(self, op, **fields)
+
+    @_writes
+    def find_and_modify(self, query=None, update=None, upsert=False,
+                        sort=None, new=False, remove=False, fields=None,
+                        **kwargs):
         if query is None: query = {}
-        before = self.find_one(query, sort=kwargs.get('sort'))
-        upserted = False
-        if before is None:
-            upserted = True
-            if upsert:
-                before = dict(query)
-                self.insert(before)
-            else:
-                return None
-        before = self.find_one(query, sort=kwargs.get('sort'))
-        self.update({'_id': before['_id']}, update)
-        if kwargs.get('new', False) or upserted:
-            return self.find_one(dict(_id=before['_id']))
-        return before
+        if isinstance(sort, dict): sort = sort.items()
+        self._expire()
+        for before in self._find(query, sort=sort, top=1):
+            break
+        else:
+            if not upsert: return None
+            _id = self.insert(dict(query))
+            self.update({'_id': _id}, update)
+            return self.find_one({'_id': _id}, fields=fields)
+        _id = before.get('_id', ())
+        result = _copy_out(before, _normalize_fields(fields), dict)
+        if remove:
+            self.remove({'_id': _id})
+            return result
+        self.update({'_id': _id}, update)
+        if new:
+            return self.find_one({'_id': _id}, fields=fields)
+        return result
 
+    @_writes
     def insert(self, doc_or_docs, safe=False, manipulate=True):
         if not isinstance(doc_or_docs, list):
             doc_or_docs = [ doc_or_docs ]
-        for doc in doc_or_docs:
-            doc = bcopy(doc)
-            bson_safe(doc)
+        if manipulate:
+            doc_or_docs = [
+                doc if '_id' in doc else dict(doc, _id=bson.ObjectId())
+                for doc in doc_or_docs ]
+        self._expire()
+        profile = self._profiler('insert')
+        errors = self._insert_docs(
+            doc_or_docs, ordered=True, skip_duplicate_ids=not safe)
+        if profile is not None:
+            profile.finish(ninserted=len(doc_or_docs) - len(errors))
+        if errors:
+            raise DuplicateKeyError(errors[0][2], errors[0][1])
+        return doc_or_docs[-1].get('_id', ())
+
+    def _insert_docs(self, docs, ordered, skip_duplicate_ids=False):
+        '''Insert docs, checking each against the _ids and unique indexes
+        but adding them to the indexes together at the end.  Returns a list
+        of (position in docs, error code, message) for those rejected; if
+        ordered, none are attempted after the first rejection.'''
+        indexes = self._indexes.values()
+        unique = [ j for j, index in enumerate(indexes) if index.unique ]
+        batch_keys = [ set() for index in indexes ]
+        entries = [ [] for index in indexes ]
+        accepted = {}
+        errors = []
+        capped = self._capped
+        keep_order = capped is not None or self._logs()
+        order = []
+        for i, doc in enumerate(docs):
+            doc = self._copy_in(doc)
             _id = doc.get('_id', ())
-            if _id == () and manipulate:
-                _id = doc['_id'] = bson.ObjectId()
-            if _id in self._data:
-                if safe: raise DuplicateKeyError('duplicate ID on insert')
+            if _id is () and capped is not None:
+                # capped collections (made with autoIndexId=False) needn't
+                # have an _id for each document
+                _id = _Unkeyed()
+            elif _id in self._data or _id in accepted:
+                if skip_duplicate_ids: continue
+                errors.append((i, 11000, 'E11000 duplicate key error '
+                               'index: %s.$_id_ dup key: { : %r }'
+                               % (self._name, _id)))
+                if ordered: break
                 continue
-            self._index(doc)
-            self._data[_id] = bcopy(doc)
-        return _id
+            if '_id' in doc:
+                keys = [ index._keys(doc) for index in indexes ]
+                for j in unique:
+                    if indexes[j].taken(keys[j], batch_keys[j]): break
+                else:
+                    j = None
+                if j is not None:
+                    errors.append((i, 11000, 'E11000 duplicate key error '
+                                   'index: %r: %s' % (self, indexes[j].fields)))
+                    if ordered: break
+                    continue
+                for j in unique:
+                    batch_keys[j].update(hkey for hkey, skey in keys[j])
+                for j, index_keys in enumerate(keys):
+                    entries[j].append((_id, index_keys))
+            accepted[_id] = doc
+            if keep_order:
+                order.append(_id)
+        for index, index_entries in zip(indexes, entries):
+            index.add_many(index_entries)
+        if self._journal is not None:
+            for _id in accepted:
+                self._journal_doc(_id)
+        self._data.update(accepted)
+        if order and capped is not None:
+            self._cap(order)
+        if order and self._logs():
+            self._log([ ('i', accepted[key], None) for key in order ])
+        return errors
+
+    def _logs(self):
+        '''Whether writes go to the oplog or to watchers'''
+        return self._oplog_ns is not None or bool(self._watchers)
+
+    def _log(self, writes):
+        '''Record writes, (op, o, o2) triples as in the oplog, in the oplog
+        and pass them to the watchers'''
+        if self._oplog_ns is not None:
+            self._database.connection._log(self._oplog_ns, writes)
+        if self._watchers:
+            self._notify(writes)
+
+    def _notify(self, writes):
+        '''Push a change event for each write to the watchers whose specs
+        it matches.  Each event is built and frozen once, and shared.'''
+        ns = dict(db=self._database.name, coll=self._name)
+        watchers = self._watchers
+        for op, o, o2 in writes:
+            event = dict(
+                _id=dict(_data=self._change_ids.next()),
+                operationType=_OPERATION_TYPES[op], ns=ns,
+                documentKey=_id_spec(o) if o2 is None else o2)
+            if op != 'd':
+                event['fullDocument'] = o
+            event = freeze(event)
+            for watcher in watchers:
+                watcher._push(event)
 
+    @_writes
+    def watch(self, spec=None, max_queue=1000, max_await_time_ms=None):
+        '''A ChangeStream of the events for writes to this collection (that
+        match spec, if given), pushed to it as they are made'''
+        stream = ChangeStream(self, spec, max_queue, max_await_time_ms)
+        self._watchers = self._watchers + [ stream ]
+        return stream
+
+    @_writes
+    def _unwatch(self, stream):
+        self._watchers = [ w for w in self._watchers if w is not stream ]
+
+    def _drop(self):
+        '''End the change streams on this collection, as it's dropped'''
+        if self._watchers:
+            with self._lock.writing:
+                self._invalidate()
+
+    def _invalidate(self):
+        '''Tell the watchers this collection was dropped, and end them'''
+        ns = dict(db=self._database.name, coll=self._name)
+        for watcher in self._watchers:
+            watcher._push(freeze(dict(
+                        _id=dict(_data=self._change_ids.next()),
+                        operationType='drop', ns=ns)))
+            watcher._push(_INVALIDATE, match=False)
+        self._watchers = []
+
+    def _cap(self, keys):
+        '''Append the documents just stored under keys to a capped
+        collection's ring, evict the oldest beyond its limits and wake
+        the tailable cursors waiting for more'''
+        capped = self._capped
+        self._journal_capped()
+        for key in keys:
+            capped.push(key, len(bson.BSON.encode(self._data[key])))
+        for key in capped.evict():
+            self._journal_doc(key)
+            self._deindex(self._data.pop(key))
+        if self._journal is None:
+            capped.compact()
+        with capped.tailing:
+            capped.tailing.notify_all()
+
+    def _copy_in(self, doc):
+        '''A private copy of doc, in the form this collection stores'''
+        if self._copy_on_write:
+            return freeze(doc)
+        return bcopy(doc)
+
+    @_writes
     def save(self, doc, safe=False):
         _id = doc.get('_id', ())
         if _id == ():
@@ -360,7 +1093,20 @@ class Collection(collection.Collection):
             self.update({'_id':_id}, doc, upsert=True, safe=safe)
             return _id
 
+    @_writes
     def update(self, spec, updates, upsert=False, safe=False, multi=False, **kwargs):
+        self._expire()
+        profile = self._profiler(
+            'update', query=spec, updateobj=updates, upsert=bool(upsert))
+        if profile is None:
+            return self._update(spec, updates, upsert, multi, None, **kwargs)
+        result = self._update(spec, updates, upsert, multi, profile.entry, **kwargs)
+        # mim doesn't tell no-op updates apart
+        profile.finish(nMatched=result['n'], nModified=result['n'],
+                       upserted='upserted' in result)
+        return result
+
+    def _update(self, spec, updates, upsert, multi, stats, **kwargs):
         bson_safe(spec)
         bson_safe(updates)
         result = dict(
@@ -369,12 +1115,32 @@ class Collection(collection.Collection):
             err=None,
             ok=1.0,
             n=0)
-        for doc, mspec in self._find(spec):
-            self._deindex(doc) 
-            mspec.update(updates)
-            self._index(doc) 
+        positional = _is_positional(updates)
+        logged = [] if self._logs() else None
+        for doc in self._find(spec, stats=stats):
+            key = self._key(doc)
+            self._journal_doc(key)
+            self._deindex(doc)
+            if self._copy_on_write:
+                doc = CowDict(doc)
+            mspec = match(spec, doc) if positional else None
+            if not isinstance(mspec, MatchDoc):
+                mspec = MatchDoc(doc)
+            if self._copy_on_write:
+                # freeze() copies the result, so arguments needn't be
+                mspec._copy = _identity
+                mspec.update(updates)
+                doc = self._data[key] = freeze(doc)
+            else:
+                mspec.update(updates)
+            self._index(doc)
+            if logged is not None:
+                # logged as replacements, which any update can be
+                logged.append(('u', doc, _id_spec(doc)))
             result['n'] += 1
             if not multi: break
+        if logged:
+            self._log(logged)
         if result['n']:
             result['updatedExisting'] = True
             return result
@@ -384,48 +1150,196 @@ class Collection(collection.Collection):
             _id = doc.get('_id', ())
             if _id == ():
                 _id = doc['_id'] = bson.ObjectId()
-            self._index(doc) 
-            self._data[_id] = bcopy(doc)
+            doc = self._copy_in(doc)
+            self._index(doc)
+            self._journal_doc(_id)
+            self._data[_id] = doc
+            if self._capped is not None:
+                self._cap([_id])
+            if self._logs():
+                self._log([ ('i', doc, None) ])
             result['upserted'] = _id
             return result
         else:
             return result
 
-    def remove(self, spec=None, **kwargs):
-        if spec is None: spec = {}
-        new_data = {}
-        for id, doc in self._data.iteritems():
-            if match(spec, doc):
-                self._deindex(doc)
-            else:
-                new_data[id] = doc
-        self._data = new_data
+    @_writes
+    def remove(self, spec_or_id=None, safe=False, multi=True, **kwargs):
+        if spec_or_id is None:
+            spec_or_id = {}
+        elif not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        if self._capped is not None:
+            raise OperationFailure(
+                'cannot remove from a capped collection: %s' % self._name)
+        self._expire()
+        profile = self._profiler('remove', query=spec_or_id)
+        if profile is None:
+            return self._remove(spec_or_id, multi, None)
+        result = self._remove(spec_or_id, multi, profile.entry)
+        profile.finish(ndeleted=result['n'])
+        return result
+
+    def _remove(self, spec_or_id, multi, stats):
+        result = dict(connectionId=None, err=None, ok=1.0, n=0)
+        if not spec_or_id and multi:
+            result['n'] = len(self._data)
+            if stats is not None:
+                stats['planSummary'] = 'COUNT'
+            if self._logs():
+                self._log([ ('d', {'_id': _id}, None) for _id in self._data ])
+            self.clear()
+            return result
+        logged = [] if self._logs() else None
+        for doc in list(self._find(spec_or_id, stats=stats)):
+            _id = doc.get('_id', ())
+            self._journal_doc(_id)
+            self._deindex(doc)
+            del self._data[_id]
+            if logged is not None:
+                logged.append(('d', {'_id': _id}, None))
+            result['n'] += 1
+            if not multi: break
+        if logged:
+            self._log(logged)
+        return result
 
+    @_writes
     def ensure_index(self, key_or_list, unique=False, ttl=300,
-                     name=None, background=None, sparse=False):
+                     name=None, background=None, sparse=False,
+                     expireAfterSeconds=None, **kwargs):
+        '''As pymongo's ensure_index.  (ttl is how long pymongo would cache
+        the index's existence; expireAfterSeconds makes a TTL index.)'''
         if isinstance(key_or_list, list):
             keys = tuple(k[0] for k in key_or_list)
+            directions = tuple(k[1] for k in key_or_list)
         else:
             keys = (key_or_list,)
-        index_name = '_'.join(keys)
-        self._indexes[index_name] =[ (k, 0) for k in keys ]
-        if not unique: return
-        self._unique_indexes[keys] = index = {}
-        for id, doc in self._data.iteritems():
-            key_values = tuple(doc.get(key, None) for key in keys)
-            index[key_values] =id
+            directions = (ASCENDING,)
+        index_name = name or _index_name(zip(keys, directions))
+        for index in self._indexes.itervalues():
+            if index.name == index_name:
+                if (index.fields, index.directions) != (keys, directions):
+                    raise OperationFailure(
+                        'Index with name: %s already exists with a different '
+                        'key spec' % index_name, 86)
+                if (index.unique != bool(unique)
+                    or index.sparse != bool(sparse)
+                    or index.expire_after != expireAfterSeconds):
+                    raise OperationFailure(
+                        'Index with name: %s already exists with different '
+                        'options' % index_name, 85)
+                return index_name
+            if (index.fields, index.directions) == (keys, directions):
+                raise OperationFailure(
+                    'Index with pattern: %s already exists with a different '
+                    'name: %s' % (index.summary(), index.name), 85)
+        if expireAfterSeconds is not None and len(keys) != 1:
+            raise OperationFailure('TTL indexes are single-field indexes, '
+                                   'compound indexes do not support TTL')
+        if expireAfterSeconds is not None and self._capped is not None:
+            raise OperationFailure('Cannot create TTL index on a capped '
+                                   'collection: %s' % self._name)
+        index = Index(index_name, keys, unique=unique, sparse=sparse,
+                      directions=directions, expire_after=expireAfterSeconds)
+        if not index.build(self._data.itervalues()):
+            raise DuplicateKeyError(
+                'E11000 duplicate key error index: %r: %s'
+                % (self, index.fields), 11000)
+        self._journal_indexes()
+        self._indexes[index_name] = index
+        self._ttl = self._ttl or expireAfterSeconds is not None
         return index_name
 
+    @_reads
     def index_information(self):
-        return dict(
-            (index_name, dict(key=fields))
-            for index_name, fields in self._indexes.iteritems())
+        result = {}
+        for index_name, index in self._indexes.iteritems():
+            info = result[index_name] = dict(key=index.key)
+            if index.unique: info['unique'] = True
+            if index.expire_after is not None:
+                info['expireAfterSeconds'] = index.expire_after
+        return result
 
+    @_writes
     def drop_index(self, iname):
-        index = self._indexes.pop(iname, None)
-        if index is None: return
-        keys = tuple(i[0] for i in index)
-        self._unique_indexes.pop(keys, None)
+        if not isinstance(iname, basestring):
+            iname = _index_name(iname)
+        if iname not in self._indexes: return
+        self._journal_indexes()
+        del self._indexes[iname]
+        self._update_ttl()
+
+    def _update_ttl(self):
+        self._ttl = any(index.expire_after is not None
+                        for index in self._indexes.itervalues())
+
+    def _expire(self):
+        '''Remove the documents that TTL indexes say have expired.  Called
+        as reads and writes start, so expiry needs no background thread.'''
+        if not self._ttl: return
+        now = self._database.connection._clock()
+        ttl = [ index for index in self._indexes.values()
+                if index.expire_after is not None ]
+        if not any(index.due(now) for index in ttl): return
+        with self._lock.writing:
+            expired = set()
+            for index in ttl:
+                expired.update(index.expired(now))
+            expired = [ _id for _id in expired if _id in self._data ]
+            if expired:
+                self._remove({'_id': {'$in': expired}}, True, None)
+
+    def _journal_doc(self, _id):
+        '''Record the document stored under _id before it is replaced,
+        changed or removed'''
+        if self._journal is None: return
+        old = self._data.get(_id, _MISSING)
+        if old is not _MISSING and not self._copy_on_write:
+            # updates change documents in place
+            old = bcopy(old)
+        self._journal.append((_JOURNAL_DOC, _id, old))
+
+    def _journal_capped(self):
+        '''Record the state of a capped collection's ring before it moves'''
+        if self._journal is None: return
+        self._journal.append((_JOURNAL_CAPPED, self._capped.position(), None))
+
+    def _key(self, doc):
+        '''The key doc is stored under in _data: its _id, or for a capped
+        collection document without one, the key it was given'''
+        _id = doc.get('_id', ())
+        if _id is () and self._capped is not None:
+            for key in self._capped.keys():
+                if self._data.get(key) is doc: return key
+        return _id
+
+    def _journal_indexes(self):
+        '''Record the index set before it changes'''
+        if self._journal is None: return
+        self._journal.append((_JOURNAL_INDEXES, self._indexes, None))
+        self._indexes = dict(self._indexes)
+
+    @_writes
+    def _rollback(self, position):
+        '''Undo journalled writes back to position'''
+        journal = self._journal
+        while len(journal) > position:
+            kind, value, old = journal.pop()
+            if kind is _JOURNAL_DOC:
+                current = self._data.pop(value, None)
+                if current is not None:
+                    self._deindex(current)
+                if old is not _MISSING:
+                    self._index(old)
+                    self._data[value] = old
+            elif kind is _JOURNAL_RESET:
+                self._data, self._indexes = value, old
+            elif kind is _JOURNAL_CAPPED:
+                self._capped.restore(value)
+            else:
+                self._indexes = value
+        self._update_ttl()
 
     def _get_wc_override(self):
         '''For gridfs compatibility'''
@@ -436,18 +1350,19 @@ class Collection(collection.Collection):
 
     def _index(self, doc):
         if '_id' not in doc: return
-        for keys, index in self._unique_indexes.iteritems():
-            key_values = tuple(doc.get(key, None) for key in keys)
-            old_id = index.get(key_values, ())
-            if old_id == doc['_id']: continue
-            if old_id in self._data:
-                raise DuplicateKeyError, '%r: %s' % (self, keys)
-            index[key_values] = doc['_id']
+        indexes = self._indexes.values()
+        for index in indexes:
+            if not index.check(doc):
+                raise DuplicateKeyError(
+                    'E11000 duplicate key error index: %r: %s'
+                    % (self, index.fields), 11000)
+        for index in indexes:
+            index.add(doc)
 
     def _deindex(self, doc):
-        for keys, index in self._unique_indexes.iteritems():
-            key_values = tuple(doc.get(key, None) for key in keys)
-            index.pop(key_values, None)
+        if '_id' not in doc: return
+        for index in self._indexes.itervalues():
+            index.remove(doc['_id'])
 
     def map_reduce(self, map, reduce, out, full_response=False, **kwargs):
         if isinstance(out, basestring):
@@ -465,40 +1380,1076 @@ class Collection(collection.Collection):
                                       'key': key,
                                       })
 
+    def initialize_ordered_bulk_op(self):
+        return BulkOperationBuilder(self, ordered=True)
+
+    def initialize_unordered_bulk_op(self):
+        return BulkOperationBuilder(self, ordered=False)
+
+    def bulk_write(self, requests, ordered=True):
+        if not isinstance(requests, list):
+            raise TypeError("requests must be a list")
+        blk = _Bulk(self, ordered)
+        for request in requests:
+            request._add_to_bulk(blk)
+        return results.BulkWriteResult(blk.execute(), True)
+
+    def insert_many(self, documents, ordered=True):
+        if not isinstance(documents, list) or not documents:
+            raise TypeError("documents must be a non-empty list")
+        blk = _Bulk(self, ordered)
+        for doc in documents:
+            blk.add_insert(doc)
+        blk.execute()
+        return results.InsertManyResult(
+            [ doc['_id'] for doc in documents ], True)
+
+    @_writes
+    def _bulk_run(self, run, ordered):
+        '''Apply one run of a bulk write, returning the bulk API result
+        for it, with operation indexes local to the run'''
+        self._expire()
+        result = dict(n=0, writeErrors=[], upserted=[])
+        if run.op_type == _INSERT:
+            errors = self._insert_docs(run.ops, ordered)
+            result['n'] = len(run.ops) - len(errors)
+            if ordered and errors:
+                result['n'] = errors[0][0]
+            result['writeErrors'] = [
+                dict(index=i, code=code, errmsg=errmsg)
+                for i, code, errmsg in errors ]
+            return result
+        for i, op in enumerate(run.ops):
+            try:
+                if run.op_type == _UPDATE:
+                    r = self.update(op['q'], op['u'],
+                                    upsert=op['upsert'], multi=op['multi'])
+                    if 'upserted' in r:
+                        result['upserted'].append(dict(index=i, _id=r['upserted']))
+                        result['n'] += 1
+                else:
+                    r = self.remove(op['q'], multi=not op['limit'])
+                result['n'] += r['n']
+            except OperationFailure, e:
+                result['writeErrors'].append(dict(
+                        index=i, code=e.code or 2, errmsg=str(e)))
+                if ordered: break
+        return result
+
+    def aggregate(self, pipeline, **kwargs):
+        '''Run an aggregation pipeline.  As with pymongo, passing cursor
+        returns a cursor over the results rather than a command response.'''
+        if not isinstance(pipeline, (dict, list, tuple)):
+            raise TypeError("pipeline must be a dict, list or tuple")
+        if isinstance(pipeline, dict):
+            pipeline = [ pipeline ]
+        stages = _compile_pipeline(pipeline)
+        cursor = Cursor(collection=self,
+                        _iterator_gen=lambda **kw: self._aggregate(stages))
+        if 'cursor' in kwargs:
+            return cursor
+        return dict(result=list(cursor), ok=1.0)
+
+    def _aggregate(self, stages):
+        '''Chain the stages into a generator pipeline.  A leading \$match
+        and \$sort are left to _find(), so they can use indexes.'''
+        spec, sort = {}, None
+        if stages and stages[0][0] == '$match':
+            spec = stages[0][1]
+            stages = stages[1:]
+        if stages and stages[0][0] == '$sort':
+            sort = stages[0][1]
+            stages = stages[1:]
+        docs = self._find(spec, sort=sort, top=_pipeline_top(stages))
+        for i, (name, arg) in enumerate(stages):
+            if name == '$sort':
+                docs = _sort_docs(docs, arg, _pipeline_top(stages[i+1:]))
+            else:
+                docs = _PIPELINE_STAGES[name](docs, arg)
+        return docs
+
+
+class Index(object):
+    '''A secondary index over one or more (possibly dotted) fields.
+
+    Entries are kept twice: a hash from the full key to the set of matching
+    _ids, used for equality lookups and unique checks, and a list of
+    (key, _id) pairs in index order, used for range scans, sorts, and
+    equality on a prefix of a compound key.  Keys are tuples of BSON values
+    (BsonArith.to_bson), wrapped in _Descending for descending fields, so
+    they compare natively.  Missing fields hash and sort like null, as
+    sort() orders them, so bounds at null must take in both.
+
+    A document whose indexed paths reach into arrays has a key for each
+    element (for each combination, in a compound index), and makes the index
+    multikey: its scans may then find a document more than once.
+    '''
+
+    def __init__(self, name, fields, unique=False, sparse=False, directions=None,
+                 expire_after=None):
+        self.name = name
+        self.fields = tuple(fields)
+        if directions is None:
+            directions = [ ASCENDING ] * len(self.fields)
+        self.directions = tuple(directions)
+        self._descending = [
+            i for i, direction in enumerate(self.directions) if direction < 0 ]
+        self._paths = [ field.split('.') for field in self.fields ]
+        self._missing_hash = (_NULL_KEY,) * len(self.fields)
+        self.unique = bool(unique)
+        self.sparse = bool(sparse)
+        self.expire_after = expire_after
+        self.multikey = False
+        self.clear()
+
+    @property
+    def key(self):
+        return zip(self.fields, self.directions)
+
+    def clear(self):
+        self._hash = {}
+        self._sorted = []
+        self._entries = {}
+        # For TTL indexes, a heap of (expiry time, _id), holding stale
+        # entries until they surface, and each _id's current expiry time
+        self._expiry = []
+        self._expires = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<Index %s%s>' % (self.name, ' unique' if self.unique else '')
+
+    def summary(self):
+        return '{ %s }' % ', '.join('%s: %s' % key for key in self.key)
+
+    def _keys(self, doc):
+        '''The distinct (hash key, sort key) pairs doc is indexed under'''
+        values = [ self._values(doc, path) for path in self._paths ]
+        if max(map(len, values)) == 1:
+            return [ self._key([ v[0] for v in values ]) ]
+        keys, seen = [], set()
+        for combination in itertools.product(*values):
+            hkey, skey = key = self._key(list(combination))
+            if hkey in seen: continue
+            seen.add(hkey)
+            keys.append(key)
+        return keys
+
+    def _key(self, values):
+        hkey, skey = [], []
+        for value in values:
+            if value is ():
+                hkey.append(_NULL_KEY)
+                skey.append(_MISSING_BVALUE)
+            else:
+                bvalue = BsonArith.to_bson(value)
+                hkey.append((bvalue[0], _hashable(bvalue[1])))
+                skey.append(bvalue)
+        if self._descending:
+            return tuple(hkey), self._sort_key(skey)
+        return tuple(hkey), tuple(skey)
+
+    def _sort_key(self, components):
+        for i in self._descending:
+            components[i] = _Descending(components[i])
+        return tuple(components)
+
+    def _absent(self, skey):
+        '''Whether skey is for a document with none of the indexed fields'''
+        for component in skey:
+            if isinstance(component, _Descending):
+                component = component.value
+            if component is not _MISSING_BVALUE: return False
+        return True
+
+    def _component(self, position, bvalue):
+        if self.directions[position] < 0:
+            return _Descending(bvalue)
+        return bvalue
+
+    def _values(self, doc, path):
+        '''The values at path in doc that a query tests, as _path_getter
+        finds them: each array on the way is searched, and an array at the
+        end stands for itself and each of its elements'''
+        value = doc
+        for part in path:
+            if isinstance(value, dict):
+                value = value.get(part, ())
+            elif isinstance(value, list):
+                break
+            else:
+                value = ()
+        else:
+            if not isinstance(value, list): return [ value ]
+        values = [ doc ]
+        for part in path:
+            found = []
+            for value in values:
+                if isinstance(value, dict):
+                    found.append(value.get(part, ()))
+                elif isinstance(value, list):
+                    self.multikey = True
+                    if part.isdigit() and int(part) < len(value):
+                        found.append(value[int(part)])
+                    found.extend(element.get(part, ()) for element in value
+                                 if isinstance(element, dict))
+                else:
+                    found.append(())
+            values = found
+        result = []
+        for value in values:
+            if isinstance(value, list):
+                self.multikey = True
+                result.extend(value)
+            result.append(value)
+        return result or [ () ]
+
+    def check(self, doc):
+        '''False if adding doc would violate a unique constraint'''
+        if not self.unique: return True
+        _id = doc['_id']
+        for hkey, skey in self._keys(doc):
+            if self.sparse and self._absent(skey): continue
+            ids = self._hash.get(hkey, ())
+            if ids and ids != set([_id]): return False
+        return True
+
+    def taken(self, keys, batch=()):
+        '''Whether a unique constraint rules out a new document with keys
+        (from _keys), given the index and the hash keys in batch'''
+        for hkey, skey in keys:
+            if self.sparse and self._absent(skey): continue
+            if hkey in self._hash or hkey in batch: return True
+        return False
+
+    def add(self, doc):
+        _id = doc['_id']
+        if _id in self._entries:
+            self.remove(_id)
+        keys = self._entries[_id] = self._keys(doc)
+        for hkey, skey in keys:
+            self._hash.setdefault(hkey, set()).add(_id)
+            bisect.insort(self._sorted, (skey, _id))
+        if self.expire_after is not None:
+            self._schedule(_id, keys)
+
+    def build(self, docs):
+        '''Index docs from scratch, sorting once rather than inserting each
+        entry in turn.  Returns False if that violates a unique constraint.'''
+        self.clear()
+        entries, hash = self._entries, self._hash
+        for doc in docs:
+            if '_id' not in doc: continue
+            _id = doc['_id']
+            keys = entries[_id] = self._keys(doc)
+            for hkey, skey in keys:
+                hash.setdefault(hkey, set()).add(_id)
+            if self.expire_after is not None:
+                self._schedule(_id, keys)
+        self._sorted = sorted(
+            (skey, _id) for _id, keys in entries.iteritems()
+            for hkey, skey in keys)
+        if not self.unique: return True
+        for hkey, ids in hash.iteritems():
+            if len(ids) < 2: continue
+            if self.sparse and hkey == self._missing_hash:
+                # Only explicit nulls count
+                present = [ _id for _id in ids
+                            if not self._absent(dict(entries[_id])[hkey]) ]
+                if len(present) < 2: continue
+            return False
+        return True
+
+    def dump(self):
+        '''The entries in index order, as a BSON-able document restore()
+        takes: each entry's _id and the values it was indexed under, with
+        the positions of missing values listed apart'''
+        ids, values, missing = [], [], []
+        for skey, _id in self._sorted:
+            row = []
+            for j, component in enumerate(skey):
+                if isinstance(component, _Descending):
+                    component = component.value
+                if component is _MISSING_BVALUE:
+                    missing.append([ len(ids), j ])
+                    row.append(None)
+                else:
+                    row.append(component[1])
+            ids.append(_id)
+            values.append(row)
+        return dict(ids=ids, values=values, missing=missing)
+
+    def restore(self, dumped):
+        '''Index the entries dump() returned, without the documents'''
+        self.clear()
+        values = dumped['values']
+        for i, j in dumped['missing']:
+            values[i][j] = ()
+        entries, hash, sorted_ = self._entries, self._hash, []
+        for _id, row in itertools.izip(dumped['ids'], values):
+            hkey, skey = key = self._key(row)
+            entries.setdefault(_id, []).append(key)
+            hash.setdefault(hkey, set()).add(_id)
+            sorted_.append((skey, _id))
+        # dumped in index order, so already sorted
+        self._sorted = sorted_
+        if self.expire_after is not None:
+            for _id, keys in entries.iteritems():
+                self._schedule(_id, keys)
+
+    def add_many(self, entries):
+        '''Add (_id, keys from _keys) entries for documents new to the
+        index.  The batch is sorted, then merged in: small batches by
+        insertion, each search starting where the last left off, and large
+        ones by appending them as a second run for the sort to merge.'''
+        hash, batch = self._hash, []
+        for _id, keys in entries:
+            self._entries[_id] = keys
+            for hkey, skey in keys:
+                hash.setdefault(hkey, set()).add(_id)
+                batch.append((skey, _id))
+            if self.expire_after is not None:
+                self._schedule(_id, keys)
+        batch.sort()
+        if len(batch) * self._BULK_RATIO < len(self._sorted):
+            lo = 0
+            for entry in batch:
+                lo = bisect.bisect_left(self._sorted, entry, lo)
+                self._sorted.insert(lo, entry)
+        else:
+            self._sorted.extend(batch)
+            self._sorted.sort()
+
+    # Re-sorting costs about as many comparisons as there are entries,
+    # each far dearer than the memmove an insort costs per entry
+    _BULK_RATIO = 64
+
+    def remove(self, _id):
+        keys = self._entries.pop(_id, None)
+        if keys is None: return
+        self._expires.pop(_id, None)
+        for hkey, skey in keys:
+            ids = self._hash[hkey]
+            ids.discard(_id)
+            if not ids: del self._hash[hkey]
+            i = bisect.bisect_left(self._sorted, (skey, _id))
+            del self._sorted[i]
+
+    def _schedule(self, _id, keys):
+        '''Note when the document indexed under keys expires: expire_after
+        seconds after the earliest date in the indexed field, or never if
+        there are none'''
+        expires = None
+        for hkey, skey in keys:
+            component = skey[0]
+            if isinstance(component, _Descending):
+                component = component.value
+            if isinstance(component[1], datetime):
+                if expires is None or component[1] < expires:
+                    expires = component[1]
+        if expires is None:
+            self._expires.pop(_id, None)
+            return
+        expires += timedelta(seconds=self.expire_after)
+        if self._expires.get(_id) == expires: return
+        self._expires[_id] = expires
+        heapq.heappush(self._expiry, (expires, _id))
+        if len(self._expiry) > 2 * len(self._expires) + 64:
+            self._expiry = [ (t, i) for i, t in self._expires.iteritems() ]
+            heapq.heapify(self._expiry)
+
+    def due(self, now):
+        '''Whether documents may have expired by now'''
+        return bool(self._expiry) and self._expiry[0][0] <= now
+
+    def expired(self, now):
+        '''Forget and return the _ids of the documents expired by now'''
+        heap, expires, result = self._expiry, self._expires, []
+        while heap and heap[0][0] <= now:
+            when, _id = heapq.heappop(heap)
+            if expires.get(_id) == when:
+                del expires[_id]
+                result.append(_id)
+        return result
+
+    def plan(self, spec):
+        '''Returns (candidate count, thunk returning candidate _ids) if
+        this index can narrow spec, else None.  Candidates are a superset of
+        the matching documents; callers must still match() each one.'''
+        if self.fields[0] not in spec: return None
+        try:
+            eq = []
+            for field in self.fields:
+                value = _index_eq_value(spec.get(field, ()))
+                if value is (): break
+                eq.append(value)
+            if len(eq) == len(self.fields):
+                ids = self._hash.get(self._hash_key(eq), ())
+                return len(ids), lambda: list(ids)
+            cond = spec[self.fields[0]]
+            if len(self.fields) == 1 and isinstance(cond, dict) and '$in' in cond:
+                buckets = [ self._hash.get(self._hash_key([v]), ())
+                            for v in _index_in_values(cond) ]
+                count = sum(len(ids) for ids in buckets)
+                return count, lambda: list(set().union(*buckets))
+            spans = self._spans(spec)
+        except _Unindexable:
+            return None
+        if spans is None: return None
+        spans = spans[2]
+        count = sum(hi - lo for lo, hi in spans)
+        def thunk():
+            result = []
+            for lo, hi in spans:
+                result.extend(_id for key, _id in self._sorted[lo:hi])
+            if self.multikey:
+                seen = set()
+                result = [ _id for _id in result
+                           if _id not in seen and not seen.add(_id) ]
+            return result
+        return count, thunk
+
+    def _spans(self, spec):
+        '''Slices of self._sorted holding every entry that could match
+        spec: equality on leading fields narrows them to a key prefix, and
+        bounds on the next field to a range after it.  Returns (number of
+        fields fixed by equality, whether the next was bounded, [(lo, hi)]),
+        or None if spec doesn't constrain the leading field.'''
+        prefix = ()
+        for position, field in enumerate(self.fields):
+            cond = spec.get(field, ())
+            if cond is (): break
+            ranges = _index_ranges(cond, self.multikey)
+            if ranges is None: break
+            ranges = map(_null_bounds, ranges)
+            if len(ranges) == 1 and ranges[0][0] == ranges[0][1] != None:
+                prefix += (self._component(position, ranges[0][0][0]),)
+                continue
+            spans = set(self._bounds(prefix, position, lower, upper)
+                        for lower, upper in ranges)
+            return len(prefix), True, sorted(spans)
+        if not prefix: return None
+        lo = bisect.bisect_left(self._sorted, (prefix,))
+        hi = bisect.bisect_left(self._sorted, (prefix + (_MAX_KEY,),))
+        return len(prefix), False, [ (lo, hi) ]
+
+    def scan(self):
+        '''Returns (candidate count, thunk returning candidate _ids) for the
+        whole index, in index order'''
+        def thunk():
+            if not self.multikey:
+                return [ _id for key, _id in self._sorted ]
+            seen = set()
+            return [ _id for key, _id in self._sorted
+                     if _id not in seen and not seen.add(_id) ]
+        return len(self._sorted), thunk
+
+    def _hash_key(self, values):
+        return tuple(
+            (bvalue[0], _hashable(bvalue[1]))
+            for bvalue in map(BsonArith.to_bson, values))
+
+    def _bounds(self, prefix, position, lower, upper):
+        '''Slice of self._sorted whose keys start with prefix and whose
+        field at position lies within the bounds, each of which is None or
+        (bson value, inclusive)'''
+        if self.directions[position] < 0:
+            lower, upper = upper, lower
+        if lower is None:
+            lo = bisect.bisect_left(self._sorted, (prefix,))
+        else:
+            probe = prefix + (self._component(position, lower[0]),)
+            if not lower[1]:
+                probe += (_MAX_KEY,)
+            lo = bisect.bisect_left(self._sorted, (probe,))
+        if upper is None:
+            hi = bisect.bisect_left(self._sorted, (prefix + (_MAX_KEY,),))
+        else:
+            probe = prefix + (self._component(position, upper[0]),)
+            if upper[1]:
+                probe += (_MAX_KEY,)
+            hi = bisect.bisect_left(self._sorted, (probe,))
+        return lo, max(lo, hi)
+
+    def count(self, spec):
+        '''The exact number of documents matching spec if this index alone
+        can tell, else None'''
+        if self.multikey or len(spec) != len(self.fields): return None
+        try:
+            if len(self.fields) > 1:
+                values = []
+                for field in self.fields:
+                    ops = dict(_parse_query(spec.get(field, ())))
+                    if ops.keys() != ['$eq'] or ops['$eq'] is None: return None
+                    _check_indexable(ops['$eq'])
+                    values.append(ops['$eq'])
+                return len(self._hash.get(self._hash_key(values), ()))
+            cond = spec.get(self.fields[0], ())
+            ops = dict(_parse_query(cond))
+            if ops.keys() == ['$eq'] or ops.keys() == ['$in']:
+                values = ops.values()[0]
+                if ops.keys() == ['$eq']: values = [ values ]
+                # Missing fields hash like null, so the bucket would be inexact
+                if None in values: return None
+                for value in values:
+                    _check_indexable(value)
+                buckets = [ self._hash.get(self._hash_key([v]), ())
+                            for v in values ]
+                return len(set().union(*buckets))
+            lower = [ op for op in ops if op in ('$gt', '$gte') ]
+            upper = [ op for op in ops if op in ('$lt', '$lte') ]
+            if (not ops or len(lower) > 1 or len(upper) > 1
+                or len(lower) + len(upper) != len(ops)):
+                return None
+            bounds = _index_ranges(cond)[0]
+            if bounds != _null_bounds(bounds): return None
+            lo, hi = self._bounds((), 0, *bounds)
+            return hi - lo
+        except _Unindexable:
+            return None
+
+    def ordered(self, spec, sort):
+        '''Returns (candidate count, thunk streaming candidate _ids in sort
+        order) if this index can deliver sort's order, else None.  The sort
+        may skip leading fields fixed by equality, and must follow the
+        index's directions throughout or reverse them throughout.'''
+        if self.multikey: return None
+        try:
+            spans = self._spans(spec)
+        except _Unindexable:
+            spans = None
+        if spans is None:
+            spans = 0, False, [ (0, len(self._sorted)) ]
+        equal, bounded, spans = spans
+        fields = tuple(k for k, d in sort)
+        for first in range(equal + 1):
+            if fields == self.fields[first:first + len(fields)]: break
+        else:
+            return None
+        # Past a bounded field, entries are no longer in the sort's order
+        if bounded and first + len(fields) > equal + 1: return None
+        reversed_ = set((d < 0) != (self.directions[first + i] < 0)
+                        for i, (k, d) in enumerate(sort))
+        if len(reversed_) != 1: return None
+        reverse = reversed_.pop()
+        if reverse: spans = spans[::-1]
+        # Bounds are entries, not positions, which writes would shift
+        bounds = [ (self._sorted[lo], self._sorted[hi - 1])
+                   for lo, hi in spans if lo < hi ]
+        def thunk():
+            for first, last in bounds:
+                for _id in self._stream(first, last, reverse):
+                    yield _id
+        return sum(hi - lo for lo, hi in spans), thunk
+
+    def _stream(self, first, last, reverse):
+        '''_ids of the entries from first to last (last to first if
+        reverse), read a chunk at a time.  Each chunk is found by bisecting
+        for the entry read before it, so writes made between chunks don't
+        make the stream skip or repeat entries.'''
+        chunk = self._STREAM_CHUNK
+        seen = None
+        while True:
+            if reverse:
+                if seen is None:
+                    hi = bisect.bisect_right(self._sorted, last)
+                else:
+                    hi = bisect.bisect_left(self._sorted, seen)
+                entries = self._sorted[max(hi - chunk, 0):hi]
+                entries.reverse()
+            else:
+                if seen is None:
+                    lo = bisect.bisect_left(self._sorted, first)
+                else:
+                    lo = bisect.bisect_right(self._sorted, seen)
+                entries = self._sorted[lo:lo + chunk]
+            for entry in entries:
+                if (entry < first) if reverse else (entry > last): return
+                yield entry[1]
+            if len(entries) < chunk: return
+            seen = entries[-1]
+
+    _STREAM_CHUNK = 256
+
+class Checkpoint(object):
+    '''A point a Database can be rolled back to'''
+
+    def __init__(self, database, collections, positions):
+        self.database = database
+        self.collections = collections
+        self.positions = positions
+
+    def __repr__(self):
+        return '<Checkpoint %r>' % self.database
+
+_MISSING = object()
+_JOURNAL_DOC = 'doc'
+_JOURNAL_RESET = 'reset'
+_JOURNAL_INDEXES = 'indexes'
+_JOURNAL_CAPPED = 'capped'
+
+class _Plan(object):
+    '''The access path chosen for a query: either a collection scan (ids is
+    None) or count candidate _ids, returned by calling ids(), drawn from
+    index or (if index is None) looked up by _id.  If ordered is set the
+    candidates come in the requested sort order.'''
+
+    def __init__(self, index=None, count=None, ids=None, ordered=False):
+        self.index = index
+        self.count = count
+        self.ids = ids
+        self.ordered = ordered
+
+    def summary(self):
+        '''The plan, as profiler entries and explain() describe it'''
+        if self.ids is None: return 'COLLSCAN'
+        if self.index is None: return 'IDHACK'
+        return 'IXSCAN %s' % self.index.summary()
+
+class _Capped(object):
+    '''The documents of a capped collection in insertion (natural) order,
+    as a ring of (sequence number, key, BSON size) entries, with the
+    limits on their total size and number.  The ring is a list whose
+    evicted head is only cut off once it is most of the list, and never
+    while a checkpoint may want it back.  Tailable cursors wait on
+    tailing for inserts.'''
+
+    def __init__(self, size, max=None):
+        self.size = size
+        self.max = max
+        self.ring = []
+        self.head = 0
+        self.nbytes = 0
+        self.seq = 0
+        self.lost = -1
+        self.index = None
+        self.tailing = threading.Condition()
+
+    @classmethod
+    def from_options(cls, options):
+        '''A _Capped for collection options, or None if they aren't capped'''
+        if not options.get('capped'): return None
+        size = options.get('size')
+        if not isinstance(size, (int, long, float)) or size <= 0:
+            raise OperationFailure('size must be given (in bytes) '
+                                   'for a capped collection')
+        return cls(size, options.get('max') or None)
+
+    def __len__(self):
+        return len(self.ring) - self.head
+
+    def keys(self):
+        return [ entry[1] for entry in itertools.islice(
+                self.ring, self.head, None) ]
+
+    def newest(self):
+        '''The sequence number of the newest entry, or -1'''
+        if len(self) == 0: return -1
+        return self.ring[-1][0]
+
+    def push(self, key, nbytes):
+        self.ring.append((self.seq, key, nbytes))
+        self.seq += 1
+        self.nbytes += nbytes
+
+    def evict(self):
+        '''Drop the oldest entries (always keeping the newest) until the
+        limits are met, returning their keys'''
+        ring = self.ring
+        evicted = []
+        while len(self) > 1 and (
+                self.nbytes > self.size or self.max and len(self) > self.max):
+            seq, key, nbytes = ring[self.head]
+            self.head += 1
+            self.nbytes -= nbytes
+            self.lost = seq
+            evicted.append(key)
+        return evicted
+
+    def clear(self):
+        if len(self):
+            self.lost = self.ring[-1][0]
+        self.head = len(self.ring)
+        self.nbytes = 0
+
+    def compact(self):
+        if self.head > 1024 and self.head * 2 > len(self.ring):
+            del self.ring[:self.head]
+            self.head = 0
+
+    def since(self, seq):
+        '''The entries after sequence number seq (all of them if seq is
+        None), or None if some of those have been evicted'''
+        if seq is None:
+            return self.ring[self.head:]
+        if self.lost > seq:
+            return None
+        start = bisect.bisect_left(self.ring, (seq + 1,), self.head)
+        return self.ring[start:]
+
+    def position(self):
+        return (self.head, len(self.ring), self.nbytes, self.lost)
+
+    def restore(self, position):
+        '''Go back to position, dropping entries pushed since'''
+        self.head, end, self.nbytes, self.lost = position
+        del self.ring[end:]
+
+class _RingIndex(object):
+    '''An index on a field that a capped collection's documents are
+    appended in order of (an oplog's ts), which the ring itself is sorted
+    on: bounds on the field are found by bisecting it'''
+    multikey = False
+
+    def __init__(self, capped, field):
+        self.capped = capped
+        self.field = field
+        self.name = field
+        self.key = [ (field, ASCENDING) ]
+
+    def summary(self):
+        return '{ %s: 1 }' % self.field
+
+    def plan(self, spec, data):
+        '''As Index.plan, given the collection's documents'''
+        span = self.span(spec, data)
+        if span is None: return None
+        lo, hi = span
+        ring = self.capped.ring
+        return hi - lo, lambda: [ entry[1] for entry in ring[lo:hi] ]
+
+    def span(self, spec, data):
+        '''The slice of the ring that could match spec, or None if spec
+        doesn't bound the field'''
+        cond = spec.get(self.field, ())
+        if cond is (): return None
+        try:
+            ranges = _index_ranges(cond)
+        except _Unindexable:
+            return None
+        if ranges is None or len(ranges) != 1: return None
+        lower, upper = ranges[0]
+        ring = self.capped.ring
+        lo, hi = self.capped.head, len(ring)
+        if lower is not None:
+            lo = self._bisect(data, lower[0], not lower[1])
+        if upper is not None:
+            hi = self._bisect(data, upper[0], upper[1])
+        return lo, max(lo, hi)
+
+    def _bisect(self, data, bvalue, after):
+        '''The ring position of the first entry whose field is at least
+        bvalue (or, if after, greater than it)'''
+        ring, field, to_bson = self.capped.ring, self.field, BsonArith.to_bson
+        lo, hi = self.capped.head, len(ring)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = to_bson(_lookup(data.get(ring[mid][1]), field, None))
+            if value < bvalue or after and value == bvalue:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+_OPLOG = ('local', 'oplog.rs')
+
+_OPERATION_TYPES = dict(i='insert', u='update', d='delete')
+
+def _id_spec(doc):
+    '''The spec selecting doc by _id (as an oplog update's o2)'''
+    if '_id' in doc: return {'_id': doc['_id']}
+    return {}
+
+class _Unkeyed(object):
+    '''The key a capped collection document without an _id is stored
+    under; equal only to itself'''
+    __slots__ = ()
+    def __repr__(self): return '_Unkeyed()'
+
+def _natural_direction(sort):
+    '''-1 if sort asks for reverse natural order, otherwise 1'''
+    if sort and sort[0][0] == '$natural' and sort[0][1] < 0: return -1
+    return 1
+
+def _index_name(key):
+    '''The name the server gives an index on key, a list of (field,
+    direction) pairs: a_1_b_-1'''
+    return '_'.join('%s_%s' % (field, direction) for field, direction in key)
+
+class _Unindexable(Exception): pass
+
+class _MaxKey(object):
+    '''Sorts after every index key; used to build bisect probes'''
+    def __eq__(self, other): return other is self
+    def __ne__(self, other): return other is not self
+    def __lt__(self, other): return False
+    def __le__(self, other): return other is self
+    def __gt__(self, other): return other is not self
+    def __ge__(self, other): return True
+    def __repr__(self): return '_MAX_KEY'
+
+_MAX_KEY = _MaxKey()
+
+def _id_candidates(cond, data):
+    '''The _ids in data that cond (an equality or \$in on _id) can match,
+    or None if cond can't be answered by hash lookup'''
+    if _is_cond(cond):
+        if '$in' not in cond: return None
+        values = cond['$in']
+    else:
+        values = [ cond ]
+    result = []
+    for value in values:
+        if isinstance(value, (_RE_TYPE, dict, list)): return None
+        try:
+            if value in data: result.append(value)
+        except TypeError: # unhashable
+            return None
+    return list(set(result))
+
+def _index_eq_value(cond):
+    '''The value cond requires by equality, or () if it isn't an equality.
+    Matches for \$all include the first value, so it counts as equality.'''
+    if cond is (): return ()
+    for op, value in _parse_query(cond):
+        if op == '$eq':
+            _check_indexable(value)
+            return value
+        elif op == '$all' and _index_all_value(value) is not ():
+            return _index_all_value(value)
+    return ()
+
+def _index_all_value(values):
+    if not values or _is_cond(values[0]): return ()
+    _check_indexable(values[0])
+    return values[0]
+
+def _index_ranges(cond, multikey=False):
+    '''A list of (lower, upper) bounds on BSON values that together cover
+    every value satisfying cond, or None if cond can't be bounded.  In a
+    multikey index different elements may satisfy each bound, so only
+    \$elemMatch gets both.'''
+    lower = upper = None
+    for op, value in _parse_query(cond):
+        if op == '$eq':
+            _check_indexable(value)
+            bvalue = BsonArith.to_bson(value)
+            return [ ((bvalue, True), (bvalue, True)) ]
+        elif op == '$in':
+            return [ ((bvalue, True), (bvalue, True))
+                     for bvalue in map(BsonArith.to_bson, _index_in_values(cond)) ]
+        elif op == '$all' and _index_all_value(value) is not ():
+            bvalue = BsonArith.to_bson(_index_all_value(value))
+            return [ ((bvalue, True), (bvalue, True)) ]
+        elif op == '$elemMatch' and _is_cond(value):
+            ranges = _index_ranges(value)
+            if ranges is not None: return ranges
+        elif op in ('$gt', '$gte'):
+            _check_indexable(value)
+            lower = (BsonArith.to_bson(value), op == '$gte')
+        elif op in ('$lt', '$lte'):
+            _check_indexable(value)
+            upper = (BsonArith.to_bson(value), op == '$lte')
+    if lower is None and upper is None: return None
+    if multikey and lower is not None:
+        upper = None
+    return [ (lower, upper) ]
+
+def _null_bounds(bounds):
+    '''(lower, upper) widened to take in all of null's place in index
+    order, which missing values share; queries put them before null.'''
+    lower, upper = bounds
+    if lower is not None and lower[0] == _NULL_KEY:
+        lower = None
+    if upper is not None and upper[0] == _NULL_KEY:
+        upper = (_NULL_KEY, True)
+    return lower, upper
+
+def _index_spec(spec):
+    '''spec, with each \$elemMatch on subdocuments also given as
+    conditions on the dotted paths it tests, for indexes on those paths'''
+    extra = {}
+    for key, cond in spec.iteritems():
+        if not isinstance(cond, dict) or '$elemMatch' not in cond: continue
+        query = cond['$elemMatch']
+        if not isinstance(query, dict) or _is_cond(query): continue
+        for field, subcond in query.iteritems():
+            if not field.startswith('$'):
+                extra['%s.%s' % (key, field)] = subcond
+    if not extra: return spec
+    extra.update(spec)
+    return extra
+
+def _index_in_values(cond):
+    values = cond['$in']
+    for value in values:
+        _check_indexable(value)
+    return values
+
+def _check_indexable(value):
+    if isinstance(value, (list, _RE_TYPE)):
+        raise _Unindexable()
+    try:
+        BsonArith.bson_type(value)
+    except KeyError:
+        raise _Unindexable()
+
+def _hashable(value):
+    if isinstance(value, dict):
+        return tuple(sorted((k, _hashable(v)) for k, v in value.iteritems()))
+    elif isinstance(value, list):
+        return tuple(_hashable(v) for v in value)
+    return value
+
+_RE_TYPE = type(re.compile('foo'))
+_NULL_KEY = (0, None)
+
+class _Missing(tuple):
+    '''The index key component for a missing field, which is equal to null
+    but can be told apart by identity'''
+_MISSING_BVALUE = _Missing(_NULL_KEY)
+
+class BulkOperationBuilder(object):
+    '''mim's counterpart to pymongo.bulk.BulkOperationBuilder'''
+
+    def __init__(self, collection, ordered=True):
+        self._bulk = _Bulk(collection, ordered)
+
+    def find(self, selector):
+        if not isinstance(selector, dict):
+            raise TypeError('selector must be an instance of dict')
+        return bulk.BulkWriteOperation(selector, self._bulk)
+
+    def insert(self, document):
+        self._bulk.add_insert(document)
+
+    def execute(self, write_concern=None):
+        if write_concern and not isinstance(write_concern, dict):
+            raise TypeError('write_concern must be an instance of dict')
+        return self._bulk.execute(write_concern)
+
+class _Bulk(bulk._Bulk):
+    '''pymongo's bulk operation list, executed in-process.  Each run of
+    inserts is checked and indexed as a batch.'''
+
+    def execute(self, write_concern=None):
+        if not self.ops:
+            raise InvalidOperation('No operations to execute')
+        if self.executed:
+            raise InvalidOperation('Bulk operations can '
+                                   'only be executed once.')
+        self.executed = True
+        if self.ordered:
+            runs = self.gen_ordered()
+        else:
+            runs = self.gen_unordered()
+        full_result = dict(
+            writeErrors=[], writeConcernErrors=[], nInserted=0, nUpserted=0,
+            nMatched=0, nModified=0, nRemoved=0, upserted=[])
+        for run in runs:
+            result = self.collection._bulk_run(run, self.ordered)
+            # mim doesn't tell no-op updates apart, so all count as modified
+            bulk._merge_command(run, full_result, [ (0, dict(
+                            result, nModified=result['n'] - len(result['upserted']))) ])
+            if self.ordered and full_result['writeErrors']:
+                break
+        if full_result['writeErrors']:
+            full_result['writeErrors'].sort(key=lambda error: error['index'])
+            raise BulkWriteError(full_result)
+        return full_result
 
 class Cursor(object):
 
     def __init__(self, collection, _iterator_gen,
-                 sort=None, skip=None, limit=None, fields=None, as_class=dict):
-        if isinstance(fields, list):
-            fields = dict((f, 1) for f in fields)
-        
-        if fields is not None and '_id' not in fields:
-            f = { '_id': 1 }
-            f.update(fields)
-            fields = f
-
+                 sort=None, skip=None, limit=None, fields=None, as_class=dict,
+                 spec=None):
         self._collection = collection
         self._iterator_gen = _iterator_gen
+        self._spec = spec
         self._sort = sort
         self._skip = skip
         self._limit = limit
-        self._fields = fields
+        self._fields = _normalize_fields(fields)
         self._as_class = as_class
+        self._hint = None
+        self._query_flags = 0
+        self._max_await_time_ms = None
+        self._alive = True
         self._safe_to_chain = True
+        # whether the iterator's documents are already copied out
+        self._copied = False
 
     @LazyProperty
     def iterator(self):
         self._safe_to_chain = False
-        result = (doc for doc,match in self._iterator_gen())
-        if self._sort is not None:
-            result = sorted(result, cmp=cursor_comparator(self._sort))
-        if self._skip is not None:
+        self._collection._expire()
+        if self._query_flags & _TAILABLE:
+            return self._tail()
+        profile = None
+        if self._spec is not None:
+            profile = self._collection._profiler(
+                'query', query=self._spec, ntoreturn=self._limit or 0,
+                ntoskip=self._skip or 0, nreturned=0)
+        if profile is None:
+            stats = None
+        else:
+            stats = profile.entry
+            start = time.time()
+        collection = self._collection
+        if not collection._thread_safe:
+            result = self._results(stats)
+        else:
+            # Take a snapshot, so that writes made while the cursor is being
+            # read are neither seen nor able to break the iteration.  Frozen
+            # documents are immutable, so can be kept as they are; others
+            # are copied out while the lock is held.
+            with collection._lock.reading:
+                if collection._copy_on_write:
+                    result = iter(list(self._results(stats)))
+                else:
+                    result = iter(map(self._copy_out, self._results(stats)))
+                    self._copied = True
+        if profile is None:
+            return result
+        profile.elapsed = time.time() - start
+        return _ProfiledIterator(result, profile)
+
+    def _results(self, stats=None):
+        kwargs = {}
+        if stats is not None:
+            kwargs['stats'] = stats
+        if self._hint is not None:
+            kwargs['hint'] = self._hint
+        if self._sort is None:
+            result = self._iterator_gen(**kwargs)
+        else:
+            top = None
+            if self._limit:
+                top = (self._skip or 0) + abs(self._limit)
+            result = self._iterator_gen(sort=self._sort, top=top, **kwargs)
+        if self._skip:
             result = itertools.islice(result, self._skip, sys.maxint)
-        if self._limit is not None:
+        if self._limit:
             result = itertools.islice(result, abs(self._limit))
         return iter(result)
 
+    def _tail(self):
+        collection = self._collection
+        if collection._capped is None:
+            raise OperationFailure(
+                'tailable cursor requested on non capped collection')
+        timeout = None
+        if self._query_flags & _AWAIT_DATA:
+            timeout = (self._max_await_time_ms or _AWAIT_TIME_MS) / 1000.0
+        copy = None
+        if collection._thread_safe and not collection._copy_on_write:
+            copy = self._copy_out
+            self._copied = True
+        return _Tail(collection, self._spec, timeout,
+                     replay=bool(self._query_flags & _OPLOG_REPLAY), copy=copy)
+
     def clone(self, **overrides):
         result = Cursor(
             collection=self._collection,
@@ -507,7 +2458,11 @@ class Cursor(object):
             skip=self._skip,
             limit=self._limit,
             fields=self._fields,
-            as_class=self._as_class)
+            as_class=self._as_class,
+            spec=self._spec)
+        result._hint = self._hint
+        result._query_flags = self._query_flags
+        result._max_await_time_ms = self._max_await_time_ms
         for k,v in overrides.items():
             setattr(result, k, v)
         return result
@@ -516,25 +2471,66 @@ class Cursor(object):
         if not self._safe_to_chain:
             del self.iterator
             self._safe_to_chain = True
+            self._alive = True
 
-    def count(self):
-        return sum(1 for x in self._iterator_gen())
+    def count(self, with_limit_and_skip=False):
+        self._collection._expire()
+        if self._spec is None:
+            count = sum(1 for x in self._iterator_gen())
+        else:
+            profile = self._collection._profiler('command', command=dict(
+                    count=self._collection.name, query=self._spec))
+            if profile is None:
+                count = self._collection._count(self._spec)
+            else:
+                count = self._collection._count(self._spec, profile.entry)
+                profile.finish()
+        if with_limit_and_skip:
+            if self._skip:
+                count = max(0, count - self._skip)
+            if self._limit:
+                count = min(count, abs(self._limit))
+        return count
 
     def __getitem__(self, key):
         # Le *sigh* -- this is the only place apparently where pymongo *does*
         # clone
         clone = self.clone()
-        return clone.skip(key).next()
+        try:
+            return clone.skip(key).next()
+        finally:
+            clone.close()
 
     def __iter__(self):
         return self
 
     def next(self):
-        value = self.iterator.next()
-        value = bcopy(value)
-        if self._fields:
-            value = _project(value, self._fields)
-        return wrap_as_class(value, self._as_class)
+        try:
+            doc = self.iterator.next()
+        except StopIteration:
+            if not self._query_flags & _TAILABLE:
+                self._alive = False
+            raise
+        except OperationFailure:
+            self._alive = False
+            raise
+        if self._copied:
+            return doc
+        return self._copy_out(doc)
+
+    def _copy_out(self, doc):
+        return _copy_out(doc, self._fields, self._as_class)
+
+    @property
+    def alive(self):
+        '''As pymongo's: False once the results have run out, though a
+        tailable cursor stays alive unless it loses its place'''
+        return self._alive
+
+    def close(self):
+        iterator = self.__dict__.get('iterator')
+        if isinstance(iterator, _ProfiledIterator):
+            iterator.close()
 
     def sort(self, key_or_list, direction=ASCENDING):
         if not self._safe_to_chain:
@@ -546,12 +2542,14 @@ class Cursor(object):
             if isinstance(t, tuple):
                 keys.append(t)
             else:
-                keys.append(t, ASCENDING)
+                keys.append((t, ASCENDING))
         self._sort = keys
         return self # I'd rather clone, but that's not what pymongo does here
 
     def all(self):
-        return list(self._iterator_gen())
+        self._collection._expire()
+        with self._collection._lock.reading:
+            return list(self._iterator_gen())
 
     def skip(self, skip):
         if not self._safe_to_chain:
@@ -562,39 +2560,359 @@ class Cursor(object):
     def limit(self, limit):
         if not self._safe_to_chain:
             raise InvalidOperation('cannot set options after executing query')
-        self._skip = limit
+        self._limit = limit
         return self # I'd rather clone, but that's not what pymongo does here
 
     def distinct(self, key):
         return list(set(_lookup(d, key) for d in self.all()))
 
+    def add_option(self, mask):
+        '''Set query flags (pymongo.cursor._QUERY_OPTIONS).  Tailable
+        cursors over capped collections pick up documents inserted after
+        they run out; with await_data they first wait a while for them.'''
+        if not self._safe_to_chain:
+            raise InvalidOperation('cannot set options after executing query')
+        self._query_flags |= mask
+        return self
+
+    def remove_option(self, mask):
+        if not self._safe_to_chain:
+            raise InvalidOperation('cannot set options after executing query')
+        self._query_flags &= ~mask
+        return self
+
+    def max_await_time_ms(self, max_await_time_ms):
+        '''How long a tailable await_data cursor waits for more documents
+        before giving up (until it is next read)'''
+        if not self._safe_to_chain:
+            raise InvalidOperation('cannot set options after executing query')
+        self._max_await_time_ms = max_await_time_ms
+        return self
+
     def hint(self, index):
-        # checks indexes, but doesn't actually use hinting
+        '''Force the query to use the named index (by name or key list), or
+        a collection scan for [('$natural', 1)]'''
+        if not self._safe_to_chain:
+            raise InvalidOperation('cannot set options after executing query')
         if type(index) == list:
-            # ignoring direction, since mim's ensure_index doesn't preserve it (set to 0)
-            test_idx = [(i, 0) for i, direction in index if i != '$natural']
-            if test_idx and test_idx not in self._collection._indexes.values():
-                raise OperationFailure('database error: bad hint. Valid values: %s' %
-                        self._collection._indexes.values())
+            key = [ (i, direction) for i, direction in index if i != '$natural' ]
+            if not key:
+                self._hint = '$natural'
+                return self
+            indexes = self._collection._indexes.values()
+            for idx in indexes:
+                if idx.key == key:
+                    self._hint = idx.name
+                    return self
+            raise OperationFailure('database error: bad hint. Valid values: %s' %
+                    [ idx.key for idx in indexes ])
         elif isinstance(index, basestring):
             if index not in self._collection._indexes.keys():
                 raise OperationFailure('database error: bad hint. Valid values: %s'
                         % self._collection._indexes.keys())
+            self._hint = index
         elif index == None:
-            pass
+            self._hint = None
         else:
             raise TypeError('hint index should be string, list of tuples, or None, but was %s' % type(index))
         return self
 
-def cursor_comparator(keys):
-    def comparator(a, b):
-        for k,d in keys:
-            x = _lookup(a, k, None)
-            y = _lookup(b, k, None)
-            part = BsonArith.cmp(x, y)
-            if part: return part * d
-        return 0
-    return comparator
+    def explain(self):
+        '''Run the query and describe how mim answered it, in the format of
+        MongoDB 2.6's explain'''
+        if self._spec is None:
+            raise InvalidOperation('only find() cursors can be explained')
+        collection = self._collection
+        stats = dict(nscanned=0, nscannedObjects=0)
+        with collection._lock.reading:
+            plan = collection._plan(self._spec, self._sort, self._hint)
+            start = time.time()
+            n = sum(1 for doc in self.clone()._results(stats))
+            millis = int((time.time() - start) * 1000)
+        if plan.ids is None:
+            cursor = _SCAN_CURSORS[collection._capped is not None,
+                                   _natural_direction(self._sort)]
+        elif plan.index is None:
+            cursor = 'IDCursor'
+        else:
+            cursor = 'BtreeCursor %s' % plan.index.name
+        return dict(
+            cursor=cursor,
+            isMultiKey=plan.index is not None and plan.index.multikey,
+            n=n,
+            nscanned=stats['nscanned'],
+            nscannedObjects=stats['nscannedObjects'],
+            scanAndOrder=stats['scanAndOrder'],
+            indexOnly=False,
+            nYields=0,
+            millis=millis,
+            planSummary=stats['planSummary'])
+
+_TAILABLE = _QUERY_OPTIONS['tailable_cursor']
+_AWAIT_DATA = _QUERY_OPTIONS['await_data']
+_OPLOG_REPLAY = _QUERY_OPTIONS['oplog_replay']
+_FIND_FLAGS = [
+    ('tailable', _TAILABLE), ('await_data', _AWAIT_DATA),
+    ('oplog_replay', _OPLOG_REPLAY) ]
+_AWAIT_TIME_MS = 1000
+
+# explain()'s name for a collection scan, by (capped, direction)
+_SCAN_CURSORS = {
+    (False, 1): 'BasicCursor', (False, -1): 'ReverseCursor',
+    (True, 1): 'ForwardCappedCursor', (True, -1): 'ReverseCappedCursor' }
+
+class _Tail(object):
+    '''The results of a tailable cursor: a capped collection's matching
+    documents in natural order, then those inserted since as they arrive.
+    Running out raises StopIteration but leaves the tail open for the
+    next read.  If await_timeout is given, it first waits up to that many
+    seconds for more.  With replay, an oplog tail starts at the first entry
+    its ts bounds could match rather than scanning up to it.  If copy is
+    given, documents are passed through it while the collection is locked.'''
+
+    def __init__(self, collection, spec, await_timeout=None, replay=False,
+                 copy=None):
+        self._collection = collection
+        self._copy = copy
+        self._predicate = compile_query(spec or {})
+        self._await_timeout = await_timeout
+        self._seq = None
+        if replay:
+            self._seq = collection._replay_start(spec or {})
+        self._pending = iter(())
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        for doc in self._pending:
+            return doc
+        if self._await_timeout is None:
+            deadline = None
+        else:
+            deadline = time.time() + self._await_timeout
+        while True:
+            self._pending = self._fetch()
+            for doc in self._pending:
+                return doc
+            if deadline is None: break
+            remaining = deadline - time.time()
+            if remaining <= 0: break
+            capped = self._collection._capped
+            seen = -1 if self._seq is None else self._seq
+            with capped.tailing:
+                if capped.newest() <= seen:
+                    capped.tailing.wait(remaining)
+        raise StopIteration
+
+    def _fetch(self):
+        '''The matching documents inserted since the last fetch'''
+        collection = self._collection
+        with collection._lock.reading:
+            entries = collection._capped.since(self._seq)
+            if entries is None:
+                raise OperationFailure(
+                    'CappedPositionLost: the tailable cursor fell behind the '
+                    'start of capped collection %s' % collection.name)
+            if not entries:
+                return iter(())
+            self._seq = entries[-1][0]
+            predicate = self._predicate
+            data = collection._data
+            docs = [ doc for doc in (data.get(key) for seq, key, n in entries)
+                     if doc is not None and predicate(doc) ]
+            if self._copy is not None:
+                docs = map(self._copy, docs)
+        return iter(docs)
+
+class ChangeStream(object):
+    '''Change events for a collection's writes, as watch() returns them.
+    Writes push the events that match spec straight into a queue of at
+    most max_queue, so nothing is polled or scanned, and only take the
+    condition variable when a reader is waiting on it.  Updates, which mim
+    applies as replacements, come with the fullDocument after them.
+
+    A watcher that lets its queue fill up loses the events after that:
+    once it has read those queued, it gets an OperationFailure and is
+    closed.  Dropping the collection sends drop and invalidate events and
+    ends the stream.'''
+
+    def __init__(self, collection, spec=None, max_queue=1000,
+                 max_await_time_ms=None):
+        self._collection = collection
+        self._predicate = compile_query(spec) if spec else None
+        self._queue = collections.deque()
+        self._max_queue = max_queue
+        self._ready = threading.Condition()
+        self._waiting = 0
+        self._max_await_time_ms = max_await_time_ms
+        self._lost = 0
+        self.alive = True
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+        self.close()
+
+    def next(self):
+        '''The next event, waiting up to max_await_time_ms (or for as long
+        as it takes) for one'''
+        timeout = self._max_await_time_ms
+        if timeout is not None:
+            timeout /= 1000.0
+        event = self._get(True, timeout)
+        if event is None:
+            raise StopIteration
+        return event
+
+    def try_next(self):
+        '''The next event if there is one, else None'''
+        return self._get(False, None)
+
+    def close(self):
+        if not self.alive: return
+        self.alive = False
+        self._collection._unwatch(self)
+
+    def _get(self, block, timeout):
+        if not self.alive:
+            return None
+        queue = self._queue
+        if not queue and block and not self._lost:
+            with self._ready:
+                self._waiting += 1
+                # _push appends before it checks for waiters, so this
+                # can't miss its notify
+                if not queue:
+                    self._ready.wait(timeout)
+                self._waiting -= 1
+        try:
+            event = queue.popleft()
+        except IndexError:
+            if self._lost:
+                self.close()
+                raise OperationFailure(
+                    'change stream on %s fell behind and lost %d events'
+                    % (self._collection.name, self._lost))
+            return None
+        if event is _INVALIDATE:
+            self.alive = False
+            return dict(operationType='invalidate')
+        return _copy_out(event, None, dict)
+
+    def _push(self, event, match=True):
+        if match and self._predicate is not None and not self._predicate(event):
+            return
+        if self._lost or len(self._queue) >= self._max_queue:
+            self._lost += 1
+            return
+        self._queue.append(event)
+        if self._waiting:
+            with self._ready:
+                self._ready.notify()
+
+# queued to end a ChangeStream whose collection was dropped
+_INVALIDATE = object()
+
+class _Profile(object):
+    '''A profiled operation, and its system.profile entry'''
+
+    def __init__(self, collection, op, **fields):
+        self.database = collection.database
+        self.entry = dict(
+            op=op, ns='%s.%s' % (self.database.name, collection.name),
+            nscanned=0, nscannedObjects=0, **fields)
+        self.start = time.time()
+        self.elapsed = None
+
+    def finish(self, **fields):
+        if self.elapsed is None:
+            self.elapsed = time.time() - self.start
+        self.entry.update(fields)
+        self.database._profile(self.entry, self.elapsed)
+
+class _ProfiledIterator(object):
+    '''A profiled cursor's results.  Only the time spent fetching them
+    counts, and the profile is written once they run out or the cursor is
+    closed.  (Not when it's collected: that could take system.profile's
+    lock at any point, on a thread that already holds it.)'''
+
+    def __init__(self, iterator, profile):
+        self._iterator = iterator
+        self._profile = profile
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        profile = self._profile
+        if profile is None:
+            return self._iterator.next()
+        start = time.time()
+        try:
+            value = self._iterator.next()
+        except StopIteration:
+            profile.elapsed += time.time() - start
+            self.close()
+            raise
+        profile.elapsed += time.time() - start
+        profile.entry['nreturned'] += 1
+        return value
+
+    def close(self):
+        profile, self._profile = self._profile, None
+        if profile is not None:
+            profile.finish()
+
+_TOP_KEYS = dict(
+    query='queries', insert='insert', update='update', remove='remove',
+    command='commands')
+
+def _sort_key(keys):
+    '''Key function ordering documents by keys, a list of (field, direction)'''
+    to_bson = BsonArith.to_bson
+    fields = [ (k, d < 0) for k, d in keys if k != '$natural' ]
+    def key(doc):
+        result = []
+        for k, descending in fields:
+            bvalue = to_bson(_lookup(doc, k, None))
+            result.append(_Descending(bvalue) if descending else bvalue)
+        return result
+    return key
+
+def _sort_docs(docs, keys, top=None):
+    '''Iterator over docs in the order given by keys.  If top is given only
+    that many documents are returned, selected with a bounded heap.'''
+    key = _sort_key(keys)
+    if top:
+        return iter(heapq.nsmallest(top, docs, key=key))
+    return iter(sorted(docs, key=key))
+
+class _Descending(object):
+    '''Inverts the order of a sort key, or of an index key component.
+    Anything else (such as _MAX_KEY in an index probe) decides for itself.'''
+    __slots__ = ('value',)
+    def __init__(self, value): self.value = value
+    def __eq__(self, other):
+        return isinstance(other, _Descending) and self.value == other.value
+    def __ne__(self, other): return not self == other
+    def __lt__(self, other):
+        if not isinstance(other, _Descending): return NotImplemented
+        return self.value > other.value
+    def __le__(self, other):
+        if not isinstance(other, _Descending): return NotImplemented
+        return self.value >= other.value
+    def __gt__(self, other):
+        if not isinstance(other, _Descending): return NotImplemented
+        return self.value < other.value
+    def __ge__(self, other):
+        if not isinstance(other, _Descending): return NotImplemented
+        return self.value <= other.value
+    def __repr__(self): return '_Descending(%r)' % (self.value,)
 
 class BsonArith(object):
     _types = None
@@ -642,6 +2960,7 @@ class BsonArith(object):
             (lambda x:x, [ bson.ObjectId ]),
             (lambda x:x, [ bool ]),
             (lambda x:x, [ datetime ]),
+            (lambda x:x, [ bson.Timestamp ]),
             (lambda x:x, [ type(re.compile('foo')) ] )
             ]        
 
@@ -664,8 +2983,6 @@ def match(spec, doc):
 
 class Match(object): 
     def match(self, key, op, value):
-        log.debug('match(%r, %r, %r, %r)',
-                  self, key, op, value)
         val = self.get(key, ())
         if isinstance(val, MatchList):
             if val.match('$', op, value): return True
@@ -712,14 +3029,20 @@ class Match(object):
         except KeyError:
             return default
 
+    def _copy(self, obj):
+        return bcopy(obj)
+
     def update(self, updates, **kwargs):
         newdoc = {}
         for k, v in updates.iteritems():
             if k.startswith('$'): break
-            newdoc[k] = bcopy(v)
+            newdoc[k] = self._copy(v)
         if newdoc:
+            # Replacements keep the _id of the document they replace
+            if '_id' in self._orig and '_id' not in newdoc:
+                newdoc['_id'] = self._orig['_id']
             self._orig.clear()
-            self._orig.update(bcopy(newdoc))
+            self._orig.update(newdoc)
             return
         for op, update_parts in updates.iteritems():
             func = getattr(self, '_op_' + op[1:], None)
@@ -735,14 +3058,14 @@ class Match(object):
         subdoc[key] += arg
 
     def _op_set(self, subdoc, key, arg):
-        subdoc[key] = bcopy(arg)
+        subdoc[key] = self._copy(arg)
         
     def _op_setOnInsert(self, subdoc, key, arg, **kwargs):
-        subdoc[key] = bcopy(arg)
+        subdoc[key] = self._copy(arg)
 
     def _op_push(self, subdoc, key, arg):
         l = subdoc.setdefault(key, [])
-        l.append(bcopy(arg))
+        l.append(self._copy(arg))
 
     def _op_pop(self, subdoc, key, arg):
         l = subdoc.setdefault(key, [])
@@ -753,19 +3076,20 @@ class Match(object):
 
     def _op_pushAll(self, subdoc, key, arg):
         l = subdoc.setdefault(key, [])
-        l.extend(bcopy(arg))
+        l.extend(self._copy(arg))
 
     def _op_addToSet(self, subdoc, key, arg):
         l = subdoc.setdefault(key, [])
         if arg not in l:
-            l.append(bcopy(arg))
+            l.append(self._copy(arg))
 
     def _op_pull(self, subdoc, key, arg):
         l = subdoc.setdefault(key, [])
         if isinstance(arg, dict):
+            pred = _compile_element(arg)
             subdoc[key] = [
                 vv for vv in l
-                if not match(arg, vv) ]
+                if not pred(vv) ]
         else:
             subdoc[key] = [
                 vv for vv in l
@@ -773,63 +3097,77 @@ class Match(object):
             
 
 
+def _match_wrap(value):
+    if isinstance(value, list):
+        return MatchList(value)
+    elif isinstance(value, dict):
+        return MatchDoc(value)
+    return value
+
+_UNREAD = object()
+
 class MatchDoc(Match):
+    '''Wraps doc for matching and updating.  Values are wrapped as they're
+    read, so a copy-on-write document is only thawed along the paths an
+    update touches.'''
     def __init__(self, doc):
         self._orig = doc
         self._doc = {}
-        for k,v in doc.iteritems():
-            if isinstance(v, list):
-                self._doc[k] = MatchList(v)
-            elif isinstance(v, dict):
-                self._doc[k] = MatchDoc(v)
-            else:
-                self._doc[k] = v
     def traverse(self, first, *rest):
         if not rest:
             if '.' in first:
                 return self.traverse(*(first.split('.')))
             return self, first
-        if first not in self._doc:
+        if first not in self._doc and first not in self._orig:
             self._doc[first] = MatchDoc({})
         return self[first].traverse(*rest)
     def iteritems(self):
-        return self._doc.iteritems()
+        for k in list(self._orig):
+            yield k, self[k]
+        for k, v in self._doc.items():
+            if k not in self._orig:
+                yield k, v
     def __eq__(self, o):
-        return isinstance(o, MatchDoc) and self._doc == o._doc
+        return (isinstance(o, MatchDoc)
+                and dict(self.iteritems()) == dict(o.iteritems()))
     def __hash__(self):
         return hash(self._doc)
     def __repr__(self):
-        return 'M%r' % (self._doc,)
+        return 'M%r' % (dict(self.iteritems()),)
     def __getitem__(self, key):
-        return self._doc[key]
+        try:
+            return self._doc[key]
+        except KeyError:
+            value = self._doc[key] = _match_wrap(self._orig[key])
+            return value
     def __setitem__(self, key, value):
         self._doc[key] = value
         self._orig[key] = value
     def setdefault(self, key, default):
-        self._doc.setdefault(key, default)
+        if key not in self._orig:
+            self._doc.setdefault(key, default)
         return self._orig.setdefault(key, default)
 
 class MatchList(Match):
     def __init__(self, doc, pos=None):
         self._orig = doc
-        self._doc = []
-        for ele in doc:
-            if isinstance(ele, list):
-                self._doc.append(MatchList(ele))
-            elif isinstance(ele, dict):
-                self._doc.append(MatchDoc(ele))
-            else:
-                self._doc.append(ele)
+        self._doc = [ _UNREAD ] * len(doc)
         self._pos = pos
+    def _item(self, index):
+        value = self._doc[index]
+        if value is _UNREAD:
+            value = self._doc[index] = _match_wrap(self._orig[index])
+        return value
     def __iter__(self):
-        return iter(self._doc)
+        for i in xrange(len(self._doc)):
+            yield self._item(i)
     def traverse(self, first, *rest):
         if not rest:
             return self, first
         return self[first].traverse(*rest)
     def match(self, key, op, value):
         if key == '$':
-            for i, item in enumerate(self._doc):
+            for i, item in enumerate(self):
                 if self.match(i, op, value):
                     if self._pos is None:
                         self._pos = i
@@ -846,20 +3184,20 @@ class MatchList(Match):
                 return True
 
     def __eq__(self, o):
-        return isinstance(o, MatchList) and self._doc == o._doc
+        return isinstance(o, MatchList) and list(self) == list(o)
     def __hash__(self):
         return hash(self._doc)
     def __repr__(self):
-        return 'M<%r>%r' % (self._pos, self._doc)
+        return 'M<%r>%r' % (self._pos, list(self))
     def __getitem__(self, key):
         try:
             if key == '$':
                 if self._pos is None:
-                    return self._doc[0]
+                    return self._item(0)
                 else:
-                    return self._doc[self._pos]
+                    return self._item(self._pos)
             else:
-                return self._doc[int(key)]
+                return self._item(int(key))
         except IndexError:
             raise KeyError, key
     def __setitem__(self, key, value):
@@ -887,6 +3225,788 @@ def _parse_query(v):
     else:
         return [('$eq', v)]
 
+def compile_query(spec):
+    '''Compile spec into a predicate over raw (unwrapped) documents.
+
+    The structure of a spec -- its paths and operators, but not its values --
+    is compiled once and cached, so repeated queries of the same shape only
+    bind new values.  Unlike match(), the predicate doesn't record positional
+    ('$') state; use match() when an update needs it.
+    '''
+    args = []
+    shape = _query_shape(spec, args)
+    try:
+        bind = _query_cache[shape]
+    except KeyError:
+        if len(_query_cache) >= _QUERY_CACHE_SIZE:
+            _query_cache.clear()
+        bind = _query_cache[shape] = _build_query(shape)
+    return bind(iter(args))
+
+_query_cache = {}
+_QUERY_CACHE_SIZE = 1000
+
+def _is_cond(v):
+    return isinstance(v, dict) and all(k.startswith('$') for k in v.keys())
+
+def _query_shape(spec, args):
+    '''Shape of a query: a tuple of ('$or'|'$and', branch shapes) and
+    (path, condition shape) clauses.  Values are appended to args in the
+    order _build_query consumes them.'''
+    clauses = []
+    for key in sorted(spec):
+        value = spec[key]
+        if key in ('$or', '$and'):
+            clauses.append((key, tuple(
+                        _query_shape(branch, args) for branch in value)))
+        elif _is_cond(value):
+            clauses.append((key, _cond_shape(value, args)))
+        else:
+            args.append(value)
+            clauses.append((key, ('$eq',)))
+    return tuple(clauses)
+
+def _cond_shape(cond, args):
+    ops = []
+    for op in sorted(cond):
+        value = cond[op]
+        if op == '$elemMatch':
+            if _is_cond(value) and '$or' not in value and '$and' not in value:
+                ops.append((op, 'cond', _cond_shape(value, args)))
+            else:
+                ops.append((op, 'query', _query_shape(value, args)))
+        else:
+            args.append(value)
+            ops.append(op)
+    return tuple(ops)
+
+def _build_query(shape):
+    builders = [ _build_clause(key, cond) for key, cond in shape ]
+    def bind(args):
+        preds = [ b(args) for b in builders ]
+        if not preds: return lambda doc: True
+        if len(preds) == 1: return preds[0]
+        def predicate(doc):
+            for pred in preds:
+                if not pred(doc): return False
+            return True
+        return predicate
+    return bind
+
+def _build_clause(key, cond):
+    if key == '$or':
+        branches = [ _build_query(branch) for branch in cond ]
+        def bind(args):
+            preds = [ b(args) for b in branches ]
+            return lambda doc: any(pred(doc) for pred in preds)
+        return bind
+    elif key == '$and':
+        branches = [ _build_query(branch) for branch in cond ]
+        def bind(args):
+            preds = [ b(args) for b in branches ]
+            return lambda doc: all(pred(doc) for pred in preds)
+        return bind
+    getter = _path_getter(key)
+    bind_cond = _build_cond(cond)
+    def bind(args):
+        test = bind_cond(args)
+        return lambda doc: test(getter(doc))
+    return bind
+
+def _path_getter(path):
+    '''Returns a function resolving path in a document to the list of values
+    it reaches, descending into arrays of subdocuments along the way.  Missing
+    values are represented by ().'''
+    parts = path.split('.')
+    if len(parts) == 1:
+        key = parts[0]
+        return lambda doc: [ doc.get(key, ()) ]
+    def getter(doc):
+        values = [ doc ]
+        for part in parts:
+            found = []
+            for value in values:
+                if isinstance(value, dict):
+                    found.append(value.get(part, ()))
+                elif isinstance(value, list):
+                    if part.isdigit() and int(part) < len(value):
+                        found.append(value[int(part)])
+                    found.extend(
+                        ele.get(part, ()) for ele in value
+                        if isinstance(ele, dict))
+                else:
+                    found.append(())
+            values = found
+        return values
+    return getter
+
+def _build_cond(cond):
+    '''Returns bind(args) -> test(values), where values is the result of a
+    _path_getter and test is true if every operator in cond is satisfied'''
+    builders = []
+    for op in cond:
+        if isinstance(op, tuple):
+            builders.append(_build_elem_match(*op[1:]))
+        else:
+            try:
+                builders.append(_cond_ops[op])
+            except KeyError:
+                raise NotImplementedError, op
+    def bind(args):
+        tests = [ b(args) for b in builders ]
+        if len(tests) == 1: return tests[0]
+        def test(values):
+            for t in tests:
+                if not t(values): return False
+            return True
+        return test
+    return bind
+
+def _any_value(value_test):
+    '''Lift a test on a single value to a test on a list of resolved values,
+    where an array satisfies the test if it or any of its elements does'''
+    def test(values):
+        for v in values:
+            if isinstance(v, list):
+                for ele in v:
+                    if value_test(ele): return True
+            if value_test(v): return True
+        return False
+    return test
+
+def _eq_test(value):
+    if isinstance(value, _RE_TYPE):
+        search = value.search
+        return lambda v: isinstance(v, basestring) and search(v) is not None
+    bvalue = BsonArith.to_bson(value)
+    tp = type(value)
+    to_bson = BsonArith.to_bson
+    def test(v):
+        if type(v) is tp: return v == value
+        return v is not () and to_bson(v) == bvalue
+    return test
+
+def _cmp_test(compare):
+    def bind(args):
+        bvalue = BsonArith.to_bson(args.next())
+        to_bson = BsonArith.to_bson
+        return _any_value(lambda v: compare(to_bson(v), bvalue))
+    return bind
+
+def _bind_eq(args):
+    return _any_value(_eq_test(args.next()))
+
+def _bind_ne(args):
+    test = _any_value(_eq_test(args.next()))
+    return lambda values: not test(values)
+
+def _bind_in(args):
+    tests = [ _eq_test(v) for v in args.next() ]
+    return _any_value(lambda v: any(t(v) for t in tests))
+
+def _bind_nin(args):
+    test = _bind_in(args)
+    return lambda values: not test(values)
+
+def _bind_all(args):
+    tests = [ _any_value(_eq_test(v)) for v in args.next() ]
+    return lambda values: all(t(values) for t in tests)
+
+def _bind_exists(args):
+    if args.next():
+        return lambda values: any(v is not () for v in values)
+    return lambda values: all(v is () for v in values)
+
+_cond_ops = {
+    '$eq': _bind_eq,
+    '$ne': _bind_ne,
+    '$gt': _cmp_test(lambda a, b: a > b),
+    '$gte': _cmp_test(lambda a, b: a >= b),
+    '$lt': _cmp_test(lambda a, b: a < b),
+    '$lte': _cmp_test(lambda a, b: a <= b),
+    '$in': _bind_in,
+    '$nin': _bind_nin,
+    '$all': _bind_all,
+    '$exists': _bind_exists,
+    }
+
+def _build_elem_match(kind, shape):
+    if kind == 'cond':
+        bind_elem = _build_cond(shape)
+        def bind(args):
+            elem_test = bind_elem(args)
+            return lambda ele: elem_test([ele])
+    else:
+        bind_query = _build_query(shape)
+        def bind(args):
+            pred = bind_query(args)
+            return lambda ele: isinstance(ele, dict) and pred(ele)
+    def bind_values(args):
+        elem_pred = bind(args)
+        def test(values):
+            for v in values:
+                if isinstance(v, list) and any(elem_pred(ele) for ele in v):
+                    return True
+            return False
+        return test
+    return bind_values
+
+def _compile_element(spec):
+    '''Predicate on a single array element, as used by $pull: spec is either
+    a condition ({'$gt': 1}) or a query on subdocuments ({'a': 1})'''
+    if _is_cond(spec):
+        args = []
+        test = _build_cond(_cond_shape(spec, args))(iter(args))
+        return lambda ele: test([ele])
+    pred = compile_query(spec)
+    return lambda ele: isinstance(ele, dict) and pred(ele)
+
+def _chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk: return
+        yield chunk
+
+def _map_chunk((map, reduce, docs)):
+    '''(documents, pairs emitted, reduced (key, value) pairs) for a chunk
+    of a Python map/reduce.  Module-level so that pools can pickle it.'''
+    groups = {}
+    n_emit = 0
+    for doc in docs:
+        for key, value in map(doc):
+            n_emit += 1
+            bkey = BsonArith.to_bson(key)
+            group = groups.setdefault((bkey[0], _hashable(bkey[1])), (key, []))
+            group[1].append(value)
+    pairs = [
+        (key, reduce(key, values) if len(values) > 1 else values[0])
+        for key, values in groups.itervalues() ]
+    return len(docs), n_emit, pairs
+
+def _compile_pipeline(pipeline):
+    '''[ (stage name, compiled argument) ] for an aggregation pipeline'''
+    result = []
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise OperationFailure(
+                'A pipeline stage specification object must contain '
+                'exactly one field.')
+        (name, arg), = stage.items()
+        if name == '$sort':
+            arg = arg.items()
+        elif name in _PIPELINE_COMPILERS:
+            arg = _PIPELINE_COMPILERS[name](arg)
+        elif name not in _PIPELINE_STAGES:
+            raise OperationFailure(
+                'Unrecognized pipeline stage name: %r' % name)
+        result.append((name, arg))
+    return result
+
+def _pipeline_top(stages):
+    '''How many documents the stages following a \$sort can use, if they
+    start with \$skip and \$limit'''
+    skip = 0
+    for name, arg in stages:
+        if name == '$skip':
+            skip += arg
+        elif name == '$limit':
+            return skip + arg
+        else:
+            return None
+    return None
+
+def _stage_match(docs, spec):
+    return itertools.ifilter(compile_query(spec), docs)
+
+def _stage_project(docs, project):
+    return itertools.imap(project, docs)
+
+def _stage_skip(docs, skip):
+    return itertools.islice(docs, skip, None)
+
+def _stage_limit(docs, limit):
+    return itertools.islice(docs, limit)
+
+def _stage_unwind(docs, arg):
+    path, include_index, preserve = arg
+    parts = path.split('.')
+    for doc in docs:
+        values = _field_value(doc, parts)
+        if isinstance(values, list) and values:
+            for i, value in enumerate(values):
+                result = _replace_path(doc, parts, value)
+                if include_index:
+                    result[include_index] = i
+                yield result
+        elif values is () or values is None or values == []:
+            if preserve:
+                if include_index:
+                    doc = dict(doc)
+                    doc[include_index] = None
+                yield doc
+        else:
+            if include_index:
+                doc = dict(doc)
+                doc[include_index] = None
+            yield doc
+
+def _stage_group(docs, arg):
+    key_expr, fields = arg
+    groups = {}
+    for doc in docs:
+        value = _or_null(key_expr(doc))
+        bvalue = BsonArith.to_bson(value)
+        key = (bvalue[0], _hashable(bvalue[1]))
+        group = groups.get(key)
+        if group is None:
+            group = groups[key] = (value, [ acc() for name, acc, expr in fields ])
+        for (name, acc, expr), state in zip(fields, group[1]):
+            state.add(expr(doc))
+    for value, states in groups.itervalues():
+        result = { '_id': value }
+        for (name, acc, expr), state in zip(fields, states):
+            result[name] = state.result()
+        yield result
+
+_PIPELINE_STAGES = {
+    '$match': _stage_match,
+    '$project': _stage_project,
+    '$skip': _stage_skip,
+    '$limit': _stage_limit,
+    '$unwind': _stage_unwind,
+    '$group': _stage_group,
+    '$sort': None,
+    }
+
+def _compile_unwind(arg):
+    if isinstance(arg, dict):
+        path = arg['path']
+        include_index = arg.get('includeArrayIndex')
+        preserve = arg.get('preserveNullAndEmptyArrays', False)
+    else:
+        path, include_index, preserve = arg, None, False
+    if not isinstance(path, basestring) or not path.startswith('$'):
+        raise OperationFailure(
+            '\$unwind field path must be prefixed by a \$: %r' % path)
+    return path[1:], include_index, preserve
+
+def _compile_group(arg):
+    if '_id' not in arg:
+        raise OperationFailure('a group specification must include an _id')
+    fields = []
+    for name, spec in arg.iteritems():
+        if name == '_id': continue
+        if not isinstance(spec, dict) or len(spec) != 1:
+            raise OperationFailure(
+                'the group aggregate field %r must be defined as an '
+                'expression inside an object' % name)
+        (op, expr), = spec.items()
+        if op not in _ACCUMULATORS:
+            raise OperationFailure('unknown group operator %r' % op)
+        fields.append((name, _ACCUMULATORS[op], _compile_expr(expr)))
+    return _compile_expr(arg['_id']), fields
+
+def _compile_project(spec):
+    include_id = True
+    inclusions, exclusions, computed = [], [], []
+    for key, value in _flatten_projection(spec, ''):
+        if key == '_id' and _is_flag(value):
+            include_id = bool(value)
+        elif _is_flag(value) and value:
+            inclusions.append(key.split('.'))
+        elif _is_flag(value):
+            exclusions.append(key.split('.'))
+        else:
+            computed.append((key.split('.'), _compile_expr(value)))
+    if exclusions:
+        if inclusions or computed:
+            raise OperationFailure(
+                'Cannot mix inclusion and exclusion in a \$project')
+        if not include_id:
+            exclusions.append(['_id'])
+        def project(doc):
+            for parts in exclusions:
+                doc = _exclude_path(doc, parts)
+            return doc
+        return project
+    if not (include_id or inclusions or computed):
+        raise OperationFailure('\$project requires at least one output field')
+    def project(doc):
+        result = {}
+        if include_id and '_id' in doc:
+            result['_id'] = doc['_id']
+        for parts in inclusions:
+            _include_path(doc, result, parts)
+        for parts, expr in computed:
+            value = expr(doc)
+            if value is not ():
+                _set_path(result, parts, value)
+        return result
+    return project
+
+def _flatten_projection(spec, prefix):
+    for key, value in spec.iteritems():
+        if isinstance(value, dict) and not _is_operator(value):
+            for item in _flatten_projection(value, prefix + key + '.'):
+                yield item
+        else:
+            yield prefix + key, value
+
+def _is_flag(value):
+    return type(value) in (bool, int, long, float)
+
+def _is_operator(expr):
+    return len(expr) == 1 and expr.keys()[0].startswith('$')
+
+_PIPELINE_COMPILERS = {
+    '$project': _compile_project,
+    '$unwind': _compile_unwind,
+    '$group': _compile_group,
+    }
+
+def _field_value(doc, parts):
+    '''The value at a dotted path, as an aggregation field path sees it:
+    arrays of subdocuments give arrays of their fields'''
+    value = doc
+    for part in parts:
+        if isinstance(value, dict):
+            value = value.get(part, ())
+        elif isinstance(value, list):
+            value = [ v[part] for v in value
+                      if isinstance(v, dict) and part in v ]
+        else:
+            return ()
+        if value is (): return ()
+    return value
+
+def _replace_path(doc, parts, value):
+    result = dict(doc)
+    if len(parts) == 1:
+        result[parts[0]] = value
+    else:
+        result[parts[0]] = _replace_path(doc[parts[0]], parts[1:], value)
+    return result
+
+def _set_path(doc, parts, value):
+    for part in parts[:-1]:
+        sub = doc.get(part)
+        if not isinstance(sub, dict):
+            sub = doc[part] = {}
+        doc = sub
+    doc[parts[-1]] = value
+
+def _include_path(src, dst, parts):
+    head = parts[0]
+    if head not in src: return
+    value = src[head]
+    if len(parts) == 1:
+        dst[head] = value
+    elif isinstance(value, dict):
+        sub = dst.get(head)
+        if not isinstance(sub, dict):
+            sub = dst[head] = {}
+        _include_path(value, sub, parts[1:])
+    elif isinstance(value, list):
+        value = [ v for v in value if isinstance(v, dict) ]
+        subs = dst.get(head)
+        if not isinstance(subs, list):
+            subs = dst[head] = [ {} for v in value ]
+        for v, sub in zip(value, subs):
+            _include_path(v, sub, parts[1:])
+
+def _exclude_path(doc, parts):
+    head = parts[0]
+    if head not in doc: return doc
+    result = dict(doc)
+    if len(parts) == 1:
+        del result[head]
+    elif isinstance(doc[head], dict):
+        result[head] = _exclude_path(doc[head], parts[1:])
+    elif isinstance(doc[head], list):
+        result[head] = [
+            _exclude_path(v, parts[1:]) if isinstance(v, dict) else v
+            for v in doc[head] ]
+    return result
+
+def _compile_expr(expr):
+    '''A function evaluating aggregation expression expr against a
+    document, returning () where the result is missing'''
+    if isinstance(expr, basestring):
+        if expr in ('$$ROOT', '$$CURRENT'):
+            return _identity
+        for var in ('$$ROOT.', '$$CURRENT.'):
+            if expr.startswith(var):
+                expr = '$' + expr[len(var):]
+        if expr.startswith('$$'):
+            raise OperationFailure('Unsupported variable %s' % expr)
+        if expr.startswith('$'):
+            parts = expr[1:].split('.')
+            return lambda doc: _field_value(doc, parts)
+        return lambda doc: expr
+    elif isinstance(expr, dict):
+        if _is_operator(expr):
+            (op, args), = expr.items()
+            if op == '$literal':
+                return lambda doc: args
+            if op == '$cond' and isinstance(args, dict):
+                args = [ args['if'], args['then'], args['else'] ]
+            if op not in _EXPR_OPS:
+                raise OperationFailure('Unrecognized expression %r' % op)
+            if not isinstance(args, list):
+                args = [ args ]
+            return _EXPR_OPS[op](map(_compile_expr, args))
+        fields = [ (k, _compile_expr(v)) for k, v in expr.iteritems() ]
+        def evaluate(doc):
+            result = {}
+            for k, f in fields:
+                value = f(doc)
+                if value is not (): result[k] = value
+            return result
+        return evaluate
+    elif isinstance(expr, list):
+        items = map(_compile_expr, expr)
+        return lambda doc: [ _or_null(f(doc)) for f in items ]
+    return lambda doc: expr
+
+def _or_null(value):
+    if value is (): return None
+    return value
+
+def _truthy(value):
+    if value is () or value is None or value is False: return False
+    if type(value) in (int, long, float): return value != 0
+    return True
+
+def _expr_op(func):
+    '''An expression operator applying func to its arguments' values,
+    with missing values read as null'''
+    def build(args):
+        def evaluate(doc):
+            return func(*[ _or_null(f(doc)) for f in args ])
+        return evaluate
+    return build
+
+def _null_propagating(func):
+    def apply(*values):
+        if None in values: return None
+        return func(*values)
+    return apply
+
+def _expr_add(*values):
+    if None in values: return None
+    dates = [ v for v in values if isinstance(v, datetime) ]
+    numbers = [ v for v in values if not isinstance(v, datetime) ]
+    if len(dates) > 1:
+        raise OperationFailure('only one date allowed in an \$add expression')
+    total = sum(numbers)
+    if dates:
+        return dates[0] + timedelta(milliseconds=total)
+    return total
+
+def _expr_subtract(a, b):
+    if a is None or b is None: return None
+    if isinstance(a, datetime) and isinstance(b, datetime):
+        delta = a - b
+        return (delta.days * 86400000 + delta.seconds * 1000
+                + delta.microseconds // 1000)
+    if isinstance(a, datetime):
+        return a - timedelta(milliseconds=b)
+    return a - b
+
+def _expr_divide(a, b):
+    if a is None or b is None: return None
+    if b == 0:
+        raise OperationFailure("can't \$divide by zero")
+    return float(a) / b
+
+def _expr_mod(a, b):
+    if a is None or b is None: return None
+    if b == 0:
+        raise OperationFailure("can't \$mod by zero")
+    return math.fmod(a, b) if float in (type(a), type(b)) else int(math.fmod(a, b))
+
+def _expr_multiply(*values):
+    if None in values: return None
+    return reduce(operator.mul, values, 1)
+
+def _expr_string(value):
+    if value is None: return ''
+    if isinstance(value, basestring): return value
+    return unicode(value)
+
+def _expr_substr(value, start, length):
+    value = _expr_string(value)
+    if length < 0: return value[start:]
+    return value[start:start + length]
+
+def _expr_cond(args):
+    test, then, otherwise = args
+    def evaluate(doc):
+        if _truthy(test(doc)): return then(doc)
+        return otherwise(doc)
+    return evaluate
+
+def _expr_if_null(args):
+    value, replacement = args
+    def evaluate(doc):
+        result = value(doc)
+        if result is () or result is None: return replacement(doc)
+        return result
+    return evaluate
+
+def _expr_size(value):
+    if not isinstance(value, list):
+        raise OperationFailure('The argument to \$size must be an array')
+    return len(value)
+
+def _expr_date(func):
+    def apply(value):
+        if value is None: return None
+        if not isinstance(value, datetime):
+            raise OperationFailure(
+                "can't convert from BSON type %s to Date"
+                % type(value).__name__)
+        return func(value)
+    return _expr_op(apply)
+
+def _expr_compare(test):
+    return _expr_op(lambda a, b: test(BsonArith.cmp(a, b)))
+
+_EXPR_OPS = {
+    '$add': _expr_op(_expr_add),
+    '$subtract': _expr_op(_expr_subtract),
+    '$multiply': _expr_op(_expr_multiply),
+    '$divide': _expr_op(_expr_divide),
+    '$mod': _expr_op(_expr_mod),
+    '$concat': _expr_op(_null_propagating(lambda *v: u''.join(v))),
+    '$toLower': _expr_op(lambda v: _expr_string(v).lower()),
+    '$toUpper': _expr_op(lambda v: _expr_string(v).upper()),
+    '$substr': _expr_op(_expr_substr),
+    '$strcasecmp': _expr_op(lambda a, b: cmp(
+            _expr_string(a).upper(), _expr_string(b).upper())),
+    '$cmp': _expr_compare(lambda c: c),
+    '$eq': _expr_compare(lambda c: c == 0),
+    '$ne': _expr_compare(lambda c: c != 0),
+    '$gt': _expr_compare(lambda c: c > 0),
+    '$gte': _expr_compare(lambda c: c >= 0),
+    '$lt': _expr_compare(lambda c: c < 0),
+    '$lte': _expr_compare(lambda c: c <= 0),
+    '$and': _expr_op(lambda *v: all(map(_truthy, v))),
+    '$or': _expr_op(lambda *v: any(map(_truthy, v))),
+    '$not': _expr_op(lambda v: not _truthy(v)),
+    '$cond': _expr_cond,
+    '$ifNull': _expr_if_null,
+    '$size': _expr_op(_expr_size),
+    '$year': _expr_date(lambda d: d.year),
+    '$month': _expr_date(lambda d: d.month),
+    '$dayOfMonth': _expr_date(lambda d: d.day),
+    '$dayOfWeek': _expr_date(lambda d: d.isoweekday() % 7 + 1),
+    '$dayOfYear': _expr_date(lambda d: d.timetuple().tm_yday),
+    '$hour': _expr_date(lambda d: d.hour),
+    '$minute': _expr_date(lambda d: d.minute),
+    '$second': _expr_date(lambda d: d.second),
+    '$millisecond': _expr_date(lambda d: d.microsecond // 1000),
+    }
+
+class _Sum(object):
+
+    def __init__(self):
+        self.total = 0
+
+    def add(self, value):
+        if type(value) in (int, long, float):
+            self.total += value
+
+    def result(self):
+        return self.total
+
+class _Avg(object):
+
+    def __init__(self):
+        self.total = self.count = 0
+
+    def add(self, value):
+        if type(value) in (int, long, float):
+            self.total += value
+            self.count += 1
+
+    def result(self):
+        if not self.count: return None
+        return float(self.total) / self.count
+
+class _Min(object):
+    _sign = 1
+
+    def __init__(self):
+        self.value = ()
+
+    def add(self, value):
+        if value is () or value is None: return
+        if self.value is () or BsonArith.cmp(value, self.value) * self._sign < 0:
+            self.value = value
+
+    def result(self):
+        return _or_null(self.value)
+
+class _Max(_Min):
+    _sign = -1
+
+class _First(object):
+
+    def __init__(self):
+        self.value = _MISSING
+
+    def add(self, value):
+        if self.value is _MISSING:
+            self.value = _or_null(value)
+
+    def result(self):
+        if self.value is _MISSING: return None
+        return self.value
+
+class _Last(_First):
+
+    def add(self, value):
+        self.value = _or_null(value)
+
+class _Push(object):
+
+    def __init__(self):
+        self.values = []
+
+    def add(self, value):
+        if value is not ():
+            self.values.append(value)
+
+    def result(self):
+        return self.values
+
+class _AddToSet(_Push):
+
+    def __init__(self):
+        _Push.__init__(self)
+        self.seen = set()
+
+    def add(self, value):
+        if value is (): return
+        bvalue = BsonArith.to_bson(value)
+        key = (bvalue[0], _hashable(bvalue[1]))
+        if key in self.seen: return
+        self.seen.add(key)
+        self.values.append(value)
+
+_ACCUMULATORS = {
+    '$sum': _Sum,
+    '$avg': _Avg,
+    '$min': _Min,
+    '$max': _Max,
+    '$first': _First,
+    '$last': _Last,
+    '$push': _Push,
+    '$addToSet': _AddToSet,
+    }
+
 def _part_match(op, value, key_parts, doc, allow_list_compare=True):
     if not key_parts:
         return compare(op, doc, value)
@@ -939,8 +4059,18 @@ def compare(op, a, b):
         return match(b, a)
     raise NotImplementedError, op
         
+def _is_positional(updates):
+    '''True if updates refer to the positional ('$') array element'''
+    for op, update_parts in updates.iteritems():
+        if not op.startswith('$'): return False
+        for k in update_parts:
+            if '$' in k: return True
+    return False
+
 def validate(doc):
-    for k,v in doc.iteritems():
+    # dict's own iteritems, so a CowDict isn't thawed just to be checked
+    items = dict.iteritems(doc) if isinstance(doc, dict) else doc.iteritems()
+    for k,v in items:
         assert '$' not in k
         assert '.' not in k
         if hasattr(v, 'iteritems'):
@@ -957,6 +4087,225 @@ def bcopy(obj):
     else:
         return obj
         
+def _normalize_fields(fields):
+    if isinstance(fields, list):
+        fields = dict((f, 1) for f in fields)
+    if fields is not None and '_id' not in fields:
+        f = { '_id': 1 }
+        f.update(fields)
+        fields = f
+    return fields
+
+def _copy_out(value, fields, as_class):
+    '''A copy of stored document value, as returned to callers'''
+    if isinstance(value, FrozenDict):
+        value = thaw(value)
+    else:
+        value = bcopy(value)
+    if fields:
+        value = _project(value, fields)
+    if as_class is dict:
+        return value
+    return wrap_as_class(value, as_class)
+
+_FIND_ONE_KWARGS = frozenset([ 'fields', 'as_class', 'sort', 'limit', 'skip' ])
+
+def _identity(obj):
+    return obj
+
+def freeze(obj):
+    '''An immutable deep copy of document obj, normalized the way a BSON
+    round trip would be.  Parts of obj that are already frozen are shared,
+    not copied.  Values whose types aren't known to be BSON-safe are checked
+    by encoding them, so freeze() also validates obj.'''
+    tp = type(obj)
+    if tp is FrozenDict or tp is FrozenList:
+        return obj
+    elif isinstance(obj, dict):
+        for k in obj:
+            if type(k) not in _KEY_TYPES:
+                bson_safe({k: None})
+        # dict's and list's own iteration, which a CowDict or CowList
+        # doesn't override: the frozen parts it never thawed are reused
+        return FrozenDict([
+                (k, v if type(v) in _SCALAR_TYPES else freeze(v))
+                for k, v in dict.iteritems(obj) ])
+    elif isinstance(obj, list):
+        return FrozenList([
+                v if type(v) in _SCALAR_TYPES else freeze(v)
+                for v in list.__iter__(obj) ])
+    elif isinstance(obj, tuple):
+        return FrozenList([
+                v if type(v) in _SCALAR_TYPES else freeze(v)
+                for v in obj ])
+    elif isinstance(obj, datetime):
+        if obj.utcoffset() is not None:
+            obj = obj.replace(tzinfo=None) - obj.utcoffset()
+        return obj.replace(microsecond=obj.microsecond // 1000 * 1000)
+    elif tp not in _SCALAR_TYPES:
+        bson_safe({'v': obj})
+    return obj
+
+_KEY_TYPES = frozenset([ str, unicode ])
+_SCALAR_TYPES = frozenset([
+        int, long, float, str, unicode, bool, type(None),
+        bson.ObjectId, bson.Binary, bson.Code, bson.Timestamp,
+        bson.MinKey, bson.MaxKey, _RE_TYPE ])
+
+def _immutable(self, *args, **kwargs):
+    raise TypeError('%s is immutable' % type(self).__name__)
+
+class FrozenDict(dict):
+    '''A stored document (or subdocument) in a copy-on-write collection'''
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = \
+        _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+class FrozenList(list):
+    '''A stored array in a copy-on-write collection'''
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = __iadd__ = \
+        __imul__ = append = extend = insert = pop = remove = reverse = sort = \
+        _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (FrozenList, (list(self),))
+
+def thaw(obj):
+    '''A mutable copy of frozen document obj, made of plain dicts and
+    lists.  Only the containers are copied; their values are shared.'''
+    tp = type(obj)
+    if tp is FrozenDict:
+        copy = dict(obj)
+        items = dict.iteritems(obj)
+    elif tp is FrozenList:
+        copy = list(obj)
+        items = enumerate(copy)
+    else:
+        return obj
+    for k, v in items:
+        tv = type(v)
+        if tv is FrozenDict or tv is FrozenList:
+            copy[k] = thaw(v)
+    return copy
+
+def _thaw(value):
+    tp = type(value)
+    if tp is FrozenDict: return CowDict(value)
+    if tp is FrozenList: return CowList(value)
+    return value
+
+class CowDict(dict):
+    '''A mutable view of a FrozenDict, as updates apply their operators to.
+    Creating one copies only the top level; frozen subdocuments and arrays
+    are replaced by views of their own the first time they're read, so an
+    update only copies the paths it touches.  Not for handing out: dict()
+    copies a dict subclass's values without calling __getitem__, so a copy
+    of one would hold frozen values.'''
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        tp = type(value)
+        if tp is FrozenDict or tp is FrozenList:
+            value = _thaw(value)
+            dict.__setitem__(self, key, value)
+        return value
+
+    def _thaw_all(self):
+        for k, v in dict.iteritems(self):
+            tp = type(v)
+            if tp is FrozenDict or tp is FrozenList:
+                dict.__setitem__(self, k, _thaw(v))
+
+    def get(self, key, default=None):
+        if key in self: return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self: return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+
+    def pop(self, key, *args):
+        return _thaw(dict.pop(self, key, *args))
+
+    def popitem(self):
+        k, v = dict.popitem(self)
+        return k, _thaw(v)
+
+    def copy(self):
+        return CowDict(self)
+
+    def _thawing(name):
+        method = getattr(dict, name)
+        def thawing(self, *args):
+            self._thaw_all()
+            return method(self, *args)
+        thawing.__name__ = name
+        return thawing
+
+    values = _thawing('values')
+    itervalues = _thawing('itervalues')
+    viewvalues = _thawing('viewvalues')
+    items = _thawing('items')
+    iteritems = _thawing('iteritems')
+    viewitems = _thawing('viewitems')
+    del _thawing
+
+class CowList(list):
+    '''A mutable view of a FrozenList; see CowDict'''
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            self._thaw_all()
+            return list.__getitem__(self, index)
+        value = list.__getitem__(self, index)
+        tp = type(value)
+        if tp is FrozenDict or tp is FrozenList:
+            value = _thaw(value)
+            list.__setitem__(self, index, value)
+        return value
+
+    def _thaw_all(self):
+        for i, v in enumerate(list.__iter__(self)):
+            tp = type(v)
+            if tp is FrozenDict or tp is FrozenList:
+                list.__setitem__(self, i, _thaw(v))
+
+    def __getslice__(self, i, j):
+        self._thaw_all()
+        return list.__getslice__(self, i, j)
+
+    def pop(self, *args):
+        return _thaw(list.pop(self, *args))
+
+    def _thawing(name):
+        method = getattr(list, name)
+        def thawing(self, *args):
+            self._thaw_all()
+            return method(self, *args)
+        thawing.__name__ = name
+        return thawing
+
+    __iter__ = _thawing('__iter__')
+    __reversed__ = _thawing('__reversed__')
+    __add__ = _thawing('__add__')
+    __mul__ = _thawing('__mul__')
+    del _thawing
+
 def wrap_as_class(value, as_class):
     if isinstance(value, dict):
         return as_class(dict(
@@ -983,6 +4332,207 @@ def _project(doc, fields):
         sub_result[key] = sub_doc[key]
     return result
 
+_DUMP_MAGIC = 'MIMDUMP\x01'
+_DUMP_TRAILER = struct.Struct('<q')
+_BSON_LENGTH = struct.Struct('<i')
+
+def _dump(databases, filename):
+    '''Write databases to filename as their documents' BSON back to back,
+    then a table of (_id, offset) and the index entries for each
+    collection, then a catalog of databases, collections and index
+    definitions, then the catalog's offset.  The file is written aside and
+    renamed into place, since a previous dump may still be mapped.'''
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'wb') as fp:
+        fp.write(_DUMP_MAGIC)
+        catalog = []
+        for db in databases:
+            colls = []
+            for coll in db._collections.values():
+                with coll._lock.reading:
+                    colls.append(_dump_collection(fp, coll))
+            catalog.append(dict(name=db.name, collections=colls))
+        offset = fp.tell()
+        fp.write(bson.BSON.encode(dict(databases=catalog)))
+        fp.write(_DUMP_TRAILER.pack(offset))
+    try:
+        os.rename(tmpname, filename)
+    except OSError:
+        # Windows won't rename over an existing file
+        os.remove(filename)
+        os.rename(tmpname, filename)
+
+def _dump_collection(fp, coll):
+    ids, offsets, noid, unkeyed = [], [], None, []
+    data = coll._data
+    if coll._capped is not None:
+        # in natural order, which load() keeps
+        items = ((key, bson.BSON.encode(data[key]))
+                 for key in coll._capped.keys())
+    elif isinstance(data, _MappedDocuments):
+        items = data.iterencoded()
+    else:
+        items = ((_id, bson.BSON.encode(doc)) for _id, doc in data.iteritems())
+    for _id, encoded in items:
+        if _id is ():
+            noid = fp.tell()
+        else:
+            if type(_id) is _Unkeyed:
+                unkeyed.append(len(ids))
+                _id = None
+            ids.append(_id)
+            offsets.append(fp.tell())
+        fp.write(encoded)
+    table = fp.tell()
+    fp.write(bson.BSON.encode(dict(
+                ids=ids, offsets=offsets, noid=noid, unkeyed=unkeyed)))
+    if '_indexes' in coll.__dict__:
+        indexes = []
+        for index in coll._indexes.itervalues():
+            entries = fp.tell()
+            fp.write(bson.BSON.encode(index.dump()))
+            indexes.append(dict(
+                    name=index.name, fields=list(index.fields),
+                    directions=list(index.directions),
+                    unique=index.unique, sparse=index.sparse,
+                    expireAfterSeconds=index.expire_after,
+                    multikey=index.multikey, entries=entries))
+    else:
+        # Restored by load() and not used since: copy the entries as dumped
+        buf, indexes = coll._snapshot.buf, []
+        for info in coll._snapshot.indexes:
+            info = dict(info)
+            if info.get('entries') is not None:
+                offset = info['entries']
+                size, = _BSON_LENGTH.unpack_from(buf, offset)
+                info['entries'] = fp.tell()
+                fp.write(buf[offset:offset + size])
+            indexes.append(info)
+    return dict(name=coll.name, table=table, indexes=indexes,
+                options=coll._options)
+
+def _load(filename):
+    '''{database name: {collection name: _CollectionSnapshot}} for the
+    databases dumped to filename'''
+    with open(filename, 'rb') as fp:
+        buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    if buf[:len(_DUMP_MAGIC)] != _DUMP_MAGIC:
+        raise ValueError, '%s is not a mim dump' % filename
+    offset, = _DUMP_TRAILER.unpack_from(buf, len(buf) - _DUMP_TRAILER.size)
+    catalog = _decode_at(buf, offset)
+    return dict(
+        (db['name'], dict(
+                (coll['name'], _CollectionSnapshot(
+                        buf, coll['table'], coll['indexes'],
+                        coll.get('options', {})))
+                for coll in db['collections']))
+        for db in catalog['databases'])
+
+def _decode_at(buf, offset):
+    size, = _BSON_LENGTH.unpack_from(buf, offset)
+    return bson.BSON(buf[offset:offset + size]).decode()
+
+class _CollectionSnapshot(object):
+    '''A collection in a mapped dump'''
+
+    def __init__(self, buf, table, indexes, options):
+        self.buf = buf
+        self.table = table
+        self.indexes = indexes
+        self.options = options
+        self.natural = None
+
+    def documents(self, copy_on_write):
+        '''The documents as a collection's _data.  For a capped collection
+        this also sets natural, its (key, BSON size) pairs in natural order.'''
+        table = _decode_at(self.buf, self.table)
+        ids, offsets = table['ids'], table['offsets']
+        for i in table.get('unkeyed', ()):
+            ids[i] = _Unkeyed()
+        if self.options.get('capped'):
+            self.natural = [
+                (_id, _BSON_LENGTH.unpack_from(self.buf, offset)[0])
+                for _id, offset in itertools.izip(ids, offsets) ]
+        result = _MappedDocuments(
+            self.buf, itertools.izip(ids, offsets), copy_on_write)
+        if table['noid'] is not None:
+            dict.__setitem__(result, (), table['noid'])
+        return result
+
+class _MappedDocuments(dict):
+    '''A collection's _data as restored by load(): each value is left as
+    an offset into the mapped dump until it is first read'''
+
+    def __init__(self, buf, items, copy_on_write):
+        dict.__init__(self, items)
+        self._buf = buf
+        self._copy_on_write = copy_on_write
+
+    def _decode(self, key, offset):
+        doc = _decode_at(self._buf, offset)
+        if self._copy_on_write:
+            doc = freeze(doc)
+        dict.__setitem__(self, key, doc)
+        return doc
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if type(value) in _OFFSET_TYPES:
+            value = self._decode(key, value)
+        return value
+
+    def get(self, key, default=None):
+        value = dict.get(self, key, default)
+        if type(value) in _OFFSET_TYPES and key in self:
+            value = self._decode(key, value)
+        return value
+
+    def iteritems(self):
+        for key, value in dict.iteritems(self):
+            if type(value) in _OFFSET_TYPES:
+                value = self._decode(key, value)
+            yield key, value
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def items(self):
+        return list(self.iteritems())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def pop(self, key, *args):
+        if key in self: self[key]
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        if type(value) in _OFFSET_TYPES:
+            value = self._decode(key, value)
+            dict.__delitem__(self, key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key in self: return self[key]
+        return dict.setdefault(self, key, default)
+
+    def copy(self):
+        return dict(self.iteritems())
+
+    def iterencoded(self):
+        '''(key, BSON) pairs, copying undecoded documents straight from
+        the mapped dump'''
+        for key, value in dict.iteritems(self):
+            if type(value) in _OFFSET_TYPES:
+                size, = _BSON_LENGTH.unpack_from(self._buf, value)
+                yield key, self._buf[value:value + size]
+            else:
+                yield key, bson.BSON.encode(value)
+
+_OFFSET_TYPES = set([int, long])
+
 class _DummyRequest(object):
 
     def __enter__(self):
@@ -994,3 +4544,93 @@ class _DummyRequest(object):
     def end(self):
         pass
 
+def _new_mutex(thread_safe):
+    if thread_safe:
+        return threading.RLock()
+    return _NULL_LOCK
+
+class _NullLock(object):
+    '''Stands in for a lock when thread safety isn't wanted'''
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+        return False
+
+_NULL_LOCK = _NullLock()
+
+class _NullRWLock(object):
+    reading = writing = _NULL_LOCK
+
+_NULL_RWLOCK = _NullRWLock()
+
+class _RWLock(object):
+    '''A reader/writer lock favouring writers.  Both sides are reentrant,
+    and the thread holding the write side may also take the read side.  A
+    reader may only upgrade to writing while it is the sole reader.'''
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}      # thread id => depth
+        self._writer = None
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self.reading = _LockSide(self.acquire_read, self.release_read)
+        self.writing = _LockSide(self.acquire_write, self.release_write)
+
+    def acquire_read(self):
+        me = thread.get_ident()
+        with self._cond:
+            depth = self._readers.get(me)
+            if depth is None and self._writer != me:
+                while self._writer is not None or self._writers_waiting:
+                    self._cond.wait()
+            self._readers[me] = (depth or 0) + 1
+
+    def release_read(self):
+        me = thread.get_ident()
+        with self._cond:
+            depth = self._readers.pop(me) - 1
+            if depth:
+                self._readers[me] = depth
+            else:
+                self._cond.notify_all()
+
+    def acquire_write(self):
+        me = thread.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._write_depth += 1
+                return
+            self._writers_waiting += 1
+            try:
+                while (self._writer is not None
+                       or len(self._readers) > (me in self._readers)):
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._write_depth = 1
+
+    def release_write(self):
+        with self._cond:
+            self._write_depth -= 1
+            if not self._write_depth:
+                self._writer = None
+                self._cond.notify_all()
+
+class _LockSide(object):
+    '''One side of an _RWLock, as a context manager'''
+
+    def __init__(self, acquire, release):
+        self._acquire = acquire
+        self._release = release
+
+    def __enter__(self):
+        self._acquire()
+        return self
+
+    def __exit__(self, ex_type, ex_value, ex_tb):
+        self._release()
+        return False
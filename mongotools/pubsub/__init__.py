@@ -1,2 +1,6 @@
 from .channel import Channel
 from .oplog import OplogTail
+from .mux import OplogMux
+from .dispatch import Dispatcher
+from .checkpoint import CollectionCheckpoint, FileCheckpoint
+from .loop import Loop
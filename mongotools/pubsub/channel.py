@@ -1,19 +1,25 @@
 import re
+import types
 import logging
-from collections import defaultdict
 
 from .oplog import OplogTail
+from .router import Router
 
 log = logging.getLogger(__name__)
 
 class Channel(object):
+    '''A capped collection used as a message channel.  Callbacks run on
+    the thread handling the messages, unless a Dispatcher is given to run
+    them on its workers instead.  A checkpoint keeps the channel's place
+    in the oplog across restarts (see OplogTail).'''
 
-    def __init__(self, db, name):
+    def __init__(self, db, name, dispatcher=None, checkpoint=None):
         self.db = db
         self.name = name
+        self.dispatcher = dispatcher
         self._collection_ns = '{}.{}'.format(self.db.name, self.name)
-        self._callbacks = defaultdict(list)
-        self._tail = OplogTail(db.connection)
+        self._router = Router()
+        self._tail = OplogTail(db.connection, checkpoint)
 
     def __repr__(self): # pragma no cover
         return '<Channel %s.%s>' % (
@@ -22,9 +28,9 @@ class Channel(object):
 
     def _spec(self):
         spec = {'ns': self._collection_ns, 'op': 'i'}
-        if self._callbacks:
-            regex = '|'.join(cb.pattern for cb in self._callbacks)
-            spec['o.k'] = re.compile(regex)
+        pattern = self._router.pattern()
+        if pattern is not None:
+            spec['o.k'] = re.compile(pattern)
         return spec
 
     def ensure_channel(self, capacity=2**15, message_size=1024):
@@ -37,10 +43,9 @@ class Channel(object):
                 autoIndexId=False)
 
     def sub(self, pattern, callback=None):
-        re_pattern = re.compile('^' + re.escape(pattern))
-        self._callbacks[re_pattern] # ensure key exists
+        self._router.add(pattern)
         def decorator(func):
-            self._callbacks[re_pattern].append(func)
+            self._router.add(pattern, func)
             return func
         if callback is None: return decorator
         return decorator(callback)
@@ -55,24 +60,68 @@ class Channel(object):
         return messages
 
     def handle_ready(self, raise_errors=False, await=False):
-        if not self._callbacks:
+        if not self._router:
             return
         spec = self._spec()
         for msg in self._tail.tail(spec, raise_errors=raise_errors, await=await):
-            msg_obj = msg['o']
-            to_call = []
-            for pattern, callbacks in self._callbacks.items():
-                if pattern.match(msg_obj['k']):
-                    to_call += callbacks
-            for cb in to_call:
-                try:
-                    cb(self, msg_obj)
-                except:
-                    if raise_errors:
-                        raise
-                    log.exception('Error in callback handling %r(%r)',
-                                  cb, msg)
+            self._dispatch(msg, raise_errors)
+
+    def poll(self, raise_errors=False, spawn=None):
+        '''Handle the messages ready now without blocking, reading them from
+        a tailable cursor kept open between calls.  Callbacks may be
+        generator functions: the generators they return are passed to
+        spawn (as a Loop does) rather than run to completion.  Returns the
+        number of messages handled.'''
+        if not self._router:
+            return 0
+        count = 0
+        for msg in self._tail.poll(self._spec(), raise_errors=raise_errors):
+            self._dispatch(msg, raise_errors, spawn)
+            count += 1
+        return count
+
+    def _dispatch(self, msg, raise_errors, spawn=None, tail=None):
+        '''Run the callbacks for msg, which tail (by default the channel's
+        own) read.  Those left running on a worker or spawned hold the
+        tail's checkpoint before msg until they finish.'''
+        if tail is None:
+            tail = self._tail
+        msg_obj, ts = msg['o'], msg['ts']
+        for cb in self._router.match(msg_obj['k']):
+            if self.dispatcher is not None:
+                tail.hold(ts)
+                self.dispatcher.submit(
+                    msg_obj['k'], self._call, cb, msg_obj, tail, ts)
+                continue
+            try:
+                result = cb(self, msg_obj)
+                if isinstance(result, types.GeneratorType):
+                    if spawn is None:
+                        for step in result: pass
+                    else:
+                        tail.hold(ts)
+                        spawn(_releasing(result, tail, ts))
+            except:
+                if raise_errors:
+                    raise
+                log.exception('Error in callback handling %r(%r)',
+                              cb, msg)
+
+    def _call(self, cb, msg_obj, tail, ts):
+        try:
+            result = cb(self, msg_obj)
+            if isinstance(result, types.GeneratorType):
+                for step in result: pass
+        finally:
+            tail.release(ts)
 
     def await(self):
         return self._tail.await(self._spec())
 
+def _releasing(task, tail, ts):
+    '''Run task, then release its message's hold on tail'''
+    try:
+        for step in task:
+            yield step
+    finally:
+        tail.release(ts)
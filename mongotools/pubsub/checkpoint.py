@@ -0,0 +1,59 @@
+import os
+import json
+
+import bson
+
+class CollectionCheckpoint(object):
+    '''Keeps an OplogTail's position in a document of a Mongo collection,
+    one per name'''
+
+    def __init__(self, collection, name):
+        self._collection = collection
+        self._name = name
+
+    def load(self):
+        doc = self._collection.find_one({'_id': self._name})
+        if doc is None:
+            return None
+        return doc['ts']
+
+    def save(self, ts):
+        self._collection.update(
+            {'_id': self._name}, {'$set': {'ts': ts}}, upsert=True)
+
+class FileCheckpoint(object):
+    '''Keeps an OplogTail's position in a local file, replaced atomically
+    on each save.  Loading a file that isn't a saved position raises
+    ValueError rather than resuming from the newest event, which would skip
+    everything since the position was saved.'''
+
+    def __init__(self, path):
+        self._path = path
+
+    def load(self):
+        if not os.path.exists(self._path):
+            return None
+        with open(self._path) as fp:
+            content = fp.read()
+        try:
+            doc = json.loads(content)
+            return bson.Timestamp(doc['time'], doc['inc'])
+        except (ValueError, TypeError, KeyError) as err:
+            raise ValueError('Unreadable checkpoint %s: %r (%s)'
+                             % (self._path, content[:100], err))
+
+    def save(self, ts):
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as fp:
+            json.dump(dict(time=ts.time, inc=ts.inc), fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.rename(tmp, self._path)
+        if hasattr(os, 'O_DIRECTORY'):
+            # and the rename, where the platform lets a directory be synced
+            fd = os.open(os.path.dirname(os.path.abspath(self._path)),
+                         os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
@@ -0,0 +1,85 @@
+import time
+import Queue
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+class Dispatcher(object):
+    '''Runs callbacks on a pool of worker threads, so a slow subscriber
+    doesn't hold up the thread reading the oplog.  Each key hashes to one
+    worker, whose queue is first in first out, so messages with the same
+    key are still handled in the order they were published.  Queues hold
+    at most max_queue callbacks; when one is full, submit() blocks until
+    its worker catches up, and stats() shows how often and for how long
+    that happened.'''
+
+    def __init__(self, workers=4, max_queue=1000):
+        self._workers = [ _Worker(max_queue) for i in range(workers) ]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, key, func, *args):
+        '''Queue func(*args) on the worker for key'''
+        worker = self._workers[hash(key) % len(self._workers)]
+        try:
+            worker.queue.put_nowait((func, args))
+        except Queue.Full:
+            start = time.time()
+            worker.queue.put((func, args))
+            worker.blocked += 1
+            worker.blocked_time += time.time() - start
+        worker.submitted += 1
+        worker.max_depth = max(worker.max_depth, worker.queue.qsize())
+
+    def join(self):
+        '''Wait for every queued callback to finish'''
+        for worker in self._workers:
+            worker.queue.join()
+
+    def close(self):
+        '''Finish the queued callbacks and stop the workers'''
+        for worker in self._workers:
+            worker.queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def stats(self):
+        '''One dict per worker: callbacks submitted, completed and failed,
+        the queue's current and largest depth, and how many submits
+        blocked on a full queue and for how many seconds in all'''
+        return [ dict(
+                submitted=worker.submitted,
+                completed=worker.completed,
+                errors=worker.errors,
+                depth=worker.queue.qsize(),
+                max_depth=worker.max_depth,
+                blocked=worker.blocked,
+                blocked_time=worker.blocked_time)
+                 for worker in self._workers ]
+
+class _Worker(threading.Thread):
+
+    def __init__(self, max_queue):
+        super(_Worker, self).__init__()
+        self.daemon = True
+        self.queue = Queue.Queue(max_queue)
+        self.submitted = self.completed = self.errors = 0
+        self.max_depth = self.blocked = 0
+        self.blocked_time = 0.0
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                func, args = item
+                try:
+                    func(*args)
+                except:
+                    self.errors += 1
+                    log.exception('Error in callback %r%r', func, args)
+                self.completed += 1
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,73 @@
+import logging
+from collections import deque
+
+import bson
+
+from .oplog import OplogTail
+from .mux import OplogMux
+
+log = logging.getLogger(__name__)
+
+class Loop(object):
+    '''Services any number of Channels from one thread, without sleeping
+    between polls.  Each pass handles what every channel has ready, from
+    one tailable cursor (an OplogMux's) kept open between passes, and
+    steps each running task (the generators that generator-function
+    callbacks return, which yield to let the others run).  When a pass
+    finds nothing to do, the loop blocks on a single await_data cursor
+    until the oplog moves past where it was when the pass began, so a
+    message published meanwhile isn't waited out.'''
+
+    def __init__(self, cli, raise_errors=False, checkpoint=None):
+        self._tail = OplogTail(cli)
+        self._mux = OplogMux(cli, checkpoint)
+        self._tasks = deque()
+        self._raise_errors = raise_errors
+        self._running = False
+
+    def add(self, channel):
+        return self._mux.add(channel)
+
+    def remove(self, channel):
+        self._mux.remove(channel)
+
+    def spawn(self, task):
+        '''Run generator task alongside the channels, a step per pass'''
+        self._tasks.append(task)
+
+    def run_once(self, block=True):
+        '''Make a pass over the channels and tasks, then (if block is set
+        and there was nothing to do) wait for the oplog to move.  Returns
+        the number of messages handled and task steps taken.'''
+        last = self._tail.last()
+        done = self._mux.poll(self._raise_errors, self.spawn)
+        done += self._step()
+        if block and not done and not self._tasks:
+            self._tail.wait(last['ts'] if last else bson.Timestamp(0, 1))
+        return done
+
+    def run(self):
+        '''Run passes until stop() is called (from a callback or task)'''
+        self._running = True
+        while self._running:
+            self.run_once()
+
+    def stop(self):
+        self._running = False
+
+    def _step(self):
+        '''Run each task to its next yield; returns the number run'''
+        count = len(self._tasks)
+        for i in range(count):
+            task = self._tasks.popleft()
+            try:
+                task.next()
+            except StopIteration:
+                continue
+            except:
+                if self._raise_errors:
+                    raise
+                log.exception('Error in task %r', task)
+                continue
+            self._tasks.append(task)
+        return count
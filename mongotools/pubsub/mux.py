@@ -0,0 +1,79 @@
+import re
+import logging
+
+from .oplog import OplogTail
+
+log = logging.getLogger(__name__)
+
+class OplogMux(object):
+    '''One oplog tail shared by many Channels.  Its cursor's spec is the
+    union of theirs, and each event it reads is handed to the channels
+    for the namespace it was published to, so N channels cost the oplog
+    one cursor rather than N.'''
+
+    def __init__(self, cli, checkpoint=None):
+        self._tail = OplogTail(cli, checkpoint)
+        self._channels = {}
+
+    def add(self, channel):
+        channels = self._channels.setdefault(channel._collection_ns, [])
+        if channel not in channels:
+            channels.append(channel)
+        return channel
+
+    def remove(self, channel):
+        channels = self._channels[channel._collection_ns]
+        channels.remove(channel)
+        if not channels:
+            del self._channels[channel._collection_ns]
+
+    def _spec(self):
+        '''The union of the channels' specs: those taking every key are
+        selected by namespace alone, the rest by namespace and key pattern.
+        None if no channel has subscriptions.'''
+        unfiltered, clauses = [], []
+        for ns, channels in sorted(self._channels.iteritems()):
+            routers = [ chan._router for chan in channels if chan._router ]
+            if not routers: continue
+            patterns = [ router.pattern() for router in routers ]
+            if None in patterns:
+                unfiltered.append(ns)
+            else:
+                clauses.append({'ns': ns, 'o.k': re.compile('|'.join(patterns))})
+        if unfiltered:
+            clauses.append({'ns': {'$in': unfiltered}})
+        if not clauses:
+            return None
+        if len(clauses) == 1:
+            spec = clauses[0]
+        else:
+            spec = {'$or': clauses}
+        spec['op'] = 'i'
+        return spec
+
+    def handle_ready(self, raise_errors=False, await=False, spawn=None):
+        '''As Channel.handle_ready, for every channel at once.  Returns the
+        number of events read.'''
+        spec = self._spec()
+        if spec is None:
+            return 0
+        return self._dispatch(
+            self._tail.tail(spec, raise_errors=raise_errors, await=await),
+            raise_errors, spawn)
+
+    def poll(self, raise_errors=False, spawn=None):
+        '''As Channel.poll, for every channel at once'''
+        spec = self._spec()
+        if spec is None:
+            return 0
+        return self._dispatch(
+            self._tail.poll(spec, raise_errors=raise_errors),
+            raise_errors, spawn)
+
+    def _dispatch(self, msgs, raise_errors, spawn):
+        count = 0
+        for msg in msgs:
+            count += 1
+            for channel in self._channels.get(msg['ns'], ()):
+                channel._dispatch(msg, raise_errors, spawn, self._tail)
+        return count
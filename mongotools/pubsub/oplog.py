@@ -1,4 +1,7 @@
+import time
 import logging
+import threading
+from collections import deque
 
 import bson
 from pymongo.errors import OperationFailure
@@ -7,46 +10,150 @@ from pymongo.cursor import _QUERY_OPTIONS
 log = logging.getLogger(__name__)
 
 class OplogTail(object):
+    '''Reads the oplog from a position: that of the last event read, or
+    to begin with the newest event (or what a checkpoint saved).
 
-    def __init__(self, cli):
+    The position moves past an event once it is handled: when the consumer
+    of tail() or poll() asks for the next one.  Whoever hands an event on
+    to be handled later (a Dispatcher, say) calls hold(ts) first and
+    release(ts) when it's done.
+
+    A checkpoint (see the checkpoint module) makes the position survive a
+    restart.  It is saved every commit_every events or commit_interval
+    seconds, whichever comes first, and by commit(); it never passes an
+    event still held.  Whenever a cursor is
+    opened, the oplog is checked for having rolled past the position;
+    on_gap(position, oldest) is then called with the position and the
+    oldest event's timestamp, and reading resumes from that event.  A
+    cursor that runs out has scanned every event there was when it was
+    read from, so the position then moves up to the newest of them: a
+    filtered tail whose events are rare is told of a gap only if the oplog
+    rolls past what it has scanned.'''
+
+    def __init__(self, cli, checkpoint=None, commit_every=1000,
+                 commit_interval=1.0, on_gap=None):
         self._cli = cli
         self._coll = cli.local['oplog.rs']
-        last_msg = self.last()
-        if last_msg:
-            self._position = last_msg['ts']
+        self._checkpoint = checkpoint
+        self._commit_every = commit_every
+        self._commit_interval = commit_interval
+        self._on_gap = on_gap or _log_gap
+        saved = checkpoint.load() if checkpoint is not None else None
+        if saved is not None:
+            self._position = saved
         else:
-            self._position = bson.Timestamp(0, 1)
+            last_msg = self.last()
+            if last_msg:
+                self._position = last_msg['ts']
+            else:
+                self._position = bson.Timestamp(0, 1)
+        self._committed = self._position
+        self._committed_at = time.time()
+        self._uncommitted = 0
+        self._polling = None
+        self._holds = deque()  # [ts, count] in the order read
+        self._holds_lock = threading.Lock()
 
     def last(self, spec=None):
         if spec is None:
             spec = {}
         return self._coll.find_one(spec, sort=[('$natural', -1)], limit=1)
 
-    def cursor(self, spec=None, await=True):
+    def cursor(self, spec=None, await=True, tailable=None):
         '''Cursor over all events, starting right now, that satisfy the spec'''
         if spec is None:
             spec = {}
+        if tailable is None:
+            tailable = await
+        self._check_gap()
         spec['ts'] = {'$gt': self._position}
         if await:
             options = dict(tailable=True, await_data=True)
+        elif tailable:
+            options = dict(tailable=True)
         else:
             options = {}
         q = self._coll.find(spec, **options)
         q = q.hint([('$natural', 1)])
-        if await:
+        if tailable:
             q = q.add_option(_QUERY_OPTIONS['oplog_replay'])
         return q
 
     def tail(self, spec=None, raise_errors=False, await=True):
         if spec is None:
             spec = {}
+        head = self._head()
         cursor = self.cursor(spec, await)
+        for msg in self._read(cursor, head, raise_errors):
+            yield msg
+
+    def poll(self, spec=None, raise_errors=False):
+        '''Like tail(spec, await=False), but the tailable cursor is kept
+        open from one call to the next (until spec changes), so each call
+        reads only the events added since the last'''
+        if spec is None:
+            spec = {}
+        head = self._head()
+        key = _spec_key(spec)
+        if (self._polling is None or self._polling[0] != key
+            or not self._polling[1].alive):
+            self._polling = (key, self.cursor(dict(spec), await=False, tailable=True))
+        for msg in self._read(self._polling[1], head, raise_errors):
+            yield msg
+
+    def hold(self, ts):
+        '''Keep the checkpoint before the event at ts until release(ts)'''
+        if self._checkpoint is None:
+            return
+        with self._holds_lock:
+            if self._holds and self._holds[-1][0] == ts:
+                self._holds[-1][1] += 1
+            else:
+                self._holds.append([ts, 1])
+
+    def release(self, ts):
+        if self._checkpoint is None:
+            return
+        with self._holds_lock:
+            for hold in self._holds:
+                if hold[0] == ts:
+                    hold[1] -= 1
+                    break
+            while self._holds and not self._holds[0][1]:
+                self._holds.popleft()
+
+    def commit(self):
+        '''Save the position to the checkpoint, if it has moved (while
+        events are held, the position just before the oldest of them)'''
+        if self._checkpoint is not None:
+            with self._holds_lock:
+                if self._holds:
+                    position = _before(self._holds[0][0])
+                else:
+                    position = self._position
+            if position != self._committed:
+                self._checkpoint.save(position)
+                self._committed = position
+        self._committed_at = time.time()
+        self._uncommitted = 0
+
+    def _head(self):
+        last = self.last()
+        return last['ts'] if last else None
+
+    def _read(self, cursor, head, raise_errors):
+        '''The events from cursor, read after the oplog's newest event was
+        head'''
         while True:
             try:
                 msg = cursor.next()
             except StopIteration:
+                if head is not None and head > self._position:
+                    self._position = head
                 break
             except OperationFailure as err:
+                if self._polling is not None and self._polling[1] is cursor:
+                    self._polling = None
                 if raise_errors:
                     raise
                 else:
@@ -54,8 +161,48 @@ class OplogTail(object):
                         'Error getting messages, may have dropped some: %r',
                         err)
                     break
-            self._position = msg['ts']
             yield msg
+            self._advance(msg['ts'])
+        self._maybe_commit()
+
+    def _advance(self, ts):
+        self._position = ts
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_every:
+            self.commit()
+        else:
+            self._maybe_commit()
+
+    def _maybe_commit(self):
+        if self._position != self._committed and (
+            time.time() - self._committed_at >= self._commit_interval):
+            self.commit()
+
+    def _check_gap(self):
+        '''If the oplog has rolled past the position, report the gap and
+        move the position to just before the oldest event'''
+        if self._position == bson.Timestamp(0, 1):
+            return
+        first = self._coll.find_one(sort=[('$natural', 1)])
+        if first is None or first['ts'] <= self._position:
+            return
+        self._on_gap(self._position, first['ts'])
+        self._position = _before(first['ts'])
+
+    def wait(self, since=None):
+        '''Block until the oplog has an event after the timestamp since (by
+        default, the newest event now), or until the server gives up
+        awaiting data.  Returns that event, or None.'''
+        if since is None:
+            last = self.last()
+            since = last['ts'] if last else bson.Timestamp(0, 1)
+        curs = self._coll.find(
+            {'ts': {'$gt': since}}, tailable=True, await_data=True)
+        curs = curs.hint([('$natural', 1)])
+        curs = curs.add_option(_QUERY_OPTIONS['oplog_replay'])
+        for msg in curs:
+            return msg
+        return None
 
     def await(self, spec=None):
         '''Await the very next message on the oplog satisfying the spec'''
@@ -76,3 +223,17 @@ class OplogTail(object):
         except StopIteration:
             return None
 
+def _log_gap(position, oldest):
+    log.error('Oplog rolled past position %r; events before %r may be lost',
+              position, oldest)
+
+def _before(ts):
+    '''The timestamp just before ts'''
+    if ts.inc:
+        return bson.Timestamp(ts.time, ts.inc - 1)
+    return bson.Timestamp(ts.time - 1, 2**32 - 1)
+
+def _spec_key(spec):
+    '''spec in a form that compares equal for equal specs, compiled regexes
+    included'''
+    return sorted((k, getattr(v, 'pattern', v)) for k, v in spec.iteritems())
@@ -0,0 +1,90 @@
+import re
+
+class Router(object):
+    '''Callbacks subscribed by key prefix.  The prefixes are kept in a trie
+    of characters, so finding every callback whose prefix a key starts
+    with walks the key once, however many prefixes there are.'''
+
+    def __init__(self):
+        self._root = _Node()
+        self._pattern = None
+
+    def __nonzero__(self):
+        return bool(self._root.children) or self._root.subscribed
+
+    def add(self, prefix, callback=None):
+        '''Subscribe prefix, adding callback (if given) to those it calls'''
+        node = self._root
+        for ch in prefix:
+            child = node.children.get(ch)
+            if child is None:
+                child = node.children[ch] = _Node()
+            node = child
+        if not node.subscribed:
+            node.subscribed = True
+            self._pattern = None
+        if callback is not None:
+            node.callbacks.append(callback)
+
+    def match(self, key):
+        '''The callbacks for every subscribed prefix of key, shortest
+        prefix first and in the order they were added'''
+        node = self._root
+        result = list(node.callbacks)
+        for ch in key:
+            node = node.children.get(ch)
+            if node is None: break
+            if node.callbacks:
+                result.extend(node.callbacks)
+        return result
+
+    def pattern(self):
+        '''A regex matching just the keys with a subscribed prefix, shaped
+        like the trie so it too only reads each key once; None if every
+        key has one (or there are no subscriptions)'''
+        if self._root.subscribed or not self._root.children:
+            return None
+        if self._pattern is None:
+            self._pattern = '^' + _alternation(self._root)
+        return self._pattern
+
+class _Node(object):
+    __slots__ = ('children', 'callbacks', 'subscribed')
+
+    def __init__(self):
+        self.children = {}
+        self.callbacks = []
+        self.subscribed = False
+
+def _alternation(root):
+    '''A regex for the subscribed prefixes below root.  A subscribed node
+    ends its branch, since any longer prefix already starts with it, and a
+    run of nodes with one child each becomes one literal.  Built with a
+    stack of the nodes being worked on, not by recursion, so long prefixes
+    don't hit the recursion limit.'''
+    stack = [ ('', _children(root), []) ]
+    while True:
+        head, children, branches = stack[-1]
+        for ch, child in children:
+            run = [ ch ]
+            while not child.subscribed and len(child.children) == 1:
+                (ch, child), = child.children.items()
+                run.append(ch)
+            literal = re.escape(''.join(run))
+            if child.subscribed:
+                branches.append(literal)
+            else:
+                stack.append((literal, _children(child), []))
+                break
+        else:
+            stack.pop()
+            if len(branches) == 1:
+                group = branches[0]
+            else:
+                group = '(?:%s)' % '|'.join(branches)
+            if not stack:
+                return group
+            stack[-1][2].append(head + group)
+
+def _children(node):
+    return iter(sorted(node.children.iteritems()))
@@ -1,9 +1,16 @@
-from datetime import datetime
+import os
+import shutil
+import calendar
+import tempfile
+import threading
+from datetime import datetime, timedelta
 from unittest import TestCase
 
 import bson
-from mongotools import mim
-from pymongo.errors import OperationFailure
+from mongotools import mim, pubsub
+from pymongo.errors import OperationFailure, DuplicateKeyError, InvalidOperation
+from pymongo.errors import CollectionInvalid
+from pymongo.cursor import _QUERY_OPTIONS
 from nose import SkipTest
 
 class TestDatastore(TestCase):
@@ -432,7 +439,7 @@ class TestCollection(TestCase):
         self.assertEqual(type(cursor), type(self.bind.db.coll.find()))
         cursor = self.bind.db.coll.find().hint([('myindex', 1)])
         self.assertEqual(type(cursor), type(self.bind.db.coll.find()))
-        cursor = self.bind.db.coll.find().hint('myindex')
+        cursor = self.bind.db.coll.find().hint('myindex_1')
         self.assertEqual(type(cursor), type(self.bind.db.coll.find()))
         cursor = self.bind.db.coll.find().hint(None)
         self.assertEqual(type(cursor), type(self.bind.db.coll.find()))
@@ -532,3 +539,1801 @@ class TestMatch(TestCase):
     def test_traverse_list(self):
         doc = { 'a': [ { 'b': 1 }, { 'b': 2 } ] }
         self.assertIsNotNone(mim.match( {'a.b': 1 }, doc))
+
+class TestIndexes(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection.get()
+        self.bind.drop_all()
+        self.coll = self.bind.db.coll
+        for i in range(20):
+            self.coll.insert({'_id': i, 'a': i % 5, 'b': i, 'c': 'x%d' % (i % 2)})
+        self.coll.insert({'_id': 'missing'})
+
+    def _ids(self, spec):
+        return sorted(d['_id'] for d in self.coll.find(spec))
+
+    def _scan_ids(self, spec):
+        return sorted(
+            d['_id'] for d in self.coll._data.values()
+            if mim.match(spec, d) is not None)
+
+    def test_plan_uses_index(self):
+        self.coll.ensure_index('a')
+        plan = self.coll._plan({'a': 2})
+        self.assertEqual(plan.index.name, 'a_1')
+        self.assertEqual(sorted(plan.ids()), [2, 7, 12, 17])
+        self.assertIsNone(self.coll._plan({'c': 'x0'}).index)
+
+    def test_plan_prefers_selective_index(self):
+        self.coll.ensure_index('a')
+        self.coll.ensure_index('b')
+        plan = self.coll._plan({'a': 2, 'b': {'$gte': 17}})
+        self.assertEqual(plan.index.name, 'b_1')
+        self.assertEqual(sorted(plan.ids()), [17, 18, 19])
+
+    def test_results_match_scan(self):
+        self.coll.ensure_index('a')
+        self.coll.ensure_index('b')
+        self.coll.ensure_index([('c', 1), ('a', 1)])
+        for spec in [
+                {'a': 3},
+                {'a': {'$in': [1, 4]}},
+                {'a': {'$in': []}},
+                {'b': {'$gt': 5, '$lte': 9}},
+                {'b': {'$lt': 3}},
+                {'b': {'$gte': 19}},
+                {'a': None},
+                {'c': 'x1'},
+                {'c': 'x1', 'a': 3},
+                {'c': {'$in': ['x0', 'y']}, 'a': {'$gt': 2}},
+                {'a': 3, 'b': {'$ne': 8}},
+                ]:
+            self.assertEqual(self._ids(spec), self._scan_ids(spec), spec)
+            self.assertIsNotNone(self.coll._plan(spec).index, spec)
+
+    def test_update_and_remove_maintain_index(self):
+        self.coll.ensure_index('a')
+        self.coll.update({'_id': 3}, {'$set': {'a': 42}})
+        self.assertEqual(self._ids({'a': 42}), [3])
+        self.assertEqual(self._ids({'a': 3}), [8, 13, 18])
+        self.coll.remove({'a': 42})
+        self.assertEqual(self._ids({'a': 42}), [])
+        self.assertEqual(len(self.coll._indexes['a_1']), 20)
+
+    def test_unique(self):
+        self.coll.ensure_index('b', unique=True)
+        self.assertRaises(
+            DuplicateKeyError, self.coll.insert, {'_id': 'dup', 'b': 4})
+        self.coll.insert({'_id': 'ok', 'b': 400})
+        self.assertRaises(
+            DuplicateKeyError, self.coll.ensure_index, 'a', unique=True)
+
+    def test_arrays_index_each_element(self):
+        self.coll.ensure_index('a')
+        self.coll.insert({'_id': 'arr', 'a': [3, 99]})
+        self.assertEqual(self.coll._plan({'a': 3}).index.name, 'a_1')
+        self.assertTrue(self.coll._indexes['a_1'].multikey)
+        self.assertEqual(self._ids({'a': 99}), ['arr'])
+
+    def test_drop_index(self):
+        self.coll.ensure_index('a')
+        self.coll.drop_index('a_1')
+        self.assertIsNone(self.coll._plan({'a': 2}).index)
+        self.assertEqual(self.coll.index_information(), {})
+
+class TestCompiledQuery(TestCase):
+
+    docs = [
+        { 'd': 2 },
+        { 'd': 2.0, 'e': 'foo' },
+        { 'c': [ 1, 2 ] },
+        { 'a': [ { 'b': 1 }, { 'b': 2 } ] },
+        { 'foo': { 'bar': [ 1, 2, 3, 4, 5 ] } },
+        { 'd': None },
+        {},
+        ]
+
+    specs = [
+        { 'd': 2 },
+        { 'd': { '$gt': 1, '$lt': 3 } },
+        { 'd': { '$lte': 1 } },
+        { 'd': { '$exists': 1 } },
+        { 'e': { '$exists': 0 } },
+        { 'c': 2 },
+        { 'c': { '$all': [ 1, 2 ] } },
+        { 'c': { '$in': [ 5, 2 ] } },
+        { 'a.b': 2 },
+        { 'foo.bar': 4 },
+        { '$or': [ { 'd': 1 }, { 'c': 1 } ] },
+        { 'd': 2, 'e': 'foo' },
+        ]
+
+    def test_agrees_with_match(self):
+        for spec in self.specs:
+            pred = mim.compile_query(spec)
+            for doc in self.docs:
+                expected = mim.match(spec, doc) is not None
+                self.assertEqual(pred(doc), expected, (spec, doc))
+
+    def test_cached_by_shape(self):
+        mim.mim._query_cache.clear()
+        p1 = mim.compile_query({'d': {'$gt': 1}})
+        p2 = mim.compile_query({'d': {'$gt': 2}})
+        self.assertEqual(len(mim.mim._query_cache), 1)
+        self.assertTrue(p1({'d': 2}))
+        self.assertFalse(p2({'d': 2}))
+
+    def test_regex(self):
+        import re
+        pred = mim.compile_query({'e': re.compile('^fo')})
+        self.assertTrue(pred({'e': 'foo'}))
+        self.assertTrue(pred({'e': ['bar', 'fox']}))
+        self.assertFalse(pred({'e': 'bar'}))
+        self.assertFalse(pred({}))
+
+    def test_ne_array(self):
+        pred = mim.compile_query({'c': {'$ne': 2}})
+        self.assertFalse(pred({'c': [1, 2]}))
+        self.assertTrue(pred({'c': [1, 3]}))
+        self.assertTrue(pred({}))
+
+    def test_elem_match(self):
+        pred = mim.compile_query(
+            {'foo': { '$elemMatch': { 'bar': 1, 'baz': 2 } } })
+        self.assertTrue(pred({'foo': [ { 'bar': 1, 'baz': 2 } ]}))
+        self.assertFalse(pred(
+                {'foo': [ { 'bar': 1, 'baz': 1 }, { 'bar': 2, 'baz': 2 } ]}))
+        pred = mim.compile_query({'c': { '$elemMatch': { '$gt': 1, '$lt': 3 } } })
+        self.assertTrue(pred({'c': [0, 2, 4]}))
+        self.assertFalse(pred({'c': [0, 4]}))
+        self.assertFalse(pred({'c': 2}))
+
+    def test_pull_condition(self):
+        bind = mim.Connection.get()
+        bind.drop_all()
+        bind.db.coll.insert({'_id': 1, 'e': [1, 2, 3]})
+        bind.db.coll.update({}, {'$pull': {'e': {'$gte': 2}}})
+        self.assertEqual(bind.db.coll.find_one()['e'], [1])
+
+class TestCopyOnWrite(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection(copy_on_write=True)
+        self.coll = self.bind.db.coll
+        self.doc = {'_id': 'foo', 'a': 1, 'b': {'c': [1, {'d': 2}]}}
+        self.coll.insert(self.doc)
+
+    def test_insert_copies(self):
+        self.doc['b']['c'].append(3)
+        self.assertEqual(self.coll.find_one()['b']['c'], [1, {'d': 2}])
+
+    def test_views_are_mutable_and_private(self):
+        doc = self.coll.find_one()
+        doc['a'] = 2
+        doc['b']['c'][1]['d'] = 3
+        doc['b']['c'].append(4)
+        for sub in doc['b']['c']:
+            if isinstance(sub, dict): sub['e'] = 5
+        self.assertEqual(doc, {'_id': 'foo', 'a': 2,
+                               'b': {'c': [1, {'d': 3, 'e': 5}, 4]}})
+        self.assertEqual(self.coll.find_one(), self.doc)
+
+    def test_results_are_plain(self):
+        doc = self.coll.find_one()
+        stored = self.coll._data['foo']
+        self.assertIsInstance(stored, mim.mim.FrozenDict)
+        self.assertRaises(TypeError, stored['b'].__setitem__, 'c', None)
+        self.assertIs(type(doc), dict)
+        self.assertIs(type(doc['b']['c']), list)
+        copy = dict(doc)
+        copy['b']['x'] = 1
+        copy['b']['c'][1]['d'] = 3
+        self.assertEqual(self.coll.find_one(), self.doc)
+
+    def test_update(self):
+        self.coll.update({'b.c': 1}, {'$set': {'b.x': [1]}, '$inc': {'a': 1}})
+        self.coll.update({'b.c': 1}, {'$inc': {'b.c.$': 1}})
+        self.assertEqual(self.coll.find_one(),
+                         {'_id': 'foo', 'a': 2, 'b': {'c': [2, {'d': 2}], 'x': [1]}})
+        self.coll.save({'_id': 'foo', 'z': 1})
+        self.assertEqual(self.coll.find_one(), {'_id': 'foo', 'z': 1})
+        self.coll.update({'_id': 'foo'}, {'b': 5})
+        self.assertEqual(list(self.coll.find()), [{'_id': 'foo', 'b': 5}])
+
+    def test_update_shares_untouched(self):
+        self.coll.insert({'_id': 'bar', 'x': {'y': 1}, 'l': [{'z': 1}, {'z': 2}]})
+        before = self.coll._data['bar']
+        self.coll.update({'_id': 'bar'}, {'$set': {'l.1.z': 3}})
+        after = self.coll._data['bar']
+        self.assertIs(after['x'], before['x'])
+        self.assertIs(after['l'][0], before['l'][0])
+        self.assertEqual(after['l'][1], {'z': 3})
+        self.assertEqual(before['l'][1], {'z': 2})
+
+    def test_copies(self):
+        import copy
+        doc = self.coll.find_one()
+        self.assertEqual(copy.deepcopy(doc), self.doc)
+        self.assertEqual(bson.BSON.encode(doc).decode(), self.doc)
+
+    def test_validates(self):
+        self.assertRaises(bson.errors.InvalidDocument,
+                          self.coll.insert, {'a': set()})
+        self.assertRaises(bson.errors.InvalidDocument,
+                          self.coll.insert, {1: 2})
+
+class TestSort(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection.get()
+        self.bind.drop_all()
+        self.coll = self.bind.db.coll
+        for i in range(50):
+            self.coll.insert({'_id': i, 'ts': (i * 7) % 50, 'g': i % 3})
+        self.coll.insert({'_id': 'none', 'ts': None, 'g': 1})
+
+    def _ts(self, cursor):
+        return [ d['ts'] for d in cursor ]
+
+    def test_sort(self):
+        self.assertEqual(
+            self._ts(self.coll.find().sort('ts', -1)),
+            range(49, -1, -1) + [None])
+        self.assertEqual(
+            self._ts(self.coll.find({'g': 0}).sort('ts')),
+            sorted(d['ts'] for d in self.coll.find({'g': 0})))
+
+    def test_compound_sort(self):
+        docs = list(self.coll.find().sort([('g', 1), ('ts', -1)]))
+        keys = [ (d['g'], d['ts']) for d in docs ]
+        self.assertEqual(
+            keys,
+            sorted(keys, key=lambda k: (k[0], -1 if k[1] is None else -k[1])))
+
+    def test_limit_and_skip(self):
+        self.assertEqual(
+            self._ts(self.coll.find().sort('ts', -1).limit(3)), [49, 48, 47])
+        self.assertEqual(
+            self._ts(self.coll.find().sort('ts', -1).skip(2).limit(3)), [47, 46, 45])
+        self.assertEqual(
+            self._ts(self.coll.find(sort=[('ts', 1)], skip=1, limit=2)), [0, 1])
+        self.assertEqual(self.coll.find().limit(5).count(), 51)
+        self.assertEqual(len(list(self.coll.find().limit(5))), 5)
+
+    def test_top_uses_heap(self):
+        docs = self.coll._find({}, sort=[('ts', -1)], top=3)
+        self.assertEqual(type(docs), type(iter([])))
+        self.assertEqual([ d['ts'] for d in docs ], [49, 48, 47])
+
+    def test_index_order(self):
+        self.coll.ensure_index('ts')
+        plan = self.coll._plan({}, [('ts', -1)])
+        self.assertTrue(plan.ordered)
+        self.assertEqual(
+            self._ts(self.coll.find().sort('ts', -1).limit(3)), [49, 48, 47])
+        self.assertEqual(
+            self._ts(self.coll.find({'ts': {'$gte': 45}, 'g': 1}).sort('ts')),
+            [ d['ts'] for d in self.coll.find({'g': 1}).sort('ts')
+              if d['ts'] >= 45 ])
+        self.assertEqual(
+            self._ts(self.coll.find().sort('ts', -1)),
+            range(49, -1, -1) + [None])
+
+    def test_index_order_while_writing(self):
+        self.coll.ensure_index('n')
+        self.coll.insert([ {'n': i} for i in range(1000) ])
+        for direction in (1, -1):
+            seen = []
+            for doc in self.coll.find({'n': {'$gte': 0}}).sort('n', direction):
+                seen.append(doc['n'])
+                self.coll.remove(doc['_id'])
+            self.assertEqual(seen, range(1000)[::direction])
+            self.coll.insert([ {'n': i} for i in range(1000) ])
+
+    def test_selective_filter_beats_order(self):
+        self.coll.ensure_index('ts')
+        self.coll.ensure_index('g')
+        self.coll.insert({'_id': 'x', 'ts': 3, 'g': 'rare'})
+        plan = self.coll._plan({'g': 'rare'}, [('ts', 1)])
+        self.assertEqual(plan.index.name, 'g_1')
+        self.assertFalse(plan.ordered)
+
+class TestCountAndFindOne(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection.get()
+        self.bind.drop_all()
+        self.coll = self.bind.db.coll
+        for i in range(30):
+            self.coll.insert({'_id': i, 'a': i % 4, 'b': i % 5 or None, 'c': i})
+        self.coll.insert({'_id': 'bare'})
+
+    def _no_scan(self):
+        def fail(*args, **kwargs):
+            raise AssertionError('collection was scanned')
+        self.coll._find = fail
+
+    def test_count_without_scan(self):
+        self.coll.ensure_index('a')
+        self.coll.ensure_index('c')
+        self.coll.ensure_index([('a', 1), ('c', 1)])
+        specs = [
+            {}, {'_id': 3}, {'_id': {'$in': [1, 2, 99, 2]}},
+            {'a': 2}, {'a': {'$in': [1, 3]}}, {'c': {'$gte': 10, '$lt': 20}},
+            {'c': {'$lt': 5}}, {'a': 1, 'c': 5} ]
+        expected = [ len(list(self.coll.find(spec))) for spec in specs ]
+        self._no_scan()
+        self.assertEqual([ self.coll.find(spec).count() for spec in specs ],
+                         expected)
+        self.assertEqual(expected, [31, 1, 2, 7, 15, 10, 6, 1])
+
+    def test_count_falls_back(self):
+        self.coll.ensure_index('b')
+        for spec in [ {'b': None}, {'b': {'$ne': 1}}, {'a': 1, 'b': 1},
+                      {'_id': {'$gt': 25}} ]:
+            self.assertEqual(
+                self.coll.find(spec).count(),
+                sum(1 for d in self.coll._data.values()
+                    if mim.match(spec, d) is not None), spec)
+
+    def test_count_with_limit_and_skip(self):
+        cursor = self.coll.find({'a': 0}).skip(2).limit(3)
+        self.assertEqual(cursor.count(), 8)
+        self.assertEqual(cursor.count(with_limit_and_skip=True), 3)
+
+    def test_find_one_by_id(self):
+        self._no_scan()
+        doc = self.coll.find_one(7)
+        self.assertEqual(doc, {'_id': 7, 'a': 3, 'b': 2, 'c': 7})
+        doc['a'] = 42
+        self.assertEqual(self.coll.find_one({'_id': 7})['a'], 3)
+        self.assertEqual(self.coll.find_one({'_id': 7}, fields=['c']),
+                         {'_id': 7, 'c': 7})
+        self.assertEqual(self.coll.find_one({'_id': {'$in': [99, 8]}})['_id'], 8)
+        self.assertIsNone(self.coll.find_one({'_id': 99}))
+        self.assertIsNone(self.coll.find_one({'_id': True}))
+
+class TestIdFastPath(TestCase):
+
+    class NoScan(dict):
+        def itervalues(self):
+            raise AssertionError('collection was scanned')
+        values = itervalues
+
+    def setUp(self):
+        self.bind = mim.Connection.get()
+        self.bind.drop_all()
+        self.coll = self.bind.db.coll
+        for i in range(10):
+            self.coll.insert({'_id': i, 'a': i})
+        self.coll._data = self.NoScan(self.coll._data)
+
+    def test_update(self):
+        result = self.coll.update({'_id': 3}, {'$set': {'a': 30}})
+        self.assertEqual(result['n'], 1)
+        result = self.coll.update({'_id': {'$in': [4, 5, 99]}},
+                                  {'$inc': {'a': 1}}, multi=True)
+        self.assertEqual(result['n'], 2)
+        self.assertEqual([ self.coll.find_one(i)['a'] for i in (3, 4, 5) ],
+                         [30, 5, 6])
+        result = self.coll.update({'_id': 3, 'a': 0}, {'$set': {'a': 0}})
+        self.assertEqual(result['n'], 0)
+
+    def test_remove(self):
+        self.assertEqual(self.coll.remove({'_id': 3})['n'], 1)
+        self.assertEqual(self.coll.remove(4)['n'], 1)
+        self.assertEqual(self.coll.remove({'_id': {'$in': [5, 6, 6]}})['n'], 2)
+        self.assertIsInstance(self.coll._data, self.NoScan)
+        self.assertEqual(sorted(self.coll._data), [0, 1, 2, 7, 8, 9])
+
+    def test_find_and_modify(self):
+        old = self.coll.find_and_modify({'_id': 2}, {'$inc': {'a': 1}})
+        self.assertEqual(old, {'_id': 2, 'a': 2})
+        new = self.coll.find_and_modify({'_id': 2}, {'$inc': {'a': 1}}, new=True)
+        self.assertEqual(new, {'_id': 2, 'a': 4})
+        gone = self.coll.find_and_modify({'_id': 2}, remove=True)
+        self.assertEqual(gone, {'_id': 2, 'a': 4})
+        self.assertIsNone(self.coll.find_one(2))
+
+    def test_find_and_modify_sort(self):
+        self.coll._data = dict(self.coll._data)
+        doc = self.coll.find_and_modify(
+            {'a': {'$lt': 5}}, {'$set': {'b': 1}}, sort={'a': -1}, new=True)
+        self.assertEqual(doc, {'_id': 4, 'a': 4, 'b': 1})
+
+    def test_indexed_field(self):
+        self.coll._data = dict(self.coll._data)
+        self.coll.ensure_index('a')
+        self.coll._data = self.NoScan(self.coll._data)
+        self.assertEqual(list(self.coll.find({'_id': 3, 'a': 3})),
+                         [{'_id': 3, 'a': 3}])
+        self.assertEqual(list(self.coll.find({'_id': 3, 'a': 4})), [])
+        result = self.coll.update({'_id': 3, 'a': 3}, {'$set': {'a': 30}})
+        self.assertEqual(result['n'], 1)
+        self.assertEqual(self.coll.remove({'_id': 3, 'a': 30})['n'], 1)
+        self.assertIsNone(self.coll.find_one(3))
+
+    def test_remove_while_reading(self):
+        self.coll._data = dict(self.coll._data)
+        for doc in self.coll.find():
+            self.coll.remove({'_id': doc['_id']})
+        self.assertEqual(self.coll.count(), 0)
+
+class TestThreadSafe(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection(thread_safe=True)
+        self.coll = self.bind.db.coll
+        self.coll.insert([ {'_id': i, 'a': i, 'b': i} for i in range(10) ])
+
+    def _run(self, *targets):
+        errors = []
+        def run(target):
+            try:
+                target()
+            except Exception, e:
+                errors.append(e)
+        threads = [ threading.Thread(target=run, args=(t,)) for t in targets ]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        self.assertEqual(errors, [])
+
+    def test_cursor_is_snapshot(self):
+        cursor = self.coll.find()
+        first = cursor.next()
+        self.coll.insert([ {'_id': i} for i in range(10, 100) ])
+        self.coll.update({}, {'$set': {'a': -1}}, multi=True)
+        rest = list(cursor)
+        self.assertEqual(len(rest), 9)
+        self.assertTrue(all(doc['a'] == doc['_id'] for doc in [first] + rest))
+        self.assertEqual(self.coll.find().count(), 100)
+
+    def test_results_are_plain(self):
+        self.coll.update({'_id': 0}, {'$set': {'c': {'d': [1]}}})
+        doc = dict(self.coll.find_one({'a': 0}))
+        self.assertIs(type(doc['c']), dict)
+        doc['c']['e'] = 1
+        doc['c']['d'].append(2)
+        self.assertEqual(self.coll.find_one({'a': 0})['c'], {'d': [1]})
+
+    def test_concurrent_writes(self):
+        def inserter(base):
+            def insert():
+                for i in range(200):
+                    self.coll.insert({'_id': '%s-%s' % (base, i), 'a': i})
+            return insert
+        def reader():
+            for i in range(50):
+                for doc in self.coll.find({'a': {'$gte': 0}}):
+                    self.assertIn('a', doc)
+        self.coll.ensure_index('a')
+        self._run(inserter(1), inserter(2), inserter(3), reader)
+        self.assertEqual(self.coll.find().count(), 610)
+        self.assertEqual(self.coll.find({'a': 5}).count(), 4)
+
+    def test_documents_are_not_torn(self):
+        def writer():
+            for i in range(500):
+                self.coll.update({}, {'$set': {'a': i, 'b': i}}, multi=True)
+        def reader():
+            for i in range(200):
+                for doc in self.coll.find():
+                    self.assertEqual(doc['a'], doc['b'])
+        self._run(writer, reader, reader)
+
+    def test_find_and_modify_is_atomic(self):
+        self.coll.insert({'_id': 'counter', 'n': 0})
+        def incr():
+            for i in range(200):
+                self.coll.find_and_modify({'_id': 'counter'}, {'$inc': {'n': 1}})
+        self._run(incr, incr, incr, incr)
+        self.assertEqual(self.coll.find_one('counter')['n'], 800)
+
+    def test_collection_created_once(self):
+        colls = []
+        def get():
+            colls.append(self.bind.other_db.new_coll)
+        self._run(*[get] * 8)
+        self.assertEqual(len(set(map(id, colls))), 1)
+
+
+class TestRWLock(TestCase):
+
+    def setUp(self):
+        self.lock = mim.mim._RWLock()
+
+    def test_reentrant(self):
+        with self.lock.writing:
+            with self.lock.writing:
+                with self.lock.reading:
+                    pass
+        with self.lock.reading:
+            with self.lock.reading:
+                with self.lock.writing:
+                    pass
+        self.assertEqual(self.lock._readers, {})
+        self.assertIsNone(self.lock._writer)
+
+    def test_writer_excludes_readers(self):
+        events = []
+        def read():
+            with self.lock.reading:
+                events.append('read')
+        with self.lock.writing:
+            t = threading.Thread(target=read)
+            t.start()
+            t.join(0.05)
+            events.append('write')
+        t.join()
+        self.assertEqual(events, ['write', 'read'])
+
+    def test_readers_share(self):
+        inside = threading.Event()
+        done = []
+        def read():
+            with self.lock.reading:
+                inside.wait(1)
+                done.append(1)
+        with self.lock.reading:
+            t = threading.Thread(target=read)
+            t.start()
+            inside.set()
+            t.join(1)
+            self.assertEqual(done, [1])
+
+
+class TestDumpLoad(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'fixture.mim')
+        self.bind = mim.Connection()
+        self.bind.db.coll.insert([
+                {'_id': i, 'a': i % 3, 'b': {'c': [i, 'x%d' % i]},
+                 'd': datetime(2012, 1, 1, 0, 0, i)}
+                for i in range(10) ])
+        self.bind.db.coll.ensure_index('a')
+        self.bind.db.coll.ensure_index([('b.c', 1)], unique=True, sparse=True)
+        self.bind.db.other.insert({'_id': 'x', 'v': 1})
+        self.bind.db2.coll.insert({'_id': bson.ObjectId(), 'v': 2})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        self.bind.dump(self.filename)
+        bind = mim.Connection()
+        bind.load(self.filename)
+        self.assertEqual(sorted(bind.database_names()), ['db', 'db2'])
+        self.assertEqual(sorted(bind.db.collection_names()), ['coll', 'other'])
+        for name in ('coll', 'other'):
+            self.assertEqual(list(bind.db[name].find().sort('_id')),
+                             list(self.bind.db[name].find().sort('_id')))
+        self.assertEqual(bind.db.coll.index_information(),
+                         self.bind.db.coll.index_information())
+        self.assertEqual(bind.db2.coll.find_one()['v'], 2)
+
+    def test_documents_decoded_lazily(self):
+        self.bind.dump(self.filename)
+        bind = mim.Connection()
+        bind.load(self.filename)
+        coll = bind.db.coll
+        self.assertNotIn('_data', coll.__dict__)
+        self.assertEqual(coll.find().count(), 10)
+        self.assertEqual(coll.find_one(3)['a'], 0)
+        decoded = [ v for v in dict.values(coll._data) if isinstance(v, dict) ]
+        self.assertEqual(len(decoded), 1)
+        self.assertNotIn('_indexes', coll.__dict__)
+        self.assertEqual(coll.find({'a': 1}).count(), 3)
+        self.assertIn('_indexes', coll.__dict__)
+
+    def test_indexes_restored_without_decoding(self):
+        coll = self.bind.db.coll
+        coll.insert({'_id': 10, 'b': {'c': 'y'}, 'e': datetime.utcnow()})
+        coll.ensure_index([('d', -1), ('a', 1)])
+        coll.ensure_index('e', expireAfterSeconds=3600)
+        self.bind.dump(self.filename)
+        bind = mim.Connection()
+        bind.load(self.filename)
+        # Dumping indexes not yet used copies their entries as they were
+        bind.dump(self.filename)
+        bind.load(self.filename)
+        restored = bind.db.coll
+        restored.insert({'_id': 11, 'a': 1})
+        decoded = [ v for v in dict.values(restored._data) if isinstance(v, dict) ]
+        self.assertEqual(decoded, [{'_id': 11, 'a': 1}])
+        coll.insert({'_id': 11, 'a': 1})
+        for name, index in coll._indexes.iteritems():
+            other = restored._indexes[name]
+            self.assertEqual(other._sorted, index._sorted)
+            self.assertEqual(other._hash, index._hash)
+            self.assertEqual(other._expires, index._expires)
+            self.assertEqual(other.multikey, index.multikey)
+        self.assertEqual(restored.find({'b.c': 3}).count(), 1)
+
+    def test_restored_collections_are_writable(self):
+        self.bind.dump(self.filename)
+        bind = mim.Connection()
+        bind.load(self.filename)
+        coll = bind.db.coll
+        self.assertRaises(DuplicateKeyError, coll.insert,
+                          {'_id': 99, 'b': {'c': [4, 'x']}}, safe=True)
+        coll.update({'a': 2}, {'$set': {'e': 1}}, multi=True)
+        coll.remove({'_id': 0})
+        self.assertEqual(coll.find({'e': 1}).count(), 3)
+        self.assertEqual(coll.find({'a': 0}).count(), 3)
+        # Dumping a loaded dump copies any undecoded documents verbatim
+        bind.dump(self.filename)
+        bind.load(self.filename)
+        self.assertEqual(bind.db.coll.find().count(), 9)
+        self.assertEqual(bind.db.coll.find({'e': 1}).count(), 3)
+
+    def test_clear_after_load(self):
+        self.bind.dump(self.filename)
+        self.bind.load(self.filename)
+        self.bind.clear_all()
+        self.assertEqual(self.bind.db.coll.find().count(), 0)
+        self.assertEqual(sorted(self.bind.db.coll.index_information()),
+                         ['a_1', 'b.c_1'])
+
+    def test_database_dump_load(self):
+        self.bind.db.dump(self.filename)
+        self.bind.db.coll.remove({})
+        self.bind.db.drop_collection('other')
+        self.bind.db.load(self.filename)
+        self.assertEqual(self.bind.db.coll.find().count(), 10)
+        self.assertEqual(self.bind.db.other.find_one('x')['v'], 1)
+        # A single-database dump can be loaded under another name
+        self.bind.fixture.load(self.filename)
+        self.assertEqual(self.bind.fixture.coll.find().count(), 10)
+
+    def test_copy_on_write(self):
+        self.bind.dump(self.filename)
+        bind = mim.Connection(copy_on_write=True)
+        bind.load(self.filename)
+        self.assertIsInstance(bind.db.coll._data[1], mim.mim.FrozenDict)
+        doc = bind.db.coll.find_one(1)
+        doc['a'] = 'changed'
+        self.assertEqual(bind.db.coll.find_one(1)['a'], 1)
+
+    def test_not_a_dump(self):
+        with open(self.filename, 'wb') as fp:
+            fp.write('x' * 100)
+        self.assertRaises(ValueError, self.bind.load, self.filename)
+
+
+class TestCheckpoint(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.db = self.bind.db
+        self.db.coll.insert([ {'_id': i, 'a': i % 3, 'b': [i]} for i in range(20) ])
+        self.db.coll.ensure_index('a')
+        self.db.keep.insert({'_id': 'k'})
+
+    def _state(self):
+        return dict(
+            (name, (list(self.db[name].find().sort('_id')),
+                    self.db[name].index_information(),
+                    [ self.db[name].find({'a': a}).count() for a in range(4) ]))
+            for name in sorted(self.db.collection_names()))
+
+    def test_rollback(self):
+        before = self._state()
+        cp = self.db.checkpoint()
+        coll = self.db.coll
+        coll.insert({'_id': 100, 'a': 3})
+        coll.update({'a': 1}, {'$set': {'a': 3}, '$push': {'b': 0}}, multi=True)
+        coll.save({'_id': 0, 'a': 2})
+        coll.remove({'a': 2})
+        coll.ensure_index('b')
+        coll.drop_index('a_1')
+        coll.find_and_modify({'_id': 3}, {'$inc': {'a': 10}})
+        self.db.keep.drop()
+        self.db.created.insert({'_id': 1})
+        self.assertNotEqual(self._state(), before)
+        self.db.rollback(cp)
+        self.assertEqual(self._state(), before)
+        self.assertEqual(self.db.coll.find({'a': 3}).count(), 0)
+        # The checkpoint can be rolled back to again
+        self.db.coll.remove({})
+        self.db.coll.drop_index('a_1')
+        self.db.coll.ensure_index('a', unique=True, sparse=True)
+        self.db.rollback(cp)
+        self.assertEqual(self._state(), before)
+
+    def test_profiled_writes_alongside(self):
+        bind = mim.Connection(thread_safe=True)
+        bind.set_profiling_level(2)
+        db = bind.db
+        db.coll.insert([ {'_id': i, 'a': 0} for i in range(10) ])
+        def write():
+            for i in range(500):
+                db.coll.update({'_id': i % 10}, {'$inc': {'a': 1}})
+        writers = [ threading.Thread(target=write) for i in range(2) ]
+        for writer in writers:
+            writer.daemon = True
+            writer.start()
+        for i in range(100):
+            cp = db.checkpoint()
+            db.rollback(cp)
+            db.release(cp)
+        for writer in writers:
+            writer.join(10)
+            self.assertFalse(writer.is_alive())
+        # rollback() rewinds system.profile too
+        self.assertTrue(db.system.profile.find({'op': 'update'}).count())
+
+    def test_cost_follows_changes(self):
+        cp = self.db.checkpoint()
+        self.db.coll.update({'_id': 1}, {'$set': {'a': 5}})
+        self.db.coll.remove({})
+        self.assertEqual(len(self.db.coll._journal), 2)
+        self.db.rollback(cp)
+        self.assertEqual(self.db.coll._journal, [])
+        self.assertEqual(self.db.coll.find_one(1)['a'], 1)
+
+    def test_nested(self):
+        outer = self.db.checkpoint()
+        self.db.coll.insert({'_id': 'outer'})
+        inner = self.db.checkpoint()
+        self.db.coll.insert({'_id': 'inner'})
+        self.db.rollback(inner)
+        self.assertIsNone(self.db.coll.find_one('inner'))
+        self.assertIsNotNone(self.db.coll.find_one('outer'))
+        self.db.coll.insert({'_id': 'inner'})
+        self.db.rollback(outer)
+        self.assertEqual(self.db.coll.find().count(), 20)
+        self.assertRaises(mim.mim.InvalidOperation, self.db.rollback, inner)
+
+    def test_release(self):
+        cp = self.db.checkpoint()
+        self.db.coll.insert({'_id': 'x'})
+        self.db.release(cp)
+        self.assertIsNone(self.db.coll._journal)
+        self.assertIsNotNone(self.db.coll.find_one('x'))
+        self.assertRaises(mim.mim.InvalidOperation, self.db.rollback, cp)
+
+    def test_isolated_from_callers(self):
+        cp = self.db.checkpoint()
+        doc = self.db.coll.find_one(1)
+        doc['a'] = 'changed'
+        self.db.coll.save(doc)
+        doc['a'] = 'changed again'
+        self.db.rollback(cp)
+        self.assertEqual(self.db.coll.find_one(1)['a'], 1)
+
+
+class TestAggregate(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.coll = self.bind.db.coll
+        self.coll.insert([
+                {'_id': 1, 'cust': 'a', 'qty': 2, 'price': 10.0,
+                 'tags': ['x', 'y'], 'd': datetime(2013, 3, 4),
+                 'items': [{'sku': 's1', 'n': 1}, {'sku': 's2', 'n': 3}]},
+                {'_id': 2, 'cust': 'b', 'qty': 5, 'price': 1.0,
+                 'tags': ['y'], 'd': datetime(2013, 4, 5)},
+                {'_id': 3, 'cust': 'a', 'qty': 1, 'price': 4.0,
+                 'tags': [], 'd': datetime(2014, 1, 1)},
+                {'_id': 4, 'cust': 'c', 'qty': 7, 'price': 2.5} ])
+
+    def _agg(self, *pipeline):
+        result = self.coll.aggregate(list(pipeline))
+        self.assertEqual(result['ok'], 1.0)
+        return result['result']
+
+    def test_match_sort_skip_limit(self):
+        self.coll.ensure_index('qty')
+        result = self._agg(
+            {'$match': {'qty': {'$gt': 1}}},
+            {'$sort': {'qty': -1}},
+            {'$skip': 1},
+            {'$limit': 1})
+        self.assertEqual([ d['_id'] for d in result ], [2])
+
+    def test_project(self):
+        result = self._agg(
+            {'$match': {'_id': 1}},
+            {'$project': {
+                    'cust': 1, 'items.sku': 1,
+                    'total': {'$multiply': ['$qty', '$price']},
+                    'upper': {'$toUpper': '$cust'},
+                    'when': {'year': {'$year': '$d'}, 'month': {'$month': '$d'}},
+                    'big': {'$cond': [{'$gte': ['$qty', 2]}, 'yes', 'no']},
+                    'missing': '$nope',
+                    'n': {'$size': '$tags'}}})
+        self.assertEqual(result, [{
+                    '_id': 1, 'cust': 'a',
+                    'items': [{'sku': 's1'}, {'sku': 's2'}],
+                    'total': 20.0, 'upper': 'A',
+                    'when': {'year': 2013, 'month': 3},
+                    'big': 'yes', 'n': 2}])
+        result = self._agg(
+            {'$match': {'_id': 1}},
+            {'$project': {'items': 0, 'tags': 0, 'd': 0, '_id': 0}})
+        self.assertEqual(result, [{'cust': 'a', 'qty': 2, 'price': 10.0}])
+        self.assertRaises(OperationFailure, self._agg,
+                          {'$project': {'cust': 1, 'qty': 0}})
+
+    def test_group(self):
+        result = self._agg(
+            {'$group': {'_id': '$cust',
+                        'n': {'$sum': 1},
+                        'qty': {'$sum': '$qty'},
+                        'avg': {'$avg': '$price'},
+                        'lo': {'$min': '$qty'},
+                        'hi': {'$max': '$qty'},
+                        'first': {'$first': '$_id'},
+                        'last': {'$last': '$_id'},
+                        'ids': {'$push': '$_id'},
+                        'tags': {'$addToSet': '$tags'}}},
+            {'$sort': {'_id': 1}})
+        self.assertEqual(result[0], {
+                '_id': 'a', 'n': 2, 'qty': 3, 'avg': 7.0, 'lo': 1, 'hi': 2,
+                'first': 1, 'last': 3, 'ids': [1, 3], 'tags': [['x', 'y'], []]})
+        self.assertEqual([ r['_id'] for r in result ], ['a', 'b', 'c'])
+        self.assertEqual(result[2]['tags'], [])
+        result = self._agg(
+            {'$group': {'_id': {'year': {'$year': '$d'}}, 'n': {'$sum': 1}}},
+            {'$sort': {'_id.year': 1}})
+        self.assertEqual(
+            [ (r['_id'], r['n']) for r in result ],
+            [({'year': None}, 1), ({'year': 2013}, 2), ({'year': 2014}, 1)])
+        self.assertRaises(OperationFailure, self._agg, {'$group': {'n': {'$sum': 1}}})
+
+    def test_unwind(self):
+        result = self._agg({'$unwind': '$tags'}, {'$sort': {'_id': 1}})
+        self.assertEqual([ (d['_id'], d['tags']) for d in result ],
+                         [(1, 'x'), (1, 'y'), (2, 'y')])
+        result = self._agg(
+            {'$unwind': {'path': '$tags', 'includeArrayIndex': 'i',
+                         'preserveNullAndEmptyArrays': True}},
+            {'$project': {'tags': 1, 'i': 1}})
+        self.assertEqual(sorted((d['_id'], d.get('tags'), d['i']) for d in result),
+                         [(1, 'x', 0), (1, 'y', 1), (2, 'y', 0),
+                          (3, [], None), (4, None, None)])
+        result = self._agg(
+            {'$unwind': '$items'},
+            {'$group': {'_id': None, 'n': {'$sum': '$items.n'}}})
+        self.assertEqual(result, [{'_id': None, 'n': 4}])
+
+    def test_cursor(self):
+        cursor = self.coll.aggregate([{'$unwind': '$tags'}], cursor={})
+        doc = cursor.next()
+        doc['tags'] = 'changed'
+        self.assertEqual(len(list(cursor)), 2)
+        self.assertNotEqual(self.coll.find_one(1)['tags'], 'changed')
+        # Stages pull documents one at a time
+        seen = []
+        def source(spec, sort=None, top=None):
+            for i in range(1000):
+                seen.append(i)
+                yield {'_id': i}
+        self.coll._find = source
+        cursor = self.coll.aggregate([{'$project': {'x': '$_id'}}], cursor={})
+        self.assertEqual(cursor.next(), {'_id': 0, 'x': 0})
+        self.assertEqual(seen, [0])
+
+    def test_stage_validation(self):
+        self.assertRaises(OperationFailure, self._agg, {'$bogus': {}})
+        self.assertRaises(OperationFailure, self._agg, {'$match': {}, '$limit': 1})
+        self.assertRaises(OperationFailure, self._agg,
+                          {'$project': {'x': {'$bogus': 1}}})
+
+    def test_command(self):
+        result = self.bind.db.command(
+            'aggregate', 'coll', pipeline=[{'$match': {'cust': 'a'}}])
+        self.assertEqual(sorted(d['_id'] for d in result['result']), [1, 3])
+
+
+def _map_tags(doc):
+    for tag in doc.get('tags', []):
+        yield tag, {'n': 1, 'total': doc['n']}
+
+def _reduce_tags(key, values):
+    return {'n': sum(v['n'] for v in values),
+            'total': sum(v['total'] for v in values)}
+
+class TestPythonMapReduce(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.db = self.bind.db
+        self.db.coll.insert([
+                {'_id': i, 'n': i, 'tags': ['all', 'odd' if i % 2 else 'even']}
+                for i in range(100) ])
+        self.expected = {
+            'all': {'n': 100, 'total': 4950},
+            'even': {'n': 50, 'total': 2450},
+            'odd': {'n': 50, 'total': 2500} }
+
+    def _results(self, result):
+        return dict((r['_id'], r['value']) for r in result['results'])
+
+    def test_inline(self):
+        result = self.db.coll.map_reduce(
+            _map_tags, _reduce_tags, {'inline': 1}, chunk_size=7)
+        self.assertEqual(self._results(result), self.expected)
+        self.assertEqual(result['counts'],
+                         dict(input=100, emit=200, reduce=3, output=3))
+
+    def test_query_sort_limit_finalize(self):
+        result = self.db.command(
+            'mapreduce', 'coll', map=_map_tags, reduce=_reduce_tags,
+            query={'n': {'$gte': 10}}, sort={'n': -1}, limit=5,
+            finalize=lambda k, v: v['total'], out={'inline': 1})
+        self.assertEqual(self._results(result),
+                         {'all': 485, 'odd': 291, 'even': 194})
+
+    def test_pool(self):
+        import multiprocessing
+        pool = multiprocessing.Pool(2)
+        try:
+            result = self.db.coll.map_reduce(
+                _map_tags, _reduce_tags, {'inline': 1},
+                pool=pool, chunk_size=10)
+        finally:
+            pool.terminate()
+        self.assertEqual(self._results(result), self.expected)
+
+    def test_out(self):
+        result = self.db.coll.map_reduce(_map_tags, _reduce_tags, 'tags')
+        self.assertEqual(result['result'], 'tags')
+        self.assertEqual(self.db.tags.find_one('odd')['value'],
+                         self.expected['odd'])
+        self.db.coll.remove({'n': {'$lt': 90}})
+        self.db.coll.map_reduce(_map_tags, _reduce_tags, {'reduce': 'tags'})
+        self.assertEqual(self.db.tags.find_one('all')['value'],
+                         {'n': 110, 'total': 4950 + 945})
+        self.db.coll.map_reduce(_map_tags, _reduce_tags, {'merge': 'tags'})
+        self.assertEqual(self.db.tags.find_one('all')['value'],
+                         {'n': 10, 'total': 945})
+        self.assertEqual(self.db.tags.find().count(), 3)
+        self.db.coll.remove({'n': {'$lt': 99}})
+        self.db.coll.map_reduce(_map_tags, _reduce_tags, {'replace': 'tags'})
+        self.assertEqual(sorted(self.db.tags.find().distinct('_id')),
+                         ['all', 'odd'])
+
+
+class TestBulk(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.coll = self.bind.db.coll
+        self.coll.ensure_index('u', unique=True, sparse=True)
+        self.coll.ensure_index('a')
+        self.coll.insert([ {'_id': i, 'a': i % 3} for i in range(10) ])
+
+    def test_ordered(self):
+        bulk = self.coll.initialize_ordered_bulk_op()
+        bulk.insert({'_id': 10, 'a': 1})
+        bulk.insert({'a': 2})
+        bulk.find({'a': 1}).update({'$set': {'b': 1}})
+        bulk.find({'_id': 99}).upsert().update_one({'$set': {'a': 5}})
+        bulk.find({'_id': 0}).replace_one({'a': 7})
+        bulk.find({'a': 2}).remove_one()
+        bulk.find({'a': 0}).remove()
+        result = bulk.execute()
+        self.assertEqual(result['nInserted'], 2)
+        self.assertEqual(result['nMatched'], 5)
+        self.assertEqual(result['nUpserted'], 1)
+        self.assertEqual(result['upserted'], [{'index': 3, '_id': 99}])
+        self.assertEqual(result['nRemoved'], 4)
+        self.assertEqual(result['writeErrors'], [])
+        self.assertEqual(self.coll.find({'b': 1}).count(), 4)
+        self.assertEqual(self.coll.find_one(0), {'_id': 0, 'a': 7})
+        self.assertEqual(self.coll.find({'a': 2}).count(), 3)
+        self.assertRaises(mim.mim.InvalidOperation, bulk.execute)
+
+    def test_ordered_stops_at_error(self):
+        bulk = self.coll.initialize_ordered_bulk_op()
+        bulk.insert({'_id': 20, 'u': 1})
+        bulk.insert({'_id': 21, 'u': 1})
+        bulk.insert({'_id': 22})
+        bulk.find({'_id': 1}).remove_one()
+        try:
+            bulk.execute()
+        except mim.mim.BulkWriteError, e:
+            details = e.details
+        else:
+            self.fail('no BulkWriteError')
+        self.assertEqual(details['nInserted'], 1)
+        self.assertEqual(details['nRemoved'], 0)
+        self.assertEqual([ (err['index'], err['code']) for err in details['writeErrors'] ],
+                         [(1, 11000)])
+        self.assertEqual(details['writeErrors'][0]['op']['_id'], 21)
+        self.assertIsNotNone(self.coll.find_one(20))
+        self.assertIsNone(self.coll.find_one(22))
+
+    def test_update_duplicate_key(self):
+        self.coll.insert({'_id': 20, 'u': 1})
+        bulk = self.coll.initialize_ordered_bulk_op()
+        bulk.find({'_id': 2}).update({'$set': {'u': 1}})
+        try:
+            bulk.execute()
+        except mim.mim.BulkWriteError, e:
+            details = e.details
+        else:
+            self.fail('no BulkWriteError')
+        self.assertEqual([ (err['index'], err['code']) for err in details['writeErrors'] ],
+                         [(0, 11000)])
+        with self.assertRaises(DuplicateKeyError) as cm:
+            self.coll.insert({'_id': 21, 'u': 1})
+        self.assertEqual(cm.exception.code, 11000)
+
+    def test_unordered_continues(self):
+        bulk = self.coll.initialize_unordered_bulk_op()
+        bulk.find({'_id': 1}).remove_one()
+        bulk.insert({'_id': 1})
+        bulk.insert({'_id': 20, 'u': 1})
+        bulk.insert({'_id': 21, 'u': 1})
+        bulk.insert({'_id': 22, 'u': 2})
+        try:
+            bulk.execute()
+        except mim.mim.BulkWriteError, e:
+            details = e.details
+        else:
+            self.fail('no BulkWriteError')
+        # Inserts run before removes when unordered
+        self.assertEqual([ err['index'] for err in details['writeErrors'] ], [1, 3])
+        self.assertEqual(details['nInserted'], 2)
+        self.assertEqual(details['nRemoved'], 1)
+        self.assertEqual(self.coll.find({'u': {'$exists': True}}).count(), 2)
+
+    def test_bulk_write(self):
+        from pymongo.operations import InsertOne, UpdateMany, DeleteOne, ReplaceOne
+        result = self.coll.bulk_write([
+                InsertOne({'_id': 10, 'a': 0}),
+                UpdateMany({'a': 0}, {'$inc': {'a': 10}}),
+                ReplaceOne({'_id': 50}, {'x': 1}, upsert=True),
+                DeleteOne({'_id': 1})])
+        self.assertEqual(result.inserted_count, 1)
+        self.assertEqual(result.modified_count, 5)
+        self.assertEqual(result.upserted_ids, {2: 50})
+        self.assertEqual(result.deleted_count, 1)
+        self.assertEqual(self.coll.find({'a': 10}).count(), 5)
+
+    def test_insert_many(self):
+        docs = [ {'a': i % 3, 'u': i} for i in range(1000) ]
+        result = self.coll.insert_many(docs)
+        self.assertEqual(len(result.inserted_ids), 1000)
+        self.assertEqual(self.coll.find().count(), 1010)
+        self.assertEqual(self.coll.find({'a': 1}).count(), 336)
+        self.assertEqual(self.coll.find({'u': 999}).count(), 1)
+        index = self.coll._indexes['a_1']
+        self.assertEqual(index._sorted, sorted(index._sorted))
+        self.assertEqual(len(index._sorted), 1010)
+
+    def test_insert_list(self):
+        self.coll.insert([ {'_id': 5}, {'_id': 10, 'u': 1} ])
+        self.assertEqual(self.coll.find_one(5), {'_id': 5, 'a': 2})
+        self.assertRaises(DuplicateKeyError, self.coll.insert,
+                          [ {'_id': 11}, {'_id': 5} ], safe=True)
+        self.assertRaises(DuplicateKeyError, self.coll.insert,
+                          [ {'_id': 12}, {'_id': 13, 'u': 1}, {'_id': 14} ])
+        self.assertEqual(
+            [ self.coll.find_one(i) is not None for i in (11, 12, 13, 14) ],
+            [True, True, False, False])
+
+class TestProfiler(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.db = self.bind['db']
+        self.coll = self.db.coll
+        for i in range(10):
+            self.coll.insert({'_id': i, 'a': i % 2})
+        self.coll.ensure_index('a')
+
+    def _profile(self):
+        return list(self.db['system.profile'].find().sort('_id'))
+
+    def test_off_by_default(self):
+        self.assertEqual(self.db.profiling_level(), 0)
+        list(self.coll.find({'a': 1}))
+        self.assertEqual(self._profile(), [])
+
+    def test_set_profiling_level(self):
+        self.db.set_profiling_level(1, slow_ms=50)
+        self.assertEqual(self.db.profiling_level(), 1)
+        self.assertEqual(self.db.command('profile', -1)['slowms'], 50)
+        list(self.coll.find({'a': 1}))
+        self.assertEqual(self._profile(), [])
+
+    def test_query(self):
+        self.db.set_profiling_level(2)
+        self.assertEqual(len(list(self.coll.find({'a': 1}))), 5)
+        list(self.coll.find({'_id': {'$gt': 2}}).sort('b', -1).limit(2))
+        by_index, by_scan = self._profile()
+        self.assertEqual(by_index['op'], 'query')
+        self.assertEqual(by_index['ns'], 'db.coll')
+        self.assertEqual(by_index['query'], {'a': 1})
+        self.assertEqual(by_index['planSummary'], 'IXSCAN { a: 1 }')
+        self.assertEqual(by_index['nscanned'], 5)
+        self.assertEqual(by_index['nreturned'], 5)
+        self.assertFalse(by_index['scanAndOrder'])
+        self.assertTrue(isinstance(by_index['millis'], float))
+        self.assertEqual(by_scan['planSummary'], 'COLLSCAN')
+        self.assertTrue(by_scan['scanAndOrder'])
+        self.assertEqual(by_scan['nscanned'], 10)
+        self.assertEqual(by_scan['nreturned'], 2)
+        self.assertEqual(by_scan['ntoreturn'], 2)
+
+    def test_abandoned_cursor(self):
+        import gc
+        self.db.set_profiling_level(2)
+        cursor = self.coll.find()
+        cursor.next()
+        self.assertEqual(self._profile(), [])
+        cursor.close()
+        entry, = self._profile()
+        self.assertEqual(entry['nreturned'], 1)
+        # Only closing the cursor writes its entry, not collecting it
+        cursor = self.coll.find()
+        cursor.next()
+        del cursor
+        gc.collect()
+        self.assertEqual(len(self._profile()), 1)
+        self.coll.find_one({'a': 1})
+        self.assertEqual(self._profile()[-1]['query'], {'a': 1})
+
+    def test_find_one_and_count(self):
+        self.db.set_profiling_level(2)
+        self.coll.find_one(3)
+        self.coll.find({'a': 0}).count()
+        by_id, count = self._profile()
+        self.assertEqual(by_id['planSummary'], 'IDHACK')
+        self.assertEqual(by_id['nreturned'], 1)
+        self.assertEqual(count['op'], 'command')
+        self.assertEqual(count['command'], {'count': 'coll', 'query': {'a': 0}})
+        self.assertEqual(count['planSummary'], 'COUNT_SCAN { a: 1 }')
+
+    def test_writes(self):
+        self.bind.set_profiling_level(2)
+        self.coll.insert([{'_id': 20}, {'_id': 21}])
+        self.coll.update({'a': 1}, {'$set': {'b': 1}}, multi=True)
+        self.coll.update({'_id': 30}, {'$set': {'b': 1}}, upsert=True)
+        self.coll.remove({'a': 0})
+        insert, update, upsert, remove = self._profile()
+        self.assertEqual(insert['ninserted'], 2)
+        self.assertEqual((update['nMatched'], update['planSummary']),
+                         (5, 'IXSCAN { a: 1 }'))
+        self.assertTrue(upsert['upserted'])
+        self.assertEqual(remove['ndeleted'], 5)
+
+    def test_top(self):
+        self.bind.set_profiling_level(1, slow_ms=10000)
+        self.coll.find_one(1)
+        list(self.coll.find())
+        self.coll.insert({'_id': 20})
+        self.bind['other'].coll.insert({})
+        self.assertEqual(self._profile(), [])
+        totals = self.bind.admin.command('top')['totals']
+        self.assertEqual(sorted(totals), ['db.coll', 'other.coll'])
+        self.assertEqual(totals['db.coll']['queries']['count'], 2)
+        self.assertEqual(totals['db.coll']['insert']['count'], 1)
+        self.assertEqual(totals['db.coll']['total']['count'], 3)
+
+class TestExplain(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.coll = self.bind.db.coll
+        self.coll.ensure_index('a')
+        self.coll.ensure_index('b')
+        self.coll.ensure_index('tags')
+        for i in range(20):
+            self.coll.insert({'_id': i, 'a': i % 4, 'b': i, 'tags': ['x', 'y']})
+
+    def test_collection_scan(self):
+        plan = self.coll.find({'c': 1}).explain()
+        self.assertEqual(plan['cursor'], 'BasicCursor')
+        self.assertEqual(plan['planSummary'], 'COLLSCAN')
+        self.assertEqual((plan['n'], plan['nscanned'], plan['nscannedObjects']),
+                         (0, 20, 20))
+        self.assertFalse(plan['scanAndOrder'])
+
+    def test_index(self):
+        plan = self.coll.find({'a': 1, 'b': {'$gt': 15}}).explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor b_1')
+        self.assertEqual(plan['planSummary'], 'IXSCAN { b: 1 }')
+        self.assertEqual((plan['n'], plan['nscanned']), (1, 4))
+        self.assertFalse(plan['isMultiKey'])
+
+    def test_id(self):
+        plan = self.coll.find({'_id': {'$in': [1, 2, 50]}}).explain()
+        self.assertEqual(plan['cursor'], 'IDCursor')
+        self.assertEqual((plan['n'], plan['nscanned'], plan['nscannedObjects']),
+                         (2, 2, 2))
+
+    def test_sort(self):
+        plan = self.coll.find({'a': 1}).sort('c').explain()
+        self.assertTrue(plan['scanAndOrder'])
+        plan = self.coll.find().sort('b', -1).limit(3).explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor b_1')
+        self.assertFalse(plan['scanAndOrder'])
+        self.assertEqual((plan['n'], plan['nscanned']), (3, 3))
+
+    def test_hint_forces_index(self):
+        cursor = self.coll.find({'a': 1, 'b': {'$gt': 10}})
+        self.assertEqual(cursor.explain()['cursor'], 'BtreeCursor a_1')
+        cursor.hint('b_1')
+        self.assertEqual(sorted(doc['b'] for doc in cursor.clone()), [13, 17])
+        plan = cursor.explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor b_1')
+        self.assertEqual(plan['nscanned'], 9)
+
+    def test_hint_full_index_scan(self):
+        cursor = self.coll.find({'b': {'$lt': 3}}).hint([('tags', 1)])
+        self.assertEqual(sorted(doc['_id'] for doc in cursor.clone()), [0, 1, 2])
+        plan = cursor.explain()
+        self.assertEqual(plan['cursor'], 'BtreeCursor tags_1')
+        self.assertTrue(plan['isMultiKey'])
+        self.assertEqual((plan['nscanned'], plan['nscannedObjects']), (20, 20))
+
+    def test_hint_natural(self):
+        cursor = self.coll.find({'_id': 3}).hint([('$natural', 1)])
+        self.assertEqual(cursor.explain()['cursor'], 'BasicCursor')
+        self.assertEqual(list(cursor), [{'_id': 3, 'a': 3, 'b': 3, 'tags': ['x', 'y']}])
+
+    def test_hint_after_iteration(self):
+        cursor = self.coll.find()
+        cursor.next()
+        self.assertRaises(InvalidOperation, cursor.hint, 'a')
+
+class TestCompoundIndex(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.coll = self.bind.db.coll
+        self.coll.ensure_index([('a', 1), ('b', -1)])
+        for i in range(60):
+            doc = {'_id': i, 'a': i % 3, 'b': i % 10}
+            if i % 7 == 0: del doc['b']
+            self.coll.insert(doc)
+
+    def _check(self, spec, sort=None, cursor='BtreeCursor a_1_b_-1'):
+        cursor_ = self.coll.find(spec)
+        natural = self.coll.find(spec).hint([('$natural', 1)])
+        if sort:
+            cursor_ = cursor_.sort(sort)
+            natural = natural.sort(sort)
+        self.assertEqual(cursor_.explain()['cursor'], cursor)
+        result = list(cursor_)
+        expected = list(natural)
+        if sort:
+            key = lambda doc: [ doc.get(k) for k, d in sort ]
+            self.assertEqual(map(key, result), map(key, expected))
+        self.assertEqual(sorted(result), sorted(expected))
+        return cursor_.explain()
+
+    def test_ensure_index_conflicts(self):
+        self.assertEqual(self.coll.ensure_index([('a', 1), ('b', -1)]),
+                         'a_1_b_-1')
+        with self.assertRaises(OperationFailure) as cm:
+            self.coll.ensure_index([('a', 1), ('b', -1)], sparse=True)
+        self.assertEqual(cm.exception.code, 85)
+        with self.assertRaises(OperationFailure) as cm:
+            self.coll.ensure_index([('a', 1), ('b', -1)], name='other')
+        self.assertEqual(cm.exception.code, 85)
+        with self.assertRaises(OperationFailure) as cm:
+            self.coll.ensure_index('c', name='a_1_b_-1')
+        self.assertEqual(cm.exception.code, 86)
+        self.assertEqual(self.coll.index_information()['a_1_b_-1']['key'],
+                         [('a', 1), ('b', -1)])
+
+    def test_same_fields_other_directions(self):
+        self.assertEqual(self.coll.ensure_index([('a', 1), ('b', 1)]),
+                         'a_1_b_1')
+        self.assertEqual(self.coll.ensure_index('b', name='by_b'), 'by_b')
+        self.assertEqual(sorted(self.coll.index_information()),
+                         ['a_1_b_-1', 'a_1_b_1', 'by_b'])
+        self._check({'a': 1}, [('b', 1)], cursor='BtreeCursor a_1_b_1')
+        self.coll.drop_index([('a', 1), ('b', 1)])
+        self.assertEqual(sorted(self.coll.index_information()),
+                         ['a_1_b_-1', 'by_b'])
+
+    def test_key(self):
+        self.assertEqual(self.coll.index_information()['a_1_b_-1']['key'],
+                         [('a', 1), ('b', -1)])
+        self.assertEqual(self.coll._indexes['a_1_b_-1'].summary(), '{ a: 1, b: -1 }')
+
+    def test_prefix_and_range(self):
+        plan = self._check({'a': 1, 'b': {'$gt': 2, '$lte': 6}})
+        self.assertEqual((plan['n'], plan['nscanned']), (8, 8))
+        plan = self._check({'a': 2})
+        self.assertEqual(plan['nscanned'], 20)
+        self._check({'a': {'$in': [2, 0]}, 'b': 3})
+        self._check({'a': 0, 'b': None})
+        self._check({'a': 0, 'b': {'$in': [None, 4]}})
+
+    def test_sort(self):
+        plan = self._check({}, [('a', 1), ('b', -1)])
+        self.assertFalse(plan['scanAndOrder'])
+        plan = self._check({}, [('a', -1), ('b', 1)])
+        self.assertFalse(plan['scanAndOrder'])
+        plan = self._check({'a': 1}, [('b', 1)])
+        self.assertFalse(plan['scanAndOrder'])
+        plan = self._check({'a': 1, 'b': {'$lt': 5}}, [('b', -1)])
+        self.assertEqual(plan['nscanned'], plan['n'])
+        self.assertFalse(plan['scanAndOrder'])
+        self._check({'a': {'$in': [2, 0]}}, [('a', -1)])
+        plan = self._check({'a': {'$gt': 0}}, [('a', 1), ('b', 1)])
+        self.assertTrue(plan['scanAndOrder'])
+
+    def test_null_sorts_with_missing(self):
+        self.coll.insert([ {'_id': 'n1', 'a': None, 'b': 5},
+                           {'_id': 'm1', 'b': 1},
+                           {'_id': 'n2', 'a': None, 'b': 0} ])
+        self._check({}, [('a', -1), ('b', 1)])
+        self.assertEqual(self._check({'a': {'$lt': None}})['n'], 1)
+        self.assertEqual(self._check({'a': {'$lte': None}})['n'], 3)
+
+    def test_dump_load_keeps_directions(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'db.mim')
+            self.bind.dump(filename)
+            bind = mim.Connection()
+            bind.load(filename)
+            coll = bind.db.coll
+            self.assertEqual(coll.index_information()['a_1_b_-1']['key'],
+                             [('a', 1), ('b', -1)])
+            self.assertEqual(
+                [ doc['_id'] for doc in coll.find({'a': 1}).sort('b', -1).limit(3) ],
+                [ doc['_id'] for doc in self.coll.find({'a': 1}).sort('b', -1).limit(3) ])
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_batched_insert(self):
+        self.coll.insert([ {'a': i % 3, 'b': -i} for i in range(5) ])
+        index = self.coll._indexes['a_1_b_-1']
+        self.assertEqual(index._sorted, sorted(index._sorted))
+        self._check({'a': 1, 'b': {'$lt': 0}})
+
+class TestMultikeyIndex(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.coll = self.bind.db.coll
+        self.coll.ensure_index('tags')
+        self.coll.ensure_index('items.k')
+        self.coll.ensure_index([('n', 1), ('tags', 1)])
+        for i in range(40):
+            self.coll.insert({
+                    '_id': i, 'n': i % 4,
+                    'tags': [ 't%d' % (i % 5), 't%d' % (i % 7), i ],
+                    'items': [ {'k': 'k%d' % (i % 3), 'v': i},
+                               {'k': 'k%d' % (i % 4), 'v': -i} ] })
+        self.coll.insert({'_id': 'scalar', 'n': 0, 'tags': 't1', 'items': {'k': 'k1'}})
+        self.coll.insert({'_id': 'empty', 'n': 1, 'tags': [], 'items': []})
+
+    def _check(self, spec, index):
+        cursor = self.coll.find(spec)
+        self.assertEqual(cursor.explain()['cursor'], 'BtreeCursor ' + index)
+        natural = self.coll.find(spec).hint([('$natural', 1)])
+        result = sorted(doc['_id'] for doc in cursor)
+        self.assertEqual(result, sorted(doc['_id'] for doc in natural))
+        return result
+
+    def test_element_queries(self):
+        self.assertEqual(len(self._check({'tags': 't3'}, 'tags_1')), 12)
+        self._check({'tags': {'$in': ['t1', 't6']}}, 'tags_1')
+        self._check({'tags': {'$all': ['t2', 't3']}}, 'tags_1')
+        self._check({'tags': {'$gt': 10, '$lt': 20}}, 'tags_1')
+        self._check({'tags': {'$elemMatch': {'$gte': 30, '$lt': 33}}}, 'tags_1')
+        self._check({'n': 2, 'tags': 't4'}, 'n_1_tags_1')
+
+    def test_dotted_paths(self):
+        self.assertIn('scalar', self._check({'items.k': 'k1'}, 'items.k_1'))
+        self._check({'items': {'$elemMatch': {'k': 'k2', 'v': {'$gt': 20}}}}, 'items.k_1')
+        self._check({'items.k': {'$in': ['k0', 'k3']}}, 'items.k_1')
+
+    def test_no_duplicates(self):
+        result = list(self.coll.find({'tags': {'$gte': 't0'}}))
+        self.assertEqual(len(result), len(set(doc['_id'] for doc in result)))
+        self.assertEqual(len(result), self.coll.find(
+                {'tags': {'$gte': 't0'}}).hint([('$natural', 1)]).count())
+
+    def test_maintained_by_writes(self):
+        self.coll.update({'_id': 3}, {'$set': {'tags': ['new']}})
+        self.coll.remove({'_id': 4})
+        self.assertEqual(self._check({'tags': 'new'}, 'tags_1'), [3])
+        self.assertEqual(self._check({'tags': 't3'}, 'tags_1'),
+                         [8, 10, 13, 17, 18, 23, 24, 28, 31, 33, 38])
+        index = self.coll._indexes['tags_1']
+        self.assertEqual(len(index._sorted), sum(len(keys) for keys in index._entries.values()))
+
+    def test_unique_elements(self):
+        coll = self.bind.db.unique
+        coll.ensure_index('tags', unique=True)
+        coll.insert({'_id': 1, 'tags': ['a', 'b', 'a']})
+        self.assertRaises(DuplicateKeyError, coll.insert, {'_id': 2, 'tags': ['c', 'b']})
+        self.assertRaises(DuplicateKeyError, coll.insert, {'_id': 3, 'tags': 'a'})
+        coll.insert({'_id': 4, 'tags': ['c']})
+        self.assertRaises(DuplicateKeyError, coll.update, {'_id': 4}, {'$push': {'tags': 'a'}})
+        self.coll.drop_index('tags_1')
+        self.assertRaises(DuplicateKeyError, self.coll.ensure_index, 'tags', unique=True)
+
+class TestTTL(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2014, 1, 1)
+        self.bind = mim.Connection(clock=lambda: self.now)
+        self.coll = self.bind.db.sessions
+        self.coll.ensure_index('last_seen', expireAfterSeconds=60)
+
+    def _advance(self, seconds):
+        self.now += timedelta(seconds=seconds)
+
+    def _ids(self):
+        return sorted(doc['_id'] for doc in self.coll.find())
+
+    def test_expiry(self):
+        for i in range(5):
+            self.coll.insert({'_id': i, 'last_seen': self.now + timedelta(seconds=i * 10)})
+        self.coll.insert({'_id': 'no date', 'last_seen': 'yesterday'})
+        self.coll.insert({'_id': 'missing'})
+        self._advance(59)
+        self.assertEqual(self.coll.find().count(), 7)
+        self._advance(1)
+        self.assertEqual(self._ids(), [1, 2, 3, 4, 'missing', 'no date'])
+        self._advance(25)
+        self.assertIsNone(self.coll.find_one(2))
+        self.assertEqual(self._ids(), [3, 4, 'missing', 'no date'])
+
+    def test_updates_reschedule(self):
+        self.coll.insert({'_id': 1, 'last_seen': self.now})
+        self.coll.insert({'_id': 2, 'last_seen': self.now})
+        self._advance(30)
+        self.coll.update({'_id': 1}, {'$set': {'last_seen': self.now}})
+        self.coll.update({'_id': 2}, {'$set': {'last_seen': 'never'}})
+        self._advance(30)
+        self.assertEqual(self._ids(), [1, 2])
+        self._advance(30)
+        self.assertEqual(self._ids(), [2])
+
+    def test_array_of_dates(self):
+        self.coll.insert({'_id': 1, 'last_seen': [self.now + timedelta(seconds=100), self.now]})
+        self._advance(60)
+        self.assertEqual(self._ids(), [])
+
+    def test_writes_expire(self):
+        self.coll.insert([ {'last_seen': self.now} for i in range(100) ])
+        self._advance(61)
+        self.coll.insert({'_id': 'new', 'last_seen': self.now})
+        self.assertEqual(len(self.coll._data), 1)
+        index = self.coll._indexes['last_seen_1']
+        self.assertEqual(index._expires.keys(), ['new'])
+
+    def test_index_information(self):
+        self.assertEqual(self.coll.index_information()['last_seen_1'],
+                         {'key': [('last_seen', 1)], 'expireAfterSeconds': 60})
+        self.assertRaises(OperationFailure, self.coll.ensure_index,
+                          [('a', 1), ('b', 1)], expireAfterSeconds=10)
+        self.coll.drop_index('last_seen_1')
+        self.coll.insert({'_id': 1, 'last_seen': self.now})
+        self._advance(100)
+        self.assertEqual(self._ids(), [1])
+
+    def test_dump_load(self):
+        self.coll.insert({'_id': 1, 'last_seen': self.now})
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'db.mim')
+            self.bind.dump(filename)
+            bind = mim.Connection(clock=lambda: self.now)
+            bind.load(filename)
+            self.assertEqual(bind.db.sessions.find().count(), 1)
+            self._advance(60)
+            self.assertEqual(bind.db.sessions.find().count(), 0)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_rollback_restores_expired(self):
+        self.coll.insert({'_id': 1, 'last_seen': self.now})
+        checkpoint = self.bind.db.checkpoint()
+        self.coll.update({'_id': 1}, {'$set': {'last_seen': self.now + timedelta(days=1)}})
+        self._advance(60)
+        self.assertEqual(self._ids(), [1])
+        self.bind.db.rollback(checkpoint)
+        self.assertEqual(self._ids(), [])
+
+class TestCapped(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.coll = self.bind.db.create_collection(
+            'log', capped=True, size=10000, max=5, autoIndexId=False)
+
+    def _ks(self, cursor):
+        return [ doc['k'] for doc in cursor ]
+
+    def test_create(self):
+        self.assertIn('log', self.bind.db.collection_names())
+        self.assertEqual(self.coll.options(), dict(
+                capped=True, size=10000, max=5, autoIndexId=False))
+        self.assertRaises(CollectionInvalid, self.bind.db.create_collection, 'log')
+        self.assertRaises(OperationFailure, self.bind.db.create_collection,
+                          'other', capped=True)
+        self.bind.db.command('create', 'other', capped=True, size=100)
+        self.assertEqual(self.bind.db.other.options()['size'], 100)
+
+    def test_evicts_oldest(self):
+        for i in range(8):
+            self.coll.insert({'k': i}, manipulate=False)
+        self.assertEqual(self._ks(self.coll.find()), [3, 4, 5, 6, 7])
+        self.assertEqual(self.coll.find().count(), 5)
+        self.coll.insert([ {'k': i} for i in range(8, 11) ], manipulate=False)
+        self.assertEqual(self._ks(self.coll.find()), [6, 7, 8, 9, 10])
+
+    def test_evicts_by_size(self):
+        coll = self.bind.db.create_collection('small', capped=True, size=150)
+        for i in range(10):
+            coll.insert({'_id': i, 'pad': 'x' * 20})
+        self.assertEqual([ doc['_id'] for doc in coll.find() ], [7, 8, 9])
+        self.assertIsNone(coll.find_one({'_id': 6}))
+
+    def test_natural_order(self):
+        for i in [3, 1, 4, 1, 5]:
+            self.coll.insert({'k': i}, manipulate=False)
+        self.assertEqual(self._ks(self.coll.find()), [3, 1, 4, 1, 5])
+        self.assertEqual(self._ks(self.coll.find().sort('$natural', -1)),
+                         [5, 1, 4, 1, 3])
+        self.assertEqual(self.coll.find_one(
+                {}, sort=[('$natural', -1)], limit=1)['k'], 5)
+        self.assertEqual(
+            self.coll.find().sort('$natural', -1).explain()['cursor'],
+            'ReverseCappedCursor')
+
+    def test_no_removes(self):
+        self.coll.insert({'_id': 1, 'k': 1})
+        self.assertRaises(OperationFailure, self.coll.remove, {'_id': 1})
+        self.coll.update({'_id': 1}, {'$set': {'k': 2}})
+        self.coll.update({'k': 2}, {'$set': {'k': 3}})
+        self.assertEqual(self._ks(self.coll.find()), [3])
+
+    def test_tailable(self):
+        self.coll.insert({'k': 0}, manipulate=False)
+        cursor = self.coll.find({'k': {'$ne': 2}}, tailable=True)
+        self.assertEqual(cursor.next()['k'], 0)
+        self.assertRaises(StopIteration, cursor.next)
+        for i in range(1, 4):
+            self.coll.insert({'k': i}, manipulate=False)
+        self.assertEqual(self._ks(cursor), [1, 3])
+        self.coll.insert({'k': 4}, manipulate=False)
+        self.assertEqual(self._ks(cursor), [4])
+
+    def test_tailable_position_lost(self):
+        cursor = self.coll.find(tailable=True)
+        self.coll.insert({'k': 0}, manipulate=False)
+        self.assertEqual(self._ks(cursor), [0])
+        for i in range(1, 7):
+            self.coll.insert({'k': i}, manipulate=False)
+        self.assertRaises(OperationFailure, cursor.next)
+
+    def test_tailable_needs_capped(self):
+        cursor = self.bind.db.plain.find().add_option(
+            _QUERY_OPTIONS['tailable_cursor'])
+        self.assertRaises(OperationFailure, cursor.next)
+
+    def test_await_data(self):
+        bind = mim.Connection(thread_safe=True)
+        coll = bind.db.create_collection('log', capped=True, size=10000)
+        cursor = coll.find(tailable=True, await_data=True).max_await_time_ms(5000)
+        timer = threading.Timer(0.05, coll.insert, [{'_id': 1}])
+        timer.start()
+        self.assertEqual(cursor.next(), {'_id': 1})
+        timer.join()
+        cursor = coll.find(tailable=True, await_data=True).max_await_time_ms(50)
+        self.assertEqual(cursor.next(), {'_id': 1})
+        self.assertRaises(StopIteration, cursor.next)
+
+    def test_rollback(self):
+        for i in range(5):
+            self.coll.insert({'k': i}, manipulate=False)
+        checkpoint = self.bind.db.checkpoint()
+        for i in range(5, 8):
+            self.coll.insert({'k': i}, manipulate=False)
+        self.bind.db.rollback(checkpoint)
+        self.assertEqual(self._ks(self.coll.find()), [0, 1, 2, 3, 4])
+        self.coll.insert({'k': 5}, manipulate=False)
+        self.assertEqual(self._ks(self.coll.find()), [1, 2, 3, 4, 5])
+
+    def test_dump_load(self):
+        for i in range(7):
+            self.coll.insert({'k': i}, manipulate=False)
+        tmp = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmp, 'db.mim')
+            self.bind.dump(filename)
+            bind = mim.Connection()
+            bind.load(filename)
+            coll = bind.db.log
+            self.assertEqual(coll.options()['max'], 5)
+            self.assertEqual(self._ks(coll.find()), [2, 3, 4, 5, 6])
+            coll.insert({'k': 7}, manipulate=False)
+            self.assertEqual(self._ks(coll.find()), [3, 4, 5, 6, 7])
+        finally:
+            shutil.rmtree(tmp)
+
+class TestOplog(TestCase):
+
+    def setUp(self):
+        self.now = datetime(2014, 1, 1)
+        self.bind = mim.Connection(clock=lambda: self.now, oplog_size=4000)
+        self.oplog = self.bind.local['oplog.rs']
+
+    def _entries(self):
+        return [ (e['op'], e['ns'], e['o']) for e in self.oplog.find() ]
+
+    def test_writes(self):
+        coll = self.bind.db.coll
+        coll.insert({'_id': 1, 'a': 1})
+        coll.update({'_id': 1}, {'$set': {'a': 2}})
+        coll.remove({'_id': 1})
+        self.bind.db.drop_collection('coll')
+        self.bind.db.other.insert({'_id': 2})
+        self.assertEqual(self._entries(), [
+                ('i', 'db.coll', {'_id': 1, 'a': 1}),
+                ('u', 'db.coll', {'_id': 1, 'a': 2}),
+                ('d', 'db.coll', {'_id': 1}),
+                ('c', 'db.$cmd', {'drop': 'coll'}),
+                ('i', 'db.other', {'_id': 2}) ])
+        self.assertEqual(self.oplog.find_one({'op': 'u'})['o2'], {'_id': 1})
+        self.assertTrue(self.oplog.options()['capped'])
+
+    def test_timestamps(self):
+        for i in range(3):
+            self.bind.db.coll.insert({'_id': i})
+        self.now += timedelta(seconds=1)
+        self.bind.db.coll.insert({'_id': 3})
+        self.now -= timedelta(seconds=5)
+        self.bind.db.coll.insert({'_id': 4})
+        secs = calendar.timegm(datetime(2014, 1, 1).utctimetuple())
+        self.assertEqual([ e['ts'] for e in self.oplog.find() ], [
+                bson.Timestamp(secs, 1), bson.Timestamp(secs, 2),
+                bson.Timestamp(secs, 3), bson.Timestamp(secs + 1, 1),
+                bson.Timestamp(secs + 1, 2) ])
+
+    def test_bounded(self):
+        for i in range(100):
+            self.bind.db.coll.insert({'_id': i})
+        ids = [ e['o']['_id'] for e in self.oplog.find() ]
+        self.assertTrue(len(ids) < 100)
+        self.assertEqual(ids, range(100 - len(ids), 100))
+
+    def test_ts_index(self):
+        for i in range(10):
+            self.bind.db.coll.insert({'_id': i})
+        ts = self.oplog.find_one({'o._id': 6})['ts']
+        cursor = self.oplog.find({'ts': {'$gt': ts}})
+        self.assertEqual([ e['o']['_id'] for e in cursor ], [7, 8, 9])
+        plan = self.oplog.find({'ts': {'$gt': ts}}).explain()
+        self.assertEqual(plan['planSummary'], 'IXSCAN { ts: 1 }')
+        self.assertEqual(plan['nscanned'], 3)
+
+    def test_unlogged(self):
+        self.bind.local.other.insert({'_id': 1})
+        self.bind.set_profiling_level(2)
+        self.bind.db.coll.find_one({'a': 1})
+        self.assertEqual(self._entries(), [])
+
+    def test_oplog_tail(self):
+        self.bind.db.coll.insert({'_id': 0})
+        tail = pubsub.OplogTail(self.bind)
+        self.bind.db.coll.insert([{'_id': 1}, {'_id': 2}])
+        msgs = list(tail.tail({'ns': 'db.coll'}, await=False))
+        self.assertEqual([ m['o'] for m in msgs ], [{'_id': 1}, {'_id': 2}])
+        self.bind.db.coll.insert({'_id': 3})
+        cursor = tail.cursor({'ns': 'db.coll'}).max_await_time_ms(10)
+        self.assertEqual([ m['o'] for m in cursor ], [{'_id': 3}])
+
+    def test_channel(self):
+        messages = []
+        chan = pubsub.Channel(self.bind.db, 'channel')
+        chan.ensure_channel(capacity=8, message_size=64)
+        chan.sub('foo', lambda channel, message: messages.append(message))
+        chan.pub('foo.bar', 1)
+        chan.pub('baz', 2)
+        chan.multipub([ dict(k='foo', data=3) ])
+        chan.handle_ready()
+        self.assertEqual(messages, [ dict(k='foo.bar', data=1),
+                                     dict(k='foo', data=3) ])
+
+class TestWatch(TestCase):
+
+    def setUp(self):
+        self.bind = mim.Connection()
+        self.coll = self.bind.db.coll
+
+    def _drain(self, stream):
+        events = []
+        while True:
+            event = stream.try_next()
+            if event is None: return events
+            events.append(event)
+
+    def test_events(self):
+        stream = self.coll.watch()
+        self.coll.insert({'_id': 1, 'a': 1})
+        self.coll.update({'_id': 1}, {'$set': {'a': 2}})
+        self.coll.remove({'_id': 1})
+        events = self._drain(stream)
+        self.assertEqual([ e['operationType'] for e in events ],
+                         ['insert', 'update', 'delete'])
+        self.assertEqual([ e['documentKey'] for e in events ], [{'_id': 1}] * 3)
+        self.assertEqual(events[0]['fullDocument'], {'_id': 1, 'a': 1})
+        self.assertEqual(events[1]['fullDocument'], {'_id': 1, 'a': 2})
+        self.assertNotIn('fullDocument', events[2])
+        self.assertEqual(events[0]['ns'], {'db': 'db', 'coll': 'coll'})
+        self.assertEqual(len(set(e['_id']['_data'] for e in events)), 3)
+
+    def test_events_are_copies(self):
+        stream = self.coll.watch()
+        other = self.coll.watch()
+        self.coll.insert({'_id': 1, 'a': [1]})
+        self.coll.update({'_id': 1}, {'$push': {'a': 2}})
+        event = stream.try_next()
+        event['fullDocument']['a'].append(3)
+        self.assertEqual(other.try_next()['fullDocument'], {'_id': 1, 'a': [1]})
+
+    def test_spec(self):
+        inserts = self.coll.watch({'operationType': 'insert'})
+        big = self.coll.watch({'fullDocument.a': {'$gt': 5}})
+        self.coll.insert([ {'_id': i, 'a': i} for i in range(10) ])
+        self.coll.update({'_id': 0}, {'$set': {'a': 10}})
+        self.assertEqual(len(self._drain(inserts)), 10)
+        self.assertEqual([ e['documentKey']['_id'] for e in self._drain(big) ],
+                         [6, 7, 8, 9, 0])
+
+    def test_close(self):
+        stream = self.coll.watch()
+        with self.coll.watch() as other:
+            self.assertEqual(len(self.coll._watchers), 2)
+        self.assertEqual(self.coll._watchers, [stream])
+        self.assertFalse(other.alive)
+
+    def test_overflow(self):
+        stream = self.coll.watch(max_queue=3)
+        self.coll.insert([ {'_id': i} for i in range(5) ])
+        self.assertEqual([ stream.next()['documentKey']['_id'] for i in range(3) ],
+                         [0, 1, 2])
+        self.assertRaises(OperationFailure, stream.try_next)
+        self.assertFalse(stream.alive)
+        self.assertEqual(self.coll._watchers, [])
+
+    def test_drop(self):
+        stream = self.coll.watch()
+        self.coll.insert({'_id': 1})
+        self.bind.db.drop_collection('coll')
+        self.assertEqual([ e['operationType'] for e in stream ],
+                         ['insert', 'drop', 'invalidate'])
+        self.assertFalse(stream.alive)
+
+    def test_drop_database(self):
+        streams = [ self.coll.watch(), self.bind.db.other.watch(),
+                    self.bind.db2.coll.watch() ]
+        self.bind.drop_database('db')
+        for stream in streams[:2]:
+            self.assertEqual([ e['operationType'] for e in stream ],
+                             ['drop', 'invalidate'])
+        self.assertTrue(streams[2].alive)
+        self.bind.drop_all()
+        self.assertEqual([ e['operationType'] for e in streams[2] ],
+                         ['drop', 'invalidate'])
+        self.assertFalse(streams[2].alive)
+
+    def test_next_waits(self):
+        bind = mim.Connection(thread_safe=True)
+        coll = bind.db.coll
+        stream = coll.watch(max_await_time_ms=5000)
+        timer = threading.Timer(0.05, coll.insert, [{'_id': 1}])
+        timer.start()
+        self.assertEqual(stream.next()['documentKey'], {'_id': 1})
+        timer.join()
+        stream = coll.watch(max_await_time_ms=10)
+        self.assertRaises(StopIteration, stream.next)
@@ -0,0 +1,18 @@
+from unittest import TestCase
+
+from mongotools import mim, pubsub
+
+class ChannelTestCase(TestCase):
+    '''Channels over a mim connection that keeps an oplog'''
+
+    def setUp(self):
+        self.bind = mim.Connection(thread_safe=True, oplog_size=2**20)
+        self.messages = []
+
+    def _channel(self, name, capacity=100, **kwargs):
+        chan = pubsub.Channel(self.bind.db, name, **kwargs)
+        chan.ensure_channel(capacity=capacity)
+        return chan
+
+    def _callback(self, chan, message):
+        self.messages.append((chan.name, message['k']))
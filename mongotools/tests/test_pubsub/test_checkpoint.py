@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+import threading
+from unittest import TestCase
+
+import bson
+
+from mongotools import mim, pubsub
+from mongotools.tests.test_pubsub import ChannelTestCase
+
+class TestCheckpoint(ChannelTestCase):
+
+    def setUp(self):
+        super(TestCheckpoint, self).setUp()
+        self.checkpoint = pubsub.CollectionCheckpoint(
+            self.bind.db.checkpoints, 'coll')
+        self.spec = {'ns': 'db.coll', 'op': 'i'}
+
+    def _tail(self, **kwargs):
+        return pubsub.OplogTail(self.bind, self.checkpoint, **kwargs)
+
+    def _read(self, tail):
+        return [ msg['o']['x'] for msg in tail.tail(dict(self.spec), await=False) ]
+
+    def test_resume(self):
+        tail = self._tail()
+        self.bind.db.coll.insert([ dict(x=i) for i in range(3) ])
+        self.assertEqual(self._read(tail), [0, 1, 2])
+        tail.commit()
+        self.bind.db.coll.insert([ dict(x=i) for i in range(3, 5) ])
+        self.assertEqual(self._read(self._tail()), [3, 4])
+
+    def test_batched_commits(self):
+        tail = self._tail(commit_every=2, commit_interval=60)
+        self.assertEqual(self.checkpoint.load(), None)
+        self.bind.db.coll.insert([ dict(x=i) for i in range(3) ])
+        self._read(tail)
+        second = self.bind.local['oplog.rs'].find(self.spec).sort('$natural', 1)[1]
+        self.assertEqual(self.checkpoint.load(), second['ts'])
+        tail.commit()
+        self.assertEqual(self.checkpoint.load(), tail._position)
+        self.assertEqual(self._read(self._tail()), [])
+
+    def test_periodic_commits(self):
+        tail = self._tail(commit_interval=0)
+        self.bind.db.coll.insert(dict(x=0))
+        self._read(tail)
+        self.assertEqual(self.checkpoint.load(), tail._position)
+
+    def test_commit_after_handled(self):
+        tail = self._tail(commit_every=1)
+        self.bind.db.coll.insert([ dict(x=i) for i in range(2) ])
+        msgs = tail.tail(dict(self.spec), await=False)
+        first = msgs.next()
+        self.assertEqual(self.checkpoint.load(), None)
+        msgs.next()
+        self.assertEqual(self.checkpoint.load(), first['ts'])
+        msgs.close()
+        self.assertEqual(self._read(self._tail()), [1])
+
+    def test_dispatcher_holds(self):
+        dispatcher = pubsub.Dispatcher(workers=2)
+        self.addCleanup(dispatcher.close)
+        chan = self._channel('chan', dispatcher=dispatcher,
+                             checkpoint=self.checkpoint)
+        release = threading.Event()
+        self.addCleanup(release.set)
+        chan.sub('slow', lambda chan, message: release.wait())
+        chan.sub('fast', self._callback)
+        chan.pub('fast')
+        chan.pub('slow')
+        chan.pub('fast')
+        chan.handle_ready()
+        while not self.messages:
+            release.wait(0.01)
+        chan._tail.commit()
+        fast, slow = self.bind.local['oplog.rs'].find(
+            {'ns': 'db.chan'}).sort('$natural', 1).limit(2)
+        self.assertTrue(fast['ts'] <= self.checkpoint.load() < slow['ts'])
+        release.set()
+        dispatcher.join()
+        chan._tail.commit()
+        self.assertEqual(self.checkpoint.load(), chan._tail._position)
+
+    def test_gap(self):
+        bind = mim.Connection(oplog_size=2000)
+        gaps = []
+        tail = pubsub.OplogTail(
+            bind, on_gap=lambda position, oldest: gaps.append((position, oldest)))
+        bind.db.coll.insert(dict(x=-1))
+        self.assertEqual([ msg['o']['x'] for msg in tail.tail(dict(self.spec), await=False) ],
+                         [-1])
+        for i in range(100):
+            bind.db.coll.insert(dict(x=i))
+        msgs = list(tail.tail(dict(self.spec), await=False))
+        oldest = bind.local['oplog.rs'].find_one(sort=[('$natural', 1)])
+        self.assertEqual(len(gaps), 1)
+        self.assertEqual(gaps[0][1], oldest['ts'])
+        self.assertEqual(msgs[0]['ts'], oldest['ts'])
+        self.assertEqual(msgs[-1]['o']['x'], 99)
+        self.assertEqual(list(tail.tail(dict(self.spec), await=False)), [])
+        self.assertEqual(len(gaps), 1)
+
+    def test_no_gap_when_quiet(self):
+        bind = mim.Connection(oplog_size=2000)
+        gaps = []
+        tail = pubsub.OplogTail(
+            bind, on_gap=lambda position, oldest: gaps.append((position, oldest)))
+        bind.db.coll.insert(dict(x=-1))
+        self.assertEqual(len(list(tail.poll(dict(self.spec)))), 1)
+        for i in range(100):
+            bind.db.other.insert(dict(x=i))
+            if i % 5 == 0:
+                self.assertEqual(list(tail.tail(dict(self.spec), await=False)), [])
+        oldest = bind.local['oplog.rs'].find_one(sort=[('$natural', 1)])
+        self.assertTrue(oldest['o']['x'] > 0)
+        bind.db.coll.insert(dict(x=0))
+        self.assertEqual([ msg['o']['x'] for msg in tail.tail(dict(self.spec), await=False) ],
+                         [0])
+        self.assertEqual(gaps, [])
+
+class TestFileCheckpoint(TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.checkpoint = pubsub.FileCheckpoint(os.path.join(self.dir, 'position'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_load(self):
+        self.assertEqual(self.checkpoint.load(), None)
+        self.checkpoint.save(bson.Timestamp(1234, 5))
+        self.checkpoint.save(bson.Timestamp(1235, 1))
+        self.assertEqual(self.checkpoint.load(), bson.Timestamp(1235, 1))
+        self.assertEqual(os.listdir(self.dir), ['position'])
+
+    def test_unreadable(self):
+        for content in ['', '{"time": 12', '{"time": 12}', '[]']:
+            with open(os.path.join(self.dir, 'position'), 'w') as fp:
+                fp.write(content)
+            self.assertRaises(ValueError, self.checkpoint.load)
+        self.assertRaises(ValueError, pubsub.OplogTail,
+                          mim.Connection(oplog_size=2**20), self.checkpoint)
@@ -0,0 +1,65 @@
+import threading
+
+from mongotools import pubsub
+from mongotools.tests.test_pubsub import ChannelTestCase
+
+class TestDispatcher(ChannelTestCase):
+
+    def setUp(self):
+        super(TestDispatcher, self).setUp()
+        self.dispatcher = pubsub.Dispatcher(workers=4, max_queue=2)
+        self.chan = self._channel('chan', 1000, dispatcher=self.dispatcher)
+
+    def tearDown(self):
+        self.dispatcher.close()
+
+    def test_per_key_order(self):
+        @self.chan.sub('')
+        def callback(chan, message):
+            self.messages.append((message['k'], message['data'],
+                                  threading.current_thread().name))
+        for i in range(50):
+            for k in ['a', 'b', 'c']:
+                self.chan.pub(k, i)
+        self.chan.handle_ready()
+        self.dispatcher.join()
+        self.assertEqual(len(self.messages), 150)
+        for k in ['a', 'b', 'c']:
+            seen = [ m for m in self.messages if m[0] == k ]
+            self.assertEqual([ data for _, data, _ in seen ], range(50))
+            self.assertEqual(len(set(name for _, _, name in seen)), 1)
+            self.assertNotEqual(seen[0][2], threading.current_thread().name)
+        stats = self.dispatcher.stats()
+        self.assertEqual(sum(s['submitted'] for s in stats), 150)
+        self.assertEqual(sum(s['completed'] for s in stats), 150)
+        self.assertTrue(all(s['max_depth'] <= 2 for s in stats))
+
+    def test_backpressure(self):
+        release = threading.Event()
+        self.chan.sub('', lambda chan, message: release.wait())
+        for i in range(5):
+            self.chan.pub('k')
+        timer = threading.Timer(0.05, release.set)
+        timer.start()
+        self.chan.handle_ready()
+        timer.join()
+        self.dispatcher.join()
+        stats = [ s for s in self.dispatcher.stats() if s['submitted'] ]
+        self.assertEqual(len(stats), 1)
+        self.assertEqual(stats[0]['completed'], 5)
+        self.assertTrue(stats[0]['blocked'] >= 1)
+        self.assertTrue(stats[0]['blocked_time'] > 0)
+        self.assertEqual(stats[0]['depth'], 0)
+
+    def test_errors(self):
+        def callback(chan, message):
+            if message['k'] == 'bad':
+                raise ValueError(message['k'])
+            self.messages.append(message['k'])
+        self.chan.sub('', callback)
+        for k in ['bad', 'good']:
+            self.chan.pub(k)
+        self.chan.handle_ready(raise_errors=True)
+        self.dispatcher.join()
+        self.assertEqual(self.messages, ['good'])
+        self.assertEqual(sum(s['errors'] for s in self.dispatcher.stats()), 1)
@@ -0,0 +1,76 @@
+import time
+import threading
+
+from mongotools import pubsub
+from mongotools.tests.test_pubsub import ChannelTestCase
+
+class TestLoop(ChannelTestCase):
+
+    def setUp(self):
+        super(TestLoop, self).setUp()
+        self.loop = pubsub.Loop(self.bind)
+        self.chans = [ self.loop.add(self._channel('chan%d' % i))
+                       for i in range(3) ]
+
+    def test_poll(self):
+        chan = self.chans[0]
+        chan.sub('foo', self._callback)
+        self.assertEqual(chan.poll(), 0)
+        chan.pub('foo.1')
+        chan.pub('bar')
+        chan.pub('foo.2')
+        self.assertEqual(chan.poll(), 2)
+        self.assertEqual(chan.poll(), 0)
+        chan.pub('foo.3')
+        self.assertEqual(chan.poll(), 1)
+        self.assertEqual([ k for name, k in self.messages ],
+                         ['foo.1', 'foo.2', 'foo.3'])
+
+    def test_run_once(self):
+        for chan in self.chans:
+            chan.sub('', self._callback)
+        self.chans[2].pub('a')
+        self.chans[0].pub('b')
+        self.assertEqual(self.loop.run_once(), 2)
+        self.assertEqual(sorted(self.messages), [('chan0', 'b'), ('chan2', 'a')])
+        self.assertEqual(self.loop.run_once(block=False), 0)
+
+    def test_wakes_on_publish(self):
+        self.chans[1].sub('', self._callback)
+        self.loop.run_once(block=False)
+        timer = threading.Timer(0.05, self.chans[1].pub, ['late'])
+        timer.start()
+        start = time.time()
+        self.loop.run_once()
+        timer.join()
+        self.assertTrue(time.time() - start < 0.5)
+        self.loop.run_once(block=False)
+        self.assertEqual(self.messages, [('chan1', 'late')])
+
+    def test_generator_callbacks(self):
+        steps = []
+        def callback(chan, message):
+            steps.append((message['k'], 1))
+            yield
+            steps.append((message['k'], 2))
+        self.chans[0].sub('', callback)
+        self.chans[0].pub('a')
+        self.chans[0].pub('b')
+        self.loop.run_once()
+        self.assertEqual(steps, [('a', 1), ('b', 1)])
+        self.loop.run_once()
+        self.assertEqual(steps, [('a', 1), ('b', 1), ('a', 2), ('b', 2)])
+        self.chans[0].pub('c')
+        self.chans[0].handle_ready()
+        self.assertEqual(steps[-2:], [('c', 1), ('c', 2)])
+
+    def test_run_stop(self):
+        def callback(chan, message):
+            self.messages.append(message['k'])
+            if message['k'] == 'stop':
+                self.loop.stop()
+        self.chans[0].sub('', callback)
+        for k in ['a', 'b', 'stop']:
+            self.chans[0].pub(k)
+        self.loop.run()
+        self.assertEqual(self.messages, ['a', 'b', 'stop'])
@@ -0,0 +1,50 @@
+from mongotools import pubsub
+from mongotools.tests.test_pubsub import ChannelTestCase
+
+class TestOplogMux(ChannelTestCase):
+
+    def setUp(self):
+        super(TestOplogMux, self).setUp()
+        self.mux = pubsub.OplogMux(self.bind)
+        self.chans = [ self.mux.add(self._channel('chan%d' % i))
+                       for i in range(3) ]
+
+    def test_spec(self):
+        self.assertEqual(self.mux._spec(), None)
+        self.chans[0].sub('', self._callback)
+        self.assertEqual(self.mux._spec(), {'ns': {'$in': ['db.chan0']}, 'op': 'i'})
+        self.chans[1].sub('foo', self._callback)
+        spec = self.mux._spec()
+        self.assertEqual(sorted(spec), ['$or', 'op'])
+        self.assertEqual(spec['$or'][0]['ns'], 'db.chan1')
+        self.assertEqual(spec['$or'][0]['o.k'].pattern, '^foo')
+        self.assertEqual(spec['$or'][1], {'ns': {'$in': ['db.chan0']}})
+
+    def test_dispatch(self):
+        self.chans[0].sub('', self._callback)
+        self.chans[1].sub('foo', self._callback)
+        self.chans[1].pub('bar')
+        self.chans[2].pub('foo')
+        self.chans[1].pub('foo.1')
+        self.chans[0].pub('bar')
+        self.assertEqual(self.mux.handle_ready(), 2)
+        self.assertEqual(self.messages, [('chan1', 'foo.1'), ('chan0', 'bar')])
+
+    def test_shared_namespace(self):
+        other = self.mux.add(pubsub.Channel(self.bind.db, 'chan0'))
+        self.chans[0].sub('a', self._callback)
+        other.sub('b', lambda chan, message: self.messages.append(('other', message['k'])))
+        for k in ['a', 'b', 'c']:
+            self.chans[0].pub(k)
+        self.assertEqual(self.mux.poll(), 2)
+        self.assertEqual(self.mux.poll(), 0)
+        self.assertEqual(self.messages, [('chan0', 'a'), ('other', 'b')])
+
+    def test_remove(self):
+        for chan in self.chans:
+            chan.sub('', self._callback)
+        self.mux.remove(self.chans[1])
+        for chan in self.chans:
+            chan.pub('x')
+        self.assertEqual(self.mux.poll(), 2)
+        self.assertEqual(self.messages, [('chan0', 'x'), ('chan2', 'x')])
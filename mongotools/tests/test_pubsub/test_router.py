@@ -0,0 +1,60 @@
+import re
+from unittest import TestCase
+
+from mongotools.pubsub.router import Router
+
+class TestRouter(TestCase):
+
+    def setUp(self):
+        self.router = Router()
+
+    def test_match(self):
+        self.router.add('foo', 1)
+        self.router.add('foo.bar', 2)
+        self.router.add('foo', 3)
+        self.router.add('baz', 4)
+        self.assertEqual(self.router.match('foo.bar.baz'), [1, 3, 2])
+        self.assertEqual(self.router.match('foo.ba'), [1, 3])
+        self.assertEqual(self.router.match('fo'), [])
+        self.assertEqual(self.router.match('bazooka'), [4])
+
+    def test_empty_prefix(self):
+        self.assertFalse(self.router)
+        self.router.add('', 1)
+        self.router.add('a', 2)
+        self.assertTrue(self.router)
+        self.assertEqual(self.router.match(''), [1])
+        self.assertEqual(self.router.match('ab'), [1, 2])
+        self.assertIsNone(self.router.pattern())
+
+    def test_pattern(self):
+        self.router.add('foo.bar')
+        self.router.add('foo.baz')
+        self.router.add('fob')
+        self.router.add('a+')
+        self.router.add('a+b')
+        pattern = re.compile(self.router.pattern())
+        for key in ['foo.bar', 'foo.baz.x', 'fob', 'a+', 'a+c']:
+            self.assertTrue(pattern.match(key), key)
+        for key in ['foo', 'foo.ba', 'fo', 'aa', 'xfob']:
+            self.assertFalse(pattern.match(key), key)
+
+    def test_pattern_cached(self):
+        self.router.add('foo')
+        pattern = self.router.pattern()
+        self.router.add('foo', 1)
+        self.assertIs(self.router.pattern(), pattern)
+        self.router.add('bar')
+        self.assertNotEqual(self.router.pattern(), pattern)
+
+    def test_long_prefixes(self):
+        long = 'x.' * 2500
+        self.router.add(long + 'a')
+        self.router.add(long + 'b.' * 2000)
+        self.router.add(long + 'b.c')
+        pattern = re.compile(self.router.pattern())
+        self.assertTrue(pattern.match(long + 'ab'))
+        self.assertTrue(pattern.match(long + 'b.c'))
+        self.assertTrue(pattern.match(long + 'b.' * 2001))
+        self.assertFalse(pattern.match(long))
+        self.assertFalse(pattern.match(long + 'b.' * 1999))